@@ -0,0 +1,179 @@
+import math
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+# 优先级从高到低：交互式搜索优先于批量搜索和建索引任务
+PRIORITIES = ('interactive', 'bulk', 'indexing')
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入（队列已满，或排队期间超出时间预算/被取消），retry_after为建议的重试秒数"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, user, priority):
+        self.user = user
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+def _summarize(samples):
+    """毫秒级分布摘要"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 2),
+        'p50': pct(0.50),
+        'p95': pct(0.95),
+        'p99': pct(0.99),
+        'max': round(ordered[-1] * 1000, 2),
+    }
+
+
+class AdmissionController:
+    """有界准入队列
+
+    同时执行的请求数不超过max_concurrency，其余请求排队；排队总数或单个用户的排队数超限时立即拒绝。
+    出队时先按优先级，同一优先级内在用户之间轮转，避免单个用户的大量请求饿死其他用户。
+    """
+
+    def __init__(self, max_concurrency=2, max_queue=32, max_queue_per_user=8, samples=1000):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        # 每个优先级一个 用户 -> 等待队列 的有序字典，字典顺序即用户轮转顺序
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.queued = 0
+        self.queued_per_user = {}
+        self.wait_times = {priority: deque(maxlen=samples) for priority in PRIORITIES}
+        self.service_times = deque(maxlen=samples)
+        self.counters = {
+            'admitted': 0,
+            'rejected_queue_full': 0,
+            'rejected_user_limit': 0,
+            'expired_in_queue': 0,
+        }
+
+    @contextmanager
+    def admit(self, user, priority='interactive', budget=None):
+        """获取执行名额，退出时释放；budget为带exhausted()的时间预算，排队期间耗尽则放弃排队"""
+        self._acquire(user, priority, budget)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - start)
+
+    def _acquire(self, user, priority, budget):
+        if priority not in PRIORITIES:
+            raise ValueError(f"不支持的优先级: {priority}，可选: {', '.join(PRIORITIES)}")
+        with self.cond:
+            if self.in_flight < self.max_concurrency and self.queued == 0:
+                self.in_flight += 1
+                self.counters['admitted'] += 1
+                self.wait_times[priority].append(0.0)
+                return
+            if self.queued >= self.max_queue:
+                self.counters['rejected_queue_full'] += 1
+                raise AdmissionRejected('CLIP服务繁忙，排队已满', self._retry_after())
+            if self.queued_per_user.get(user, 0) >= self.max_queue_per_user:
+                self.counters['rejected_user_limit'] += 1
+                raise AdmissionRejected('该用户排队中的请求过多', self._retry_after())
+
+            waiter = _Waiter(user, priority)
+            self.queues[priority].setdefault(user, deque()).append(waiter)
+            self.queued += 1
+            self.queued_per_user[user] = self.queued_per_user.get(user, 0) + 1
+
+            while not waiter.granted:
+                if budget is not None and budget.exhausted():
+                    self._remove(waiter)
+                    self.counters['expired_in_queue'] += 1
+                    raise AdmissionRejected('排队期间超出时间预算或已取消', self._retry_after())
+                self.cond.wait(timeout=0.1)
+
+            self.counters['admitted'] += 1
+            self.wait_times[priority].append(time.monotonic() - waiter.enqueued_at)
+
+    def _remove(self, waiter):
+        users = self.queues[waiter.priority]
+        queue = users[waiter.user]
+        queue.remove(waiter)
+        if not queue:
+            del users[waiter.user]
+        self._dequeued(waiter.user)
+
+    def _dequeued(self, user):
+        self.queued -= 1
+        self.queued_per_user[user] -= 1
+        if self.queued_per_user[user] == 0:
+            del self.queued_per_user[user]
+
+    def _release(self, service_time):
+        with self.cond:
+            self.in_flight -= 1
+            self.service_times.append(service_time)
+            self._grant_next()
+
+    def _grant_next(self):
+        """在持有锁时调用：按优先级、用户轮转把空出的名额分给排队者"""
+        while self.in_flight < self.max_concurrency and self.queued:
+            for priority in PRIORITIES:
+                users = self.queues[priority]
+                if not users:
+                    continue
+                user, queue = next(iter(users.items()))
+                waiter = queue.popleft()
+                if queue:
+                    users.move_to_end(user)
+                else:
+                    del users[user]
+                self._dequeued(user)
+                waiter.granted = True
+                self.in_flight += 1
+                break
+        self.cond.notify_all()
+
+    def _retry_after(self):
+        """按近期平均执行时间估算排到队时需要等待的秒数"""
+        if self.service_times:
+            mean = sum(self.service_times) / len(self.service_times)
+        else:
+            mean = 1.0
+        return max(1, math.ceil(mean * (self.queued + self.in_flight) / self.max_concurrency))
+
+    def metrics(self):
+        with self.cond:
+            all_waits = [w for samples in self.wait_times.values() for w in samples]
+            return {
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'max_queue_per_user': self.max_queue_per_user,
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'queued_by_priority': {
+                    priority: sum(len(q) for q in users.values())
+                    for priority, users in self.queues.items()
+                },
+                'counters': dict(self.counters),
+                'queue_wait_ms': _summarize(all_waits),
+                'queue_wait_ms_by_priority': {
+                    priority: _summarize(samples) for priority, samples in self.wait_times.items()
+                },
+                'service_time_ms': _summarize(self.service_times),
+            }
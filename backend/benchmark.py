@@ -0,0 +1,274 @@
+"""检索质量与速度基准：对比基础模型和微调模型
+
+在留出的划分（默认为 train.py 划分出的测试集）上，对每个模型和精度模式测量：
+双向检索召回率（text→image / image→text recall@k）、批量编码吞吐（images/sec、texts/sec）、
+单条查询的编码延迟（p50/p99）以及内存（权重大小、进程内存峰值），结果写入JSON报告。
+每个（模型, 精度）组合默认在单独的子进程中运行，内存峰值互不影响。
+
+模型可以是：CLIP模型名（如 ViT-B/32）、train.py 导出的模型工件目录（含 model.f16.json），
+或检查点文件（train.py 的 ckpt-*.pt、finetune.py 的 finetuned_clip_epoch*.pt，加载到 --base 指定的结构上）。
+
+用法:
+    python benchmark.py --data-dir /tmp/data --split test \
+        --model base=ViT-B/32 --model tuned=/opt/ml/model --model ep2=finetuned_clip_epoch2.pt \
+        --precision fp32,bf16,int8 --report benchmark_report.json
+"""
+import os
+import io
+import json
+import time
+import argparse
+import contextlib
+import multiprocessing
+import torch
+import torch.nn as nn
+import clip
+from torch.utils.data import DataLoader
+from train import (FashionDataset, DatasetManifest, LocalFiles, load_prepared_dataset, merge_adapter,
+                   set_projection, peak_memory_mb, _recall_at_k)
+from serving import build_serving_model
+
+PRECISIONS = ('fp32', 'bf16', 'fp16', 'int8')
+
+
+def parse_models(specs):
+    """['base=ViT-B/32', '/opt/ml/model'] -> [('base', 'ViT-B/32'), ('/opt/ml/model', '/opt/ml/model')]"""
+    models = []
+    for spec in specs:
+        name, sep, path = spec.partition('=')
+        models.append((name, path) if sep else (spec, spec))
+    return models
+
+
+def load_model(spec, base='ViT-B/32'):
+    """按模型名、模型工件目录或检查点文件加载fp32的CLIP模型（CPU）"""
+    if os.path.isdir(spec):
+        with open(os.path.join(spec, 'model_info.json'), 'r') as f:
+            model_info = json.load(f)
+        return build_serving_model(spec, model_info['architecture'])
+    if not os.path.isfile(spec):
+        model, _ = clip.load(spec, device='cpu', jit=False)
+        return model.float().eval()
+
+    model, _ = clip.load(base, device='cpu', jit=False)
+    model = model.float()
+    checkpoint = torch.load(spec, map_location='cpu', weights_only=False)
+    if 'adapter_state_dict' in checkpoint:
+        merge_adapter(model, checkpoint['adapter_state_dict'], checkpoint['lora_scale'])
+    else:
+        state = checkpoint['model_state_dict']
+        # 蒸馏得到的学生模型投影维度与基础结构不同
+        if state['text_projection'].shape != model.text_projection.shape:
+            set_projection(model, torch.zeros(state['visual.proj'].shape), torch.zeros(state['text_projection'].shape))
+        model.load_state_dict(state)
+    return model.eval()
+
+
+def apply_precision(model, precision, device):
+    """返回 (模型, 前向时使用的上下文)；int8为Linear层的动态量化（仅CPU）"""
+    if precision == 'int8':
+        if device.type != 'cpu':
+            raise ValueError('int8动态量化只支持CPU')
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8), contextlib.nullcontext
+    if precision in ('bf16', 'fp16'):
+        dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+        return model, lambda: torch.autocast(device.type, dtype=dtype)
+    return model, contextlib.nullcontext
+
+
+def weights_mb(model):
+    """序列化后的权重大小（量化模型为打包后的大小）"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return round(buffer.tell() / 1024 ** 2, 2)
+
+
+def latency_summary(samples):
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': pct(0.50),
+        'p99': pct(0.99),
+    }
+
+
+def encode_split(model, dataset, autocast, device, batch_size, workers):
+    """按批编码整个划分，返回归一化特征及纯编码耗时（不含图片解码）"""
+    image_chunks, text_chunks = [], []
+    image_time = text_time = 0.0
+    with torch.no_grad():
+        for images, texts in DataLoader(dataset, batch_size=batch_size, num_workers=workers):
+            images, texts = images.to(device), texts.to(device)
+            start = time.perf_counter()
+            with autocast():
+                image_features = model.encode_image(images)
+            image_time += time.perf_counter() - start
+            start = time.perf_counter()
+            with autocast():
+                text_features = model.encode_text(texts)
+            text_time += time.perf_counter() - start
+            image_chunks.append(image_features.float())
+            text_chunks.append(text_features.float())
+    image_features = torch.cat(image_chunks)
+    text_features = torch.cat(text_chunks)
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    text_features /= text_features.norm(dim=-1, keepdim=True)
+    return image_features, text_features, image_time, text_time
+
+
+def single_query_latency(model, dataset, autocast, device, queries):
+    """逐条编码查询文本和图片，模拟在线搜索的单条请求"""
+    count = min(queries, len(dataset))
+    samples = {'text': [], 'image': []}
+    with torch.no_grad():
+        for i in range(count + 1):
+            image, text = dataset[i % len(dataset)]
+            for name, encode, x in (('text', model.encode_text, text), ('image', model.encode_image, image)):
+                x = x.unsqueeze(0).to(device)
+                start = time.perf_counter()
+                with autocast():
+                    encode(x)
+                # 第一条作为预热，不计入
+                if i > 0:
+                    samples[name].append(time.perf_counter() - start)
+    return {name: latency_summary(values) for name, values in samples.items()}
+
+
+def load_split(args, resolution):
+    """留出划分的数据集：--jsonl/--image-root，或 --data-dir 中 train.py 准备好的划分"""
+    if args.jsonl:
+        source, jsonl_path, image_root = LocalFiles(), args.jsonl, args.image_root
+    else:
+        source, dataset_paths = load_prepared_dataset(args.data_dir)
+        jsonl_path, image_root = dataset_paths[f'{args.split}_path'], dataset_paths['image_dir']
+    manifest = None
+    if args.manifest:
+        manifest = DatasetManifest.build(args.manifest, [jsonl_path], image_root, source, workers=args.workers)
+    dataset = FashionDataset(jsonl_path, image_root, clip.clip._transform(resolution), source, manifest)
+    if args.limit and len(dataset) > args.limit:
+        dataset.image_paths = dataset.image_paths[:args.limit]
+        dataset.texts = dataset.texts[:args.limit]
+        dataset.tokenized_texts = dataset.tokenized_texts[:args.limit]
+    return dataset
+
+
+def run_config(job):
+    """测量一个（模型, 精度）组合，返回报告中的一条结果"""
+    args, name, spec, precision = job['args'], job['name'], job['spec'], job['precision']
+    result = {'model': name, 'spec': spec, 'precision': precision}
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    try:
+        baseline_mb = peak_memory_mb()
+        load_start = time.perf_counter()
+        model = load_model(spec, args.base).to(device)
+        model, autocast = apply_precision(model, precision, device)
+        result['load_s'] = round(time.perf_counter() - load_start, 3)
+        dataset = load_split(args, model.visual.input_resolution)
+
+        image_features, text_features, image_time, text_time = encode_split(
+            model, dataset, autocast, device, args.batch_size, args.workers)
+        topk = tuple(args.topk)
+        t2i = _recall_at_k(text_features, image_features, topk, 1024)
+        i2t = _recall_at_k(image_features, text_features, topk, 1024)
+        result['recall'] = {**{f"top{k}": t2i[k] for k in topk}, **{f"i2t_top{k}": i2t[k] for k in topk}}
+        result['samples'] = len(dataset)
+        result['images_per_sec'] = round(len(dataset) / image_time, 2)
+        result['texts_per_sec'] = round(len(dataset) / text_time, 2)
+        result['latency_ms'] = single_query_latency(model, dataset, autocast, device, args.latency_queries)
+        result['memory_mb'] = {
+            'weights': weights_mb(model),
+            'peak_rss': round(peak_memory_mb(), 1) if peak_memory_mb() is not None else None,
+            'baseline_rss': round(baseline_mb, 1) if baseline_mb is not None else None,
+        }
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_benchmark(args):
+    jobs = [{'args': args, 'name': name, 'spec': spec, 'precision': precision}
+            for name, spec in parse_models(args.model) for precision in args.precision]
+    results = []
+    for job in jobs:
+        print(f"测量 {job['name']}（{job['precision']}）...")
+        if args.no_isolate:
+            result = run_config(job)
+        else:
+            # 每个组合在新的子进程中运行，进程内存峰值只反映该组合
+            with multiprocessing.get_context('spawn').Pool(1) as pool:
+                result = pool.apply(run_config, (job,))
+        if 'error' in result:
+            print(f"  失败: {result['error']}")
+        results.append(result)
+    return {
+        'config': {
+            'split': args.jsonl or f"{args.data_dir}:{args.split}",
+            'base': args.base,
+            'device': args.device,
+            'threads': args.threads or torch.get_num_threads(),
+            'batch_size': args.batch_size,
+            'latency_queries': args.latency_queries,
+            'topk': args.topk,
+        },
+        'results': results,
+    }
+
+
+def print_report(report):
+    print(f"{'模型':<16}{'精度':<6}{'t2i@1':>8}{'i2t@1':>8}{'img/s':>9}{'txt/s':>9}"
+          f"{'文本p50':>10}{'文本p99':>10}{'图片p50':>10}{'权重MB':>9}{'峰值MB':>9}")
+    for result in report['results']:
+        if 'error' in result:
+            print(f"{result['model']:<16}{result['precision']:<6}  失败: {result['error']}")
+            continue
+        recall, latency, memory = result['recall'], result['latency_ms'], result['memory_mb']
+        print(f"{result['model']:<16}{result['precision']:<6}{recall['top1'] * 100:>7.2f}%{recall['i2t_top1'] * 100:>7.2f}%"
+              f"{result['images_per_sec']:>9}{result['texts_per_sec']:>9}"
+              f"{latency['text']['p50']:>10}{latency['text']['p99']:>10}{latency['image']['p50']:>10}"
+              f"{memory['weights']:>9}{str(memory['peak_rss']):>9}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # 留出的划分：train.py 准备的 --data-dir 中的 --split，或直接指定 --jsonl 和 --image-root
+    parser.add_argument('--data-dir', type=str, default='/tmp/data')
+    parser.add_argument('--split', type=str, default='test', choices=['train', 'val', 'test'])
+    parser.add_argument('--jsonl', type=str, default=None)
+    parser.add_argument('--image-root', type=str, default='images')
+    parser.add_argument('--manifest', type=str, default='/tmp/data/benchmark_manifest.npz')
+    parser.add_argument('--limit', type=int, default=None)
+
+    # 模型与精度：--model 可重复，格式为 名称=模型名/工件目录/检查点，或直接写路径
+    parser.add_argument('--model', type=str, action='append', required=True)
+    parser.add_argument('--base', type=str, default='ViT-B/32')
+    parser.add_argument('--precision', type=lambda s: s.split(','), default=['fp32'])
+
+    # 测量设置
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latency-queries', type=int, default=100)
+    parser.add_argument('--topk', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--no-isolate', action='store_true')
+
+    parser.add_argument('--report', type=str, default='benchmark_report.json')
+
+    args = parser.parse_args()
+    unknown = [p for p in args.precision if p not in PRECISIONS]
+    if unknown:
+        parser.error(f"不支持的精度: {', '.join(unknown)}，可选: {', '.join(PRECISIONS)}")
+
+    report = run_benchmark(args)
+    print_report(report)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"报告已写入 {args.report}")
@@ -0,0 +1,29 @@
+const path = require('path');
+
+// 将 CLIP 服务的结果与图片信息合并，并过滤低相似度结果
+// score 始终是 CLIP 相似度，min_score 只作用于它；启用词法融合时 CLIP 服务已按 fused_score 排好序，
+// 这里保持该顺序并把 fused_score / lexical_score 一并转发
+function mergeClipResults(clipResults, images, minScore) {
+  return clipResults
+    .filter(result => result.score >= minScore)
+    .map(result => {
+      // 查找匹配的图片，考虑可能使用临时路径的情况
+      const image = images.find(img =>
+        img.file_path === result.path ||
+        path.basename(img.file_path) === path.basename(result.path)
+      );
+      if (!image) return null;
+      const merged = {
+        ...image,
+        url: image.s3_url || `http://57.181.23.46/${image.file_path}`,
+        score: result.score,
+      };
+      if (result.fused_score !== undefined) {
+        merged.fused_score = result.fused_score;
+        merged.lexical_score = result.lexical_score;
+      }
+      return merged;
+    }).filter(item => item !== null);
+}
+
+module.exports = { mergeClipResults };
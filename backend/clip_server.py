@@ -1,17 +1,26 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import torch
-from PIL import Image
 import clip
 import os
 import numpy as np
 import boto3
 import json
+import base64
 import tempfile
 import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from embedding_store import EmbeddingStore, evaluate_codecs, file_signatures, import_corpus
+from admission import AdmissionController, AdmissionRejected, PRIORITIES
+from lexical_index import LexicalIndex, fuse_scores, FUSIONS
+from serving import BatchPreprocessor, build_serving_model, artifact_fingerprint
 
 app = Flask(__name__)
-CORS(app)
+# 暴露搜索进度相关的响应头，前端可以据此提示结果不完整
+CORS(app, expose_headers=['X-Search-Incomplete', 'X-Search-Scored', 'X-Search-Total', 'X-Search-Lexical-Candidates'])
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -29,112 +38,379 @@ s3_client = boto3.client(
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY
 )
+# SAGEMAKER_RUNTIME_ENDPOINT_URL 可指向 local_endpoint.py 启动的本地端点替身，用于离线压测
 sagemaker_runtime = boto3.client(
     'sagemaker-runtime',
     region_name=AWS_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    endpoint_url=os.environ.get('SAGEMAKER_RUNTIME_ENDPOINT_URL') or None
 )
 
 # 加载默认CLIP模型
+# CLIP_MODEL_DIR 指向 train.py 导出的自包含模型工件（如 --distill-teacher ViT-L/14 蒸馏出的学生模型）时用它代替ViT-L/14；
+# MODEL_FINGERPRINT 标识当前模型，嵌入缓存由其他模型生成时清空重建
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-L/14", device=device)
+MODEL_DIR = os.environ.get('CLIP_MODEL_DIR')
+if MODEL_DIR:
+    with open(os.path.join(MODEL_DIR, 'model_info.json'), 'r') as f:
+        model_info = json.load(f)
+    model = build_serving_model(MODEL_DIR, model_info['architecture']).to(device)
+    MODEL_FINGERPRINT = model_info.get('model_fingerprint') or artifact_fingerprint(MODEL_DIR)
+    logger.info(f"已加载模型工件 {MODEL_DIR}（{model_info.get('finetune_mode')}，"
+                f"蒸馏自 {model_info.get('distillation', {}).get('teacher_model', '无')}）")
+else:
+    model, _ = clip.load("ViT-L/14", device=device)
+    MODEL_FINGERPRINT = 'clip:ViT-L/14'
+
+# 图片编码前的批量预处理：解码缩放进复用的uint8缓冲区后整批归一化，结果与CLIP的preprocess一致
+# 预处理器带有各自的缓冲区，不能被并发的请求共用，因此放在池中按需取用，池的大小随并发请求数增长
+# CLIP_PREPROCESS_WORKERS: 每个预处理器解码图片的线程数
+IMAGE_BATCH_SIZE = 10
+PREPROCESS_WORKERS = int(os.environ.get('CLIP_PREPROCESS_WORKERS', str(min(4, os.cpu_count() or 1))))
+preprocessor_pool = queue.LifoQueue()
+
+@contextmanager
+def image_preprocessor():
+    try:
+        preprocessor = preprocessor_pool.get_nowait()
+    except queue.Empty:
+        preprocessor = BatchPreprocessor(model.visual.input_resolution, IMAGE_BATCH_SIZE, PREPROCESS_WORKERS)
+    try:
+        yield preprocessor
+    finally:
+        preprocessor_pool.put(preprocessor)
 
 # 已加载的微调模型缓存
 fine_tuned_models = {}
 
+# 默认模型的图像嵌入缓存，避免每次搜索都重新编码同一批图片
+# 缓存以追加式文件保存在 CLIP_EMBEDDING_DIR 中并通过mmap映射，多个worker进程共享页缓存
+# 每张图片记录编码时的文件大小和修改时间，同一路径下的图片被替换后重新编码
+# CLIP_EMBEDDING_CODEC: fp32 / fp16 / int8 / pq
+# CLIP_EMBEDDING_KEEP_RAW: 为1时额外保存fp32全精度副本，用于精确重排序
+# CLIP_RERANK: 压缩打分后用全精度副本精确重排的候选数，0为关闭
+EMBEDDING_DIR = os.environ.get('CLIP_EMBEDDING_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_cache'))
+EMBEDDING_CODEC = os.environ.get('CLIP_EMBEDDING_CODEC', 'fp32')
+EMBEDDING_KEEP_RAW = os.environ.get('CLIP_EMBEDDING_KEEP_RAW', '0') == '1'
+PQ_SUBSPACES = int(os.environ.get('CLIP_PQ_SUBSPACES', '0')) or None
+RERANK_CANDIDATES = int(os.environ.get('CLIP_RERANK', '0'))
+embedding_store = EmbeddingStore(
+    EMBEDDING_DIR,
+    model.visual.output_dim,
+    codec=EMBEDDING_CODEC,
+    keep_raw=EMBEDDING_KEEP_RAW,
+    pq_subspaces=PQ_SUBSPACES,
+    model_fingerprint=MODEL_FINGERPRINT
+)
+
+# 语料嵌入：train.py --embed-corpus 写入模型工件 corpus/ 目录的嵌入在启动时导入嵌入缓存，部署后不需要重新编码语料图片
+# CLIP_CORPUS_DIR: 语料嵌入目录，默认为 CLIP_MODEL_DIR/corpus（存在时）；嵌入必须由当前模型生成
+# CLIP_CORPUS_ID_PREFIX: 加在语料id（标注中的image_path）前的前缀，拼接后与搜索请求中的图片路径一致
+CORPUS_DIR = os.environ.get('CLIP_CORPUS_DIR') or (os.path.join(MODEL_DIR, 'corpus') if MODEL_DIR else None)
+CORPUS_ID_PREFIX = os.environ.get('CLIP_CORPUS_ID_PREFIX', '')
+if os.environ.get('CLIP_CORPUS_DIR') or (CORPUS_DIR and os.path.exists(os.path.join(CORPUS_DIR, 'meta.json'))):
+    import_corpus(embedding_store, CORPUS_DIR, CORPUS_ID_PREFIX, model_fingerprint=MODEL_FINGERPRINT)
+
+# 准入控制：限制同时执行的搜索数，其余排队，队列满时直接返回429
+# CLIP_MAX_CONCURRENCY: 同时执行的请求数
+# CLIP_MAX_QUEUE: 排队请求总数上限
+# CLIP_MAX_QUEUE_PER_USER: 单个用户排队请求数上限
+admission = AdmissionController(
+    max_concurrency=int(os.environ.get('CLIP_MAX_CONCURRENCY', '2')),
+    max_queue=int(os.environ.get('CLIP_MAX_QUEUE', '32')),
+    max_queue_per_user=int(os.environ.get('CLIP_MAX_QUEUE_PER_USER', '8'))
+)
+
+# 词法预筛选：图片文件名和 product_title 元数据上的倒排索引（BM25），在向量打分前缩小或加权候选集
+# CLIP_LEXICAL_MODE: off / filter（词法信号强时只对命中的候选打分）/ boost（全部打分，按融合分数排序）/ hybrid（两者都做）
+# CLIP_LEXICAL_METADATA: 启动时加载的标注文件（JSON数组或JSONL，含 image_path 和 product_title），多个用逗号分隔
+# CLIP_LEXICAL_IMAGE_ROOT: 标注中相对 image_path 的根目录，拼接后与搜索请求中的图片路径对应（索引按完整路径区分图片）
+# CLIP_LEXICAL_MIN_RATIO: BM25分数不低于最高分该比例的候选才算命中，只含常见词（如"product"）的候选不算
+# CLIP_LEXICAL_MIN_MATCHES: 命中的候选数不少于该值才视为强词法信号并进行筛选，否则仍对全部候选打分
+# CLIP_LEXICAL_MAX_CANDIDATES: 筛选后按BM25分数最多保留的候选数
+# CLIP_LEXICAL_FUSION: linear / rrf；CLIP_LEXICAL_WEIGHT: linear融合中归一化BM25分数的权重
+# 以上设置都可以被请求中的 lexical 参数覆盖，例如 {"mode": "hybrid", "weight": 0.2}
+LEXICAL_MODES = ('off', 'filter', 'boost', 'hybrid')
+LEXICAL_DEFAULTS = {
+    'mode': os.environ.get('CLIP_LEXICAL_MODE', 'off'),
+    'min_ratio': float(os.environ.get('CLIP_LEXICAL_MIN_RATIO', '0.5')),
+    'min_matches': int(os.environ.get('CLIP_LEXICAL_MIN_MATCHES', '20')),
+    'max_candidates': int(os.environ.get('CLIP_LEXICAL_MAX_CANDIDATES', '5000')),
+    'fusion': os.environ.get('CLIP_LEXICAL_FUSION', 'linear'),
+    'weight': float(os.environ.get('CLIP_LEXICAL_WEIGHT', '0.1')),
+}
+lexical_index = LexicalIndex()
+LEXICAL_IMAGE_ROOT = os.environ.get('CLIP_LEXICAL_IMAGE_ROOT', '')
+for metadata_path in filter(None, os.environ.get('CLIP_LEXICAL_METADATA', '').split(',')):
+    count = lexical_index.load_annotations(metadata_path, LEXICAL_IMAGE_ROOT)
+    logger.info(f"加载词法索引元数据 {metadata_path}: {count} 条")
+
+class InvalidRequest(Exception):
+    """请求参数不合法（客户端错误），路由返回400而不是500"""
+
+def _number(value, name, minimum=None):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise InvalidRequest(f"{name} 必须是数字，收到: {value!r}")
+    if minimum is not None and value < minimum:
+        raise InvalidRequest(f"{name} 不能小于 {minimum}，收到: {value!r}")
+    return value
+
+def validate_request(data, default_priority):
+    """在排队和打分之前校验 priority、time_budget_ms 和 metadata，不合法时抛出 InvalidRequest"""
+    priority = data.get('priority', default_priority)
+    if priority not in PRIORITIES:
+        raise InvalidRequest(f"不支持的优先级: {priority}，可选: {', '.join(PRIORITIES)}")
+    if data.get('time_budget_ms') is not None:
+        _number(data['time_budget_ms'], 'time_budget_ms', minimum=0)
+    if data.get('metadata') is not None and not isinstance(data['metadata'], dict):
+        raise InvalidRequest('metadata 必须是 {图片路径: 文本} 对象')
+    return priority
+
+def lexical_options(data):
+    """合并默认设置与请求中的 lexical 参数并校验，不合法时抛出 InvalidRequest"""
+    overrides = data.get('lexical') or {}
+    if not isinstance(overrides, dict):
+        raise InvalidRequest('lexical 必须是对象，例如 {"mode": "hybrid", "weight": 0.2}')
+    options = {**LEXICAL_DEFAULTS, **overrides}
+    if options['mode'] not in LEXICAL_MODES:
+        raise InvalidRequest(f"不支持的词法预筛选模式: {options['mode']}，可选: {', '.join(LEXICAL_MODES)}")
+    if options['fusion'] not in FUSIONS:
+        raise InvalidRequest(f"不支持的融合方式: {options['fusion']}，可选: {', '.join(FUSIONS)}")
+    for name in ('min_ratio', 'weight'):
+        _number(options[name], f'lexical.{name}', minimum=0)
+    for name in ('min_matches', 'max_candidates'):
+        if not isinstance(_number(options[name], f'lexical.{name}', minimum=0), int):
+            raise InvalidRequest(f"lexical.{name} 必须是整数，收到: {options[name]!r}")
+    return options
+
+def invalid_response(e):
+    logger.warning(f"请求参数不合法: {str(e)}")
+    return jsonify({'error': str(e)}), 400
+
+class SearchBudget:
+    """单个搜索请求的时间预算和取消标记，搜索循环在批次之间检查"""
+
+    def __init__(self, time_budget_ms=None):
+        self.deadline = time.monotonic() + time_budget_ms / 1000.0 if time_budget_ms else None
+        self.cancelled = threading.Event()
+
+    def exhausted(self):
+        return self.cancelled.is_set() or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+# 进行中的搜索请求：request_id -> SearchBudget，供 /api/clip/cancel 取消
+active_searches = {}
+active_searches_lock = threading.Lock()
+
+def start_search(data):
+    """根据请求中的 time_budget_ms / request_id 创建预算并登记"""
+    budget = SearchBudget(data.get('time_budget_ms'))
+    request_id = data.get('request_id')
+    if request_id:
+        with active_searches_lock:
+            active_searches[request_id] = budget
+    return budget
+
+def finish_search(data):
+    request_id = (data or {}).get('request_id')
+    if request_id:
+        with active_searches_lock:
+            active_searches.pop(request_id, None)
+
+def request_user(data):
+    """用于公平调度的用户标识：优先用请求中的user_id，其次X-User-Id请求头，最后用客户端地址"""
+    return str(data.get('user_id') or request.headers.get('X-User-Id') or request.remote_addr)
+
+def rejected_response(e):
+    logger.warning(f"请求未被准入: {str(e)}")
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+def lexical_plan(options, data, query, image_paths):
+    """按词法预筛选设置（lexical_options 的结果）处理候选图片，返回 (参与向量打分的图片, 词法打分结果或None)
+
+    请求中的 metadata（{图片路径: product_title}）只用于本次打分，不写入共享的索引。筛选保留候选的原有顺序。
+    """
+    mode = options['mode']
+    if mode == 'off':
+        return image_paths, None
+
+    scores = lexical_index.score(query, image_paths, data.get('metadata'))
+    plan = {
+        'scores': scores,
+        'total': len(image_paths),
+        'fusion': options['fusion'] if mode in ('boost', 'hybrid') else None,
+        'weight': float(options['weight']),
+    }
+    threshold = float(options['min_ratio']) * max(scores.values(), default=0.0)
+    matches = [path for path, score in scores.items() if score >= threshold]
+    if mode in ('filter', 'hybrid') and len(matches) >= options['min_matches']:
+        keep = set(sorted(matches, key=scores.get, reverse=True)[:options['max_candidates']])
+        image_paths = [path for path in image_paths if path in keep]
+        logger.info(f"词法预筛选: {len(matches)}/{plan['total']} 张图片命中查询词，保留 {len(image_paths)} 个候选")
+    plan['candidates'] = len(image_paths)
+    return image_paths, plan
+
+def search_response(results, scored, total, complete=True, top_k=None, lexical=None):
+    """结果仍是按相似度降序的列表；是否因预算耗尽而不完整通过响应头标记，兼容现有调用方
+
+    启用词法融合时按融合分数 fused_score 降序，并附带 lexical_score；score 仍是CLIP相似度。
+    """
+    if lexical is not None:
+        if lexical['fusion']:
+            results = fuse_scores(results, lexical['scores'], lexical['fusion'], lexical['weight'])
+        total = lexical['total']
+    if top_k:
+        results = results[:top_k]
+    response = jsonify(results)
+    response.headers['X-Search-Incomplete'] = 'false' if complete else 'true'
+    response.headers['X-Search-Scored'] = str(scored)
+    response.headers['X-Search-Total'] = str(total)
+    if lexical is not None:
+        response.headers['X-Search-Lexical-Candidates'] = str(lexical['candidates'])
+    return response
+
 @app.route('/api/clip/search', methods=['POST'])
 def search():
+    data = {}
     try:
         data = request.json
         query = data['query']
         image_paths = data['images']  # 图片路径列表
         min_score = data.get('min_score', 0.155)  # 获取最小相似度阈值，默认0.155
         endpoint_name = data.get('endpoint_name')  # 获取端点名称，如果有的话
+        top_k = data.get('top_k')  # 只返回前top_k个结果，默认全部返回
+        priority = validate_request(data, 'interactive')
+        options = lexical_options(data)
+        budget = start_search(data)
         
         logger.info(f"处理 {len(image_paths)} 张图片的CLIP搜索请求，最小相似度阈值: {min_score}")
-        if endpoint_name:
-            logger.info(f"使用微调模型端点: {endpoint_name}")
-            return search_with_endpoint(query, image_paths, min_score, endpoint_name)
-        else:
-            logger.info("使用默认CLIP模型")
-            return search_with_default_model(query, image_paths, min_score)
+        with admission.admit(request_user(data), priority, budget):
+            image_paths, lexical = lexical_plan(options, data, query, image_paths)
+            if endpoint_name:
+                logger.info(f"使用微调模型端点: {endpoint_name}")
+                return search_with_endpoint(query, image_paths, min_score, endpoint_name, budget, top_k, lexical)
+            else:
+                logger.info("使用默认CLIP模型")
+                return search_with_default_model(query, image_paths, min_score, budget, top_k, lexical)
     
+    except InvalidRequest as e:
+        return invalid_response(e)
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"CLIP搜索发生错误: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
+    finally:
+        finish_search(data)
+
+@app.route('/api/clip/cancel', methods=['POST'])
+def cancel_search():
+    """取消进行中的搜索（调用方超时或客户端断开时调用），搜索会在当前批次结束后停止"""
+    request_id = (request.json or {}).get('request_id')
+    with active_searches_lock:
+        budget = active_searches.get(request_id)
+    if budget is None:
+        return jsonify({'cancelled': False})
+    budget.cancelled.set()
+    logger.info(f"搜索请求 {request_id} 已取消")
+    return jsonify({'cancelled': True})
 
-def search_with_default_model(query, image_paths, min_score):
-    # 对文本进行编码
+def encode_query(query):
+    """编码查询文本，返回归一化后的numpy向量"""
     text = clip.tokenize([query]).to(device)
     with torch.no_grad():
         text_features = model.encode_text(text)
         text_features /= text_features.norm(dim=-1, keepdim=True)
+    return text_features[0].float().cpu().numpy()
 
-    results = []
-    batch_size = 10  # 批处理大小
-    
-    # 分批处理图片
-    for i in range(0, len(image_paths), batch_size):
-        batch_paths = image_paths[i:i+batch_size]
-        logger.info(f"处理批次 {i//batch_size + 1}/{(len(image_paths)-1)//batch_size + 1}, {len(batch_paths)} 张图片")
-        
-        batch_images = []
-        valid_paths = []
-        
-        # 预处理批次中的图片
-        for img_path in batch_paths:
-            try:
-                img = preprocess(Image.open(img_path)).unsqueeze(0).to(device)
-                batch_images.append(img)
-                valid_paths.append(img_path)
-            except Exception as e:
-                logger.error(f"处理图片 {img_path} 时出错: {str(e)}")
+def encode_missing_images(image_paths, budget=None, batch_size=IMAGE_BATCH_SIZE, signatures=None):
+    """把嵌入缓存中还没有或文件已变化的图片分批编码并加入缓存；超出时间预算或被取消时提前停止
+
+    signatures 为 image_paths 当前的文件签名（file_signatures），不给出时在这里获取。
+    """
+    if signatures is None:
+        signatures = file_signatures(image_paths)
+    missing = embedding_store.missing(image_paths, signatures)
+    if not missing:
+        return True
+    signature_of = dict(zip(image_paths, signatures))
+
+    with image_preprocessor() as preprocessor:
+        # 分批处理图片
+        for i in range(0, len(missing), batch_size):
+            if budget is not None and budget.exhausted():
+                logger.warning(f"搜索超出时间预算或已取消，跳过剩余 {len(missing) - i} 张未编码的图片")
+                return False
+            batch_paths = missing[i:i+batch_size]
+            logger.info(f"编码批次 {i//batch_size + 1}/{(len(missing)-1)//batch_size + 1}, {len(batch_paths)} 张图片")
+
+            # 预处理批次中的图片，无法读取的图片已在预处理时记录并跳过
+            batch_tensor, ok = preprocessor(batch_paths)
+            valid_paths = [img_path for img_path, good in zip(batch_paths, ok) if good]
+            if not valid_paths:
                 continue
-        
-        if not batch_images:
-            continue
-            
-        # 连接批次中的所有图片张量
-        batch_tensor = torch.cat(batch_images)
-        
-        # 对图片批次进行编码
-        with torch.no_grad():
-            image_features = model.encode_image(batch_tensor)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+            if len(valid_paths) < len(batch_paths):
+                batch_tensor = batch_tensor[torch.tensor(ok)]
 
-        # 手动计算余弦相似度（范围在 -1 到 1 之间）
-        similarities = text_features @ image_features.T
-        
-        # 存储结果
-        for idx, (path, similarity) in enumerate(zip(valid_paths, similarities.squeeze())):
-            similarity_value = float(similarity)
-            # 只添加相似度大于等于阈值的结果
-            if similarity_value >= min_score:
-                results.append({
-                    'path': path,
-                    'score': similarity_value
-                })
-            
-        # 释放内存
-        del batch_images, batch_tensor, image_features
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+            # 对图片批次进行编码
+            with torch.no_grad():
+                image_features = model.encode_image(batch_tensor.to(device))
+                image_features /= image_features.norm(dim=-1, keepdim=True)
+
+            embedding_store.add(valid_paths, image_features.float().cpu().numpy(),
+                                [signature_of[img_path] for img_path in valid_paths])
+
+            # 释放内存
+            del batch_tensor, image_features
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    return True
+
+def score_with_default_model(query, image_paths, min_score, budget=None):
+    """用默认模型对图片打分，返回 (相似度不低于阈值的结果(按相似度降序), 实际打分的图片数, 是否完整)
+
+    预算耗尽时只对已缓存和已编码的图片打分，即当前能给出的最好的部分结果。
+    """
+    text_features = encode_query(query)
+    signatures = file_signatures(image_paths)
+    complete = encode_missing_images(image_paths, budget, signatures=signatures)
+
+    # 手动计算余弦相似度（范围在 -1 到 1 之间）；文件已变化但还没来得及重新编码的图片不参与打分
+    found_paths, similarities = embedding_store.score(text_features, image_paths, rerank=RERANK_CANDIDATES,
+                                                      signatures=signatures)
+
+    # 只添加相似度大于等于阈值的结果
+    results = [
+        {'path': path, 'score': float(similarity)}
+        for path, similarity in zip(found_paths, similarities)
+        if similarity >= min_score
+    ]
 
     # 按相似度排序
     results.sort(key=lambda x: x['score'], reverse=True)
-    
-    logger.info(f"CLIP搜索完成，找到 {len(results)} 个相似度 >= {min_score} 的结果")
-    return jsonify(results)
+    return results, len(found_paths), complete
+
+def search_with_default_model(query, image_paths, min_score, budget=None, top_k=None, lexical=None):
+    results, scored, complete = score_with_default_model(query, image_paths, min_score, budget)
+    logger.info(f"CLIP搜索完成，对 {scored}/{len(image_paths)} 张图片打分，找到 {len(results)} 个相似度 >= {min_score} 的结果")
+    return search_response(results, scored, len(image_paths), complete, top_k, lexical)
 
-def search_with_endpoint(query, image_paths, min_score, endpoint_name):
+def search_with_endpoint(query, image_paths, min_score, endpoint_name, budget=None, top_k=None, lexical=None):
     results = []
     batch_size = 10  # 批处理大小
+    scored = 0
+    complete = True
     
     # 分批处理图片
     for i in range(0, len(image_paths), batch_size):
+        if budget is not None and budget.exhausted():
+            logger.warning(f"端点搜索超出时间预算或已取消，跳过剩余 {len(image_paths) - i} 张图片")
+            complete = False
+            break
         batch_paths = image_paths[i:i+batch_size]
         logger.info(f"使用端点处理批次 {i//batch_size + 1}/{(len(image_paths)-1)//batch_size + 1}, {len(batch_paths)} 张图片")
         
@@ -158,11 +434,14 @@ def search_with_endpoint(query, image_paths, min_score, endpoint_name):
         
         # 为每张图片调用端点
         for idx, (img_data, img_path) in enumerate(zip(batch_images, valid_paths)):
+            if budget is not None and budget.exhausted():
+                complete = False
+                break
             try:
                 # 准备请求数据
                 payload = {
                     'text': query,
-                    'image': img_data.hex()  # 将二进制数据转换为十六进制字符串
+                    'image': base64.b64encode(img_data).decode('ascii')  # 与推理代码input_fn的base64解码一致
                 }
                 
                 # 调用SageMaker端点
@@ -175,6 +454,7 @@ def search_with_endpoint(query, image_paths, min_score, endpoint_name):
                 # 解析响应
                 response_body = json.loads(response['Body'].read())
                 similarity_value = float(response_body['similarity'])
+                scored += 1
                 
                 # 只添加相似度大于等于阈值的结果
                 if similarity_value >= min_score:
@@ -190,72 +470,106 @@ def search_with_endpoint(query, image_paths, min_score, endpoint_name):
     # 按相似度排序
     results.sort(key=lambda x: x['score'], reverse=True)
     
-    logger.info(f"通过端点 {endpoint_name} 的CLIP搜索完成，找到 {len(results)} 个相似度 >= {min_score} 的结果")
-    return jsonify(results)
+    logger.info(f"通过端点 {endpoint_name} 的CLIP搜索完成，对 {scored}/{len(image_paths)} 张图片打分，找到 {len(results)} 个相似度 >= {min_score} 的结果")
+    return search_response(results, scored, len(image_paths), complete, top_k, lexical)
 
 @app.route('/api/clip/secondary_search', methods=['POST'])
 def secondary_search():
+    data = {}
     try:
         data = request.json
         query = data['query']
         primary_results = data['primary_results']  # 第一次搜索的结果
         min_score = data.get('min_score', 0.155)  # 获取最小相似度阈值，默认0.155
         endpoint_name = data.get('endpoint_name')  # 获取端点名称，如果有的话
+        top_k = data.get('top_k')
+        priority = validate_request(data, 'interactive')
+        budget = start_search(data)
         
         logger.info(f"处理二次搜索请求，基于 {len(primary_results)} 张图片，最小相似度阈值: {min_score}")
-        if endpoint_name:
-            logger.info(f"使用微调模型端点: {endpoint_name}")
-            # 从primary_results中提取路径
-            image_paths = [result['path'] for result in primary_results]
-            return search_with_endpoint(query, image_paths, min_score, endpoint_name)
-        else:
-            logger.info("使用默认CLIP模型")
-            return secondary_search_with_default_model(query, primary_results, min_score)
+        with admission.admit(request_user(data), priority, budget):
+            if endpoint_name:
+                logger.info(f"使用微调模型端点: {endpoint_name}")
+                # 从primary_results中提取路径
+                image_paths = [result['path'] for result in primary_results]
+                return search_with_endpoint(query, image_paths, min_score, endpoint_name, budget, top_k)
+            else:
+                logger.info("使用默认CLIP模型")
+                return secondary_search_with_default_model(query, primary_results, min_score, budget, top_k)
     
+    except InvalidRequest as e:
+        return invalid_response(e)
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"二次搜索发生错误: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
+    finally:
+        finish_search(data)
 
-def secondary_search_with_default_model(query, primary_results, min_score):
-    # 对文本进行编码
-    text = clip.tokenize([query]).to(device)
-    with torch.no_grad():
-        text_features = model.encode_text(text)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
+def secondary_search_with_default_model(query, primary_results, min_score, budget=None, top_k=None):
+    image_paths = [img_data['path'] for img_data in primary_results]
+    results, scored, complete = score_with_default_model(query, image_paths, min_score, budget)
+    logger.info(f"二次搜索完成，对 {scored}/{len(image_paths)} 张图片打分，找到 {len(results)} 个相似度 >= {min_score} 的结果")
+    return search_response(results, scored, len(image_paths), complete, top_k)
 
-    results = []
-    # 处理每张图片
-    for img_data in primary_results:
-        try:
-            img_path = img_data['path']
-            # 读取并预处理图片
-            image = preprocess(Image.open(img_path)).unsqueeze(0).to(device)
-            
-            # 对图片进行编码
-            with torch.no_grad():
-                image_features = model.encode_image(image)
-                image_features /= image_features.norm(dim=-1, keepdim=True)
+@app.route('/api/clip/index', methods=['POST'])
+def index_images():
+    """预先编码图片并加入嵌入缓存（例如上传后），默认以最低的indexing优先级排队"""
+    data = {}
+    try:
+        data = request.json
+        image_paths = data['images']
+        priority = validate_request(data, 'indexing')
+        budget = start_search(data)
+        with admission.admit(request_user(data), priority, budget):
+            # 随图片一起提交的 product_title 等元数据在准入后才并入词法索引，被拒绝的请求不改变共享索引
+            if data.get('metadata'):
+                lexical_index.add_many(data['metadata'].items())
+            complete = encode_missing_images(image_paths, budget)
+        return jsonify({'indexed': len(embedding_store), 'complete': complete})
 
-            # 手动计算余弦相似度
-            similarity = (text_features @ image_features.T).item()
-            
-            # 只添加相似度大于等于阈值的结果
-            if similarity >= min_score:
-                results.append({
-                    'path': img_path,
-                    'score': float(similarity)
-                })
-        except Exception as e:
-            logger.error(f"二次搜索处理图片 {img_path} 时出错: {str(e)}")
-            continue
+    except InvalidRequest as e:
+        return invalid_response(e)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except Exception as e:
+        logger.error(f"建立索引错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        finish_search(data)
 
-    # 按相似度排序
-    results.sort(key=lambda x: x['score'], reverse=True)
-    
-    logger.info(f"二次搜索完成，找到 {len(results)} 个相似度 >= {min_score} 的结果")
-    return jsonify(results)
+@app.route('/api/clip/metrics', methods=['GET'])
+def get_metrics():
+    """准入队列的状态与排队等待时间分布"""
+    return jsonify({'admission': admission.metrics()})
+
+@app.route('/api/clip/index/stats', methods=['GET'])
+def get_index_stats():
+    """嵌入缓存的内存占用；带 recall_k 参数时额外对比各编码的召回损失"""
+    try:
+        stats = embedding_store.memory_footprint()
+        stats['lexical'] = lexical_index.stats()
+        recall_k = request.args.get('recall_k', type=int)
+        if recall_k and len(embedding_store) > 0:
+            # 从缓存中取样作为底库，再取其中一部分加轻微扰动作为查询
+            sample = embedding_store.sample_vectors(request.args.get('sample', 20000, type=int))
+            num_queries = min(request.args.get('queries', 100, type=int), len(sample))
+            queries = sample[np.random.default_rng(0).choice(len(sample), num_queries, replace=False)]
+            queries = queries + np.random.default_rng(1).normal(0, 0.01, queries.shape).astype(np.float32)
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+            stats['codecs'] = evaluate_codecs(
+                sample, queries, k=recall_k,
+                pq_subspaces=PQ_SUBSPACES,
+                rerank=RERANK_CANDIDATES or 100
+            )
+        return jsonify(stats)
+
+    except Exception as e:
+        logger.error(f"获取索引统计错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/clip/models', methods=['GET'])
 def get_available_models():
@@ -307,7 +621,7 @@ def test_endpoint():
         # 准备请求数据
         payload = {
             'text': test_text,
-            'image': img_data.hex()
+            'image': base64.b64encode(img_data).decode('ascii')
         }
         
         # 调用SageMaker端点
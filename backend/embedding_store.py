@@ -0,0 +1,662 @@
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 分块打分时每块的行数，避免一次性把整个压缩矩阵解码成fp32
+SCORE_BLOCK_ROWS = 65536
+
+# 未进入排序哈希索引的尾部id超过该行数时重建索引
+ID_INDEX_COMPACT_ROWS = 65536
+
+# 存储的数据文件；模型指纹变化时全部删除重建（meta.json 和锁文件除外）
+STORE_FILES = ('codes.f32', 'codes.f16', 'codes.i8', 'scales.f32', 'codes.u8', 'pending.f32', 'centroids.npy',
+               'raw.f32', 'sigs.i64', 'ids.bin', 'ids.off', 'ids.idx', 'corpus.json')
+
+
+def file_signatures(paths):
+    """各文件的 (大小, 修改时间ns)，用于发现同一路径下被替换的图片；无法stat的文件记为未知 (-1, -1)"""
+    signatures = np.full((len(paths), 2), -1, dtype=np.int64)
+    for i, path in enumerate(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signatures[i] = (st.st_size, st.st_mtime_ns)
+    return signatures
+
+
+class MappedArray:
+    """磁盘上按行追加的定长数组，读取时以np.memmap只读映射，多个进程共享同一份页缓存"""
+
+    def __init__(self, path, row_shape, dtype):
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = int(np.prod(self.row_shape, dtype=np.int64)) * self.dtype.itemsize
+        self._map = None
+
+    def write_at(self, row, block):
+        """从第row行开始写入；先截断到row行，丢弃上次进程中断时留下的未提交数据"""
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        with open(self.path, 'ab') as f:
+            f.truncate(row * self.row_bytes)
+            f.write(block.tobytes())
+
+    def view(self, rows):
+        """映射前rows行；文件变长后重新映射，旧映射由numpy在引用释放后回收"""
+        if rows == 0:
+            return np.zeros((0,) + self.row_shape, dtype=self.dtype)
+        if self._map is None or len(self._map) != rows:
+            self._map = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(rows,) + self.row_shape)
+        return self._map
+
+    def nbytes(self, rows):
+        return rows * self.row_bytes
+
+    def remove(self):
+        self._map = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _blockwise_score(rows, score_block):
+    """对行索引分块打分，控制临时fp32矩阵的内存"""
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+        block = rows[start:start + SCORE_BLOCK_ROWS]
+        scores[start:start + len(block)] = score_block(block)
+    return scores
+
+
+class Fp32Codec:
+    """不压缩的fp32存储，作为精度基准"""
+    name = 'fp32'
+    suffix = 'f32'
+    dtype = np.float32
+
+    def __init__(self, dim, directory):
+        self.dim = dim
+        self.codes = MappedArray(os.path.join(directory, f'codes.{self.suffix}'), (dim,), self.dtype)
+        self.count = 0
+
+    def sync(self, count):
+        self.count = count
+
+    def add(self, row, vectors):
+        self.codes.write_at(row, vectors)
+
+    def score(self, query, rows):
+        codes = self.codes.view(self.count)
+        return _blockwise_score(rows, lambda block: codes[block].astype(np.float32, copy=False) @ query)
+
+    def decode(self, rows):
+        return self.codes.view(self.count)[rows].astype(np.float32)
+
+    def nbytes(self):
+        return self.codes.nbytes(self.count)
+
+    def codebook_nbytes(self):
+        return 0
+
+
+class Fp16Codec(Fp32Codec):
+    """半精度存储，内存减半，精度损失通常可忽略"""
+    name = 'fp16'
+    suffix = 'f16'
+    dtype = np.float16
+
+
+class Int8Codec:
+    """逐向量对称int8量化：每个向量一个fp32缩放系数"""
+    name = 'int8'
+
+    def __init__(self, dim, directory):
+        self.dim = dim
+        self.codes = MappedArray(os.path.join(directory, 'codes.i8'), (dim,), np.int8)
+        self.scales = MappedArray(os.path.join(directory, 'scales.f32'), (), np.float32)
+        self.count = 0
+
+    def sync(self, count):
+        self.count = count
+
+    def add(self, row, vectors):
+        vectors = vectors.astype(np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        self.codes.write_at(row, codes)
+        self.scales.write_at(row, scales)
+
+    def score(self, query, rows):
+        codes, scales = self.codes.view(self.count), self.scales.view(self.count)
+        return _blockwise_score(
+            rows, lambda block: (codes[block].astype(np.float32) @ query) * scales[block])
+
+    def decode(self, rows):
+        codes, scales = self.codes.view(self.count), self.scales.view(self.count)
+        return codes[rows].astype(np.float32) * scales[rows][:, None]
+
+    def nbytes(self):
+        return self.codes.nbytes(self.count) + self.scales.nbytes(self.count)
+
+    def codebook_nbytes(self):
+        return 0
+
+
+def _kmeans(x, k, n_iter=20, seed=0):
+    """简单的Lloyd k-means，用于训练PQ码本"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    x_sq = (x ** 2).sum(axis=1, keepdims=True)
+    for _ in range(n_iter):
+        dist = x_sq - 2 * x @ centroids.T + (centroids ** 2).sum(axis=1)
+        assign = dist.argmin(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        # 空簇重新随机取样，避免码字浪费
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids
+
+
+class PQCodec:
+    """乘积量化：向量切成m个子空间，每个子空间用1字节码字表示，查询时用非对称距离(ADC)打分
+
+    码本需要训练数据：在累计到train_size个向量之前先以fp32暂存(pending.f32)，
+    达到后统一训练、编码，并写出centroids.npy；其他进程看到码本文件后自动切换到PQ码。
+    """
+    name = 'pq'
+
+    def __init__(self, dim, directory, subspaces=None, ksub=256, train_size=4096):
+        subspaces = subspaces or max(1, dim // 8)
+        if dim % subspaces != 0:
+            raise ValueError(f"向量维度 {dim} 不能被PQ子空间数 {subspaces} 整除")
+        self.dim = dim
+        self.m = subspaces
+        self.dsub = dim // subspaces
+        self.ksub = ksub
+        self.train_size = train_size
+        self.centroids = None  # (m, ksub, dsub)
+        self.centroids_path = os.path.join(directory, 'centroids.npy')
+        self.codes = MappedArray(os.path.join(directory, 'codes.u8'), (subspaces,), np.uint8)
+        self.pending = MappedArray(os.path.join(directory, 'pending.f32'), (dim,), np.float32)
+        self.count = 0
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def sync(self, count):
+        self.count = count
+        if self.centroids is None and os.path.exists(self.centroids_path):
+            self.centroids = np.load(self.centroids_path)
+
+    def train(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        ksub = min(self.ksub, len(vectors))
+        sub = vectors.reshape(len(vectors), self.m, self.dsub)
+        self.centroids = np.stack([_kmeans(sub[:, j], ksub, seed=j) for j in range(self.m)])
+        logger.info(f"PQ码本训练完成: {self.m} 个子空间 x {ksub} 个码字, 训练样本 {len(vectors)}")
+
+    def _encode(self, vectors):
+        sub = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.m, self.dsub)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            c = self.centroids[j]
+            dist = (c ** 2).sum(axis=1) - 2 * sub[:, j] @ c.T
+            codes[:, j] = dist.argmin(axis=1)
+        return codes
+
+    def add(self, row, vectors):
+        if self.trained:
+            self.codes.write_at(row, self._encode(vectors))
+            return
+        self.pending.write_at(row, vectors)
+        total = row + len(vectors)
+        if total < self.train_size:
+            return
+        pending = self.pending.view(total)
+        self.train(pending)
+        for start in range(0, total, SCORE_BLOCK_ROWS):
+            self.codes.write_at(start, self._encode(pending[start:start + SCORE_BLOCK_ROWS]))
+        # 码本最后落盘（先写临时文件再原子替换），其他进程看到它时PQ码已完整
+        tmp_path = self.centroids_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.centroids)
+        os.replace(tmp_path, self.centroids_path)
+        self.pending.remove()
+
+    def score(self, query, rows):
+        if not self.trained:
+            pending = self.pending.view(self.count)
+            return _blockwise_score(rows, lambda block: pending[block] @ query)
+        # ADC查表：table[j, c] = 查询第j段与第j个子空间码字c的内积
+        table = np.einsum('md,mkd->mk', query.reshape(self.m, self.dsub), self.centroids)
+        codes = self.codes.view(self.count)
+        sub_idx = np.arange(self.m)
+        return _blockwise_score(rows, lambda block: table[sub_idx, codes[block]].sum(axis=1))
+
+    def decode(self, rows):
+        if not self.trained:
+            return np.asarray(self.pending.view(self.count)[rows])
+        codes = self.codes.view(self.count)[rows]
+        return self.centroids[np.arange(self.m), codes].reshape(len(rows), self.dim)
+
+    def nbytes(self):
+        if not self.trained:
+            return self.pending.nbytes(self.count)
+        return self.codes.nbytes(self.count) + self.codebook_nbytes()
+
+    def codebook_nbytes(self):
+        return self.centroids.nbytes if self.trained else 0
+
+
+CODECS = {
+    'fp32': Fp32Codec,
+    'fp16': Fp16Codec,
+    'int8': Int8Codec,
+    'pq': PQCodec,
+}
+
+
+def make_codec(name, dim, directory, pq_subspaces=None, pq_train_size=4096):
+    if name not in CODECS:
+        raise ValueError(f"不支持的嵌入编码: {name}，可选: {', '.join(CODECS)}")
+    if name == 'pq':
+        return PQCodec(dim, directory, subspaces=pq_subspaces, train_size=pq_train_size)
+    return CODECS[name](dim, directory)
+
+
+def _hash_id(image_id):
+    return int.from_bytes(hashlib.blake2b(image_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class IdMap:
+    """磁盘上的 id <-> 行号 映射
+
+    ids.bin 顺序保存各id的utf-8字节，ids.off 保存每行的结束偏移(int64，其长度即已提交行数)；
+    ids.idx 是按64位哈希排序的 (hash, row) 数组，mmap后直接二分查找，启动时无需读入全部id。
+    尚未进入排序索引的尾部行放在内存dict中，超过阈值时合并重建索引。
+    """
+    INDEX_DTYPE = np.dtype([('hash', '<u8'), ('row', '<i8')])
+
+    def __init__(self, directory):
+        self.data = MappedArray(os.path.join(directory, 'ids.bin'), (), np.uint8)
+        self.offsets = MappedArray(os.path.join(directory, 'ids.off'), (), np.int64)
+        self.index_path = os.path.join(directory, 'ids.idx')
+        self.index = np.zeros(0, dtype=self.INDEX_DTYPE)
+        self.index_stat = None
+        self.tail = {}
+        self.count = 0
+
+    def sync(self):
+        """同步其他进程追加的行和重建的索引，只涉及stat和重新映射"""
+        count = os.path.getsize(self.offsets.path) // 8 if os.path.exists(self.offsets.path) else 0
+        start = self.count
+        if os.path.exists(self.index_path):
+            st = os.stat(self.index_path)
+            if (st.st_ino, st.st_mtime_ns) != self.index_stat:
+                self.index = np.load(self.index_path, mmap_mode='r')
+                self.index_stat = (st.st_ino, st.st_mtime_ns)
+                self.tail = {}
+                start = len(self.index)
+        self.count = count
+        if start < count:
+            for row in range(start, count):
+                self.tail[self.id_at(row)] = row
+
+    def id_at(self, row):
+        offsets = self.offsets.view(self.count)
+        start = int(offsets[row - 1]) if row else 0
+        data = self.data.view(int(offsets[self.count - 1]))
+        return bytes(data[start:int(offsets[row])]).decode('utf-8')
+
+    def lookup(self, image_ids):
+        """批量查行号，不存在的返回-1；同一id重新写入过（图片被替换）时返回最新的一行"""
+        rows = np.full(len(image_ids), -1, dtype=np.int64)
+        if len(self.index):
+            hashes = np.fromiter((_hash_id(i) for i in image_ids), dtype=np.uint64, count=len(image_ids))
+            pos = np.searchsorted(self.index['hash'], hashes)
+            pos_clipped = np.minimum(pos, len(self.index) - 1)
+            for i in np.flatnonzero(self.index['hash'][pos_clipped] == hashes):
+                # 64位哈希极少碰撞，但仍需核对原始id
+                p = pos_clipped[i]
+                while p < len(self.index) and self.index['hash'][p] == hashes[i]:
+                    row = int(self.index['row'][p])
+                    if row > rows[i] and self.id_at(row) == image_ids[i]:
+                        rows[i] = row
+                    p += 1
+        # 尾部的行都比索引中的新
+        for i, image_id in enumerate(image_ids):
+            rows[i] = self.tail.get(image_id, rows[i])
+        return rows
+
+    def append(self, new_ids):
+        """追加id；偏移文件最后写入，相当于提交这批行"""
+        encoded = [image_id.encode('utf-8') for image_id in new_ids]
+        offsets = self.offsets.view(self.count)
+        base = int(offsets[-1]) if self.count else 0
+        self.data.write_at(base, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        new_offsets = base + np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        self.offsets.write_at(self.count, new_offsets)
+        for image_id in new_ids:
+            self.tail[image_id] = self.count
+            self.count += 1
+        if len(self.tail) >= ID_INDEX_COMPACT_ROWS:
+            self.compact()
+
+    def compact(self):
+        """把尾部id合并进排序哈希索引（写临时文件后原子替换）"""
+        tail = np.zeros(len(self.tail), dtype=self.INDEX_DTYPE)
+        tail['hash'] = np.fromiter((_hash_id(i) for i in self.tail), dtype=np.uint64, count=len(self.tail))
+        tail['row'] = np.fromiter(self.tail.values(), dtype=np.int64, count=len(self.tail))
+        merged = np.concatenate([np.asarray(self.index), tail])
+        merged = merged[np.argsort(merged['hash'], kind='stable')]
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, merged)
+        os.replace(tmp_path, self.index_path)
+        self.sync()
+        logger.info(f"id索引已重建: {len(merged)} 行")
+
+    def nbytes(self):
+        data_bytes = int(self.offsets.view(self.count)[-1]) if self.count else 0
+        return data_bytes + self.offsets.nbytes(self.count) + self.index.nbytes
+
+
+class EmbeddingStore:
+    """图像嵌入存储：图片路径 -> (压缩后的)归一化向量
+
+    所有数据以追加式文件保存在directory中并通过mmap只读映射：启动时只需打开文件，
+    与库的大小无关；多个worker进程映射同一组文件，共享页缓存而不是各自持有一份。
+    写入通过文件锁串行化，其他进程在下次查询时自动看到新追加的行。
+    keep_raw 为真时额外保存一份fp32全精度副本(raw.f32)，用于对压缩打分的候选做精确重排序。
+
+    model_fingerprint 标识生成嵌入的模型，与已有存储记录的不同时清空重建，换模型后不会沿用旧模型的嵌入。
+    每行另存图片的 (大小, 修改时间)(sigs.i64)：查询时传入当前的文件签名，签名不一致的行视为不存在，
+    重新编码后追加新行，同一id以最新的行为准。
+    """
+
+    def __init__(self, directory, dim, codec='fp32', keep_raw=False, pq_subspaces=None, pq_train_size=4096,
+                 model_fingerprint=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dim = dim
+        self.model_fingerprint = model_fingerprint
+        self.lock_path = os.path.join(directory, 'store.lock')
+        self._check_meta(codec, keep_raw, pq_subspaces)
+        self.codec = make_codec(codec, dim, directory, pq_subspaces, pq_train_size)
+        self._raw = None
+        if keep_raw and codec != 'fp32':
+            self._raw = MappedArray(os.path.join(directory, 'raw.f32'), (dim,), np.float32)
+        self.signatures = MappedArray(os.path.join(directory, 'sigs.i64'), (2,), np.int64)
+        self.ids = IdMap(directory)
+        self.lock = threading.Lock()
+        self.count = 0
+        with self.lock:
+            self._sync()
+        logger.info(f"嵌入存储已映射: {directory}, {self.count} 行 (编码: {codec})")
+
+    def _check_meta(self, codec, keep_raw, pq_subspaces):
+        """核对存储配置；只有模型指纹不同时（包括没有记录指纹的旧存储）清空数据文件重建"""
+        meta_path = os.path.join(self.directory, 'meta.json')
+        meta = {'dim': self.dim, 'codec': codec, 'keep_raw': bool(keep_raw), 'pq_subspaces': pq_subspaces,
+                'model_fingerprint': self.model_fingerprint}
+        with self._file_lock():
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    existing = json.load(f)
+                if existing == meta:
+                    return
+                config = {key: value for key, value in existing.items() if key != 'model_fingerprint'}
+                if config != {key: value for key, value in meta.items() if key != 'model_fingerprint'}:
+                    raise ValueError(f"嵌入存储 {self.directory} 的配置 {existing} 与当前配置 {meta} 不一致，"
+                                     f"请更换目录或删除后重建")
+                logger.warning(f"嵌入存储 {self.directory} 由模型 {existing.get('model_fingerprint')} 生成，"
+                               f"与当前模型 {self.model_fingerprint} 不同，清空后重新编码")
+                for name in STORE_FILES:
+                    path = os.path.join(self.directory, name)
+                    if os.path.exists(path):
+                        os.remove(path)
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + '.tmp', meta_path)
+
+    @contextmanager
+    def _file_lock(self):
+        """跨进程写锁"""
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sync(self):
+        self.ids.sync()
+        self.count = self.ids.count
+        self.codec.sync(self.count)
+
+    def __len__(self):
+        return self.count
+
+    def _lookup(self, image_ids, signatures=None):
+        """id -> 行号；给出当前文件签名时，记录的签名与之不同的行（图片已被替换）视为不存在
+
+        任一方的签名未知（-1）时不核对。
+        """
+        rows = self.ids.lookup(image_ids)
+        if signatures is None:
+            return rows
+        hit = np.flatnonzero(rows >= 0)
+        stored = self.signatures.view(self.count)[rows[hit]]
+        current = np.asarray(signatures, dtype=np.int64).reshape(-1, 2)[hit]
+        stale = (stored[:, 0] >= 0) & (current[:, 0] >= 0) & (stored != current).any(axis=1)
+        rows[hit[stale]] = -1
+        return rows
+
+    def missing(self, image_ids, signatures=None):
+        """返回尚未入库、或入库后文件已变化的id（保持顺序、去重）；signatures 与 image_ids 一一对应"""
+        first = {}
+        for i, image_id in enumerate(image_ids):
+            first.setdefault(image_id, i)
+        if signatures is not None:
+            signatures = np.asarray(signatures, dtype=np.int64).reshape(-1, 2)[list(first.values())]
+        image_ids = list(first)
+        with self.lock:
+            self._sync()
+            rows = self._lookup(image_ids, signatures)
+        return [image_id for image_id, row in zip(image_ids, rows) if row < 0]
+
+    def add(self, image_ids, vectors, signatures=None):
+        """追加一批向量；已存在且文件未变化的id会被忽略
+
+        signatures 为编码时各图片的文件签名（见 file_signatures），不给出时记为未知，以后不再核对。
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if signatures is None:
+            signatures = np.full((len(image_ids), 2), -1, dtype=np.int64)
+        signatures = np.asarray(signatures, dtype=np.int64).reshape(-1, 2)
+        with self.lock, self._file_lock():
+            self._sync()
+            rows = self._lookup(image_ids, signatures)
+            keep = []
+            seen = set()
+            for i, (image_id, row) in enumerate(zip(image_ids, rows)):
+                if row < 0 and image_id not in seen:
+                    keep.append(i)
+                    seen.add(image_id)
+            if not keep:
+                return
+            # 先写向量，最后写id偏移：中途中断时未提交的数据会在下次写入时被截断
+            self.codec.add(self.count, vectors[keep])
+            if self._raw is not None:
+                self._raw.write_at(self.count, vectors[keep])
+            self.signatures.write_at(self.count, signatures[keep])
+            self.ids.append([image_ids[i] for i in keep])
+            self._sync()
+
+    def score(self, query, image_ids, rerank=0, signatures=None):
+        """对给定id计算与查询向量的相似度，返回 (命中的id列表, 分数数组)
+
+        直接在mmap视图上计算；行号先排序再访问，让页缓存顺序预读。
+        rerank>0 且存在全精度副本时，取压缩分数最高的rerank个候选用fp32精确重算。
+        给出 signatures 时文件已变化、尚未重新编码的图片不参与打分，不返回旧图片的分数。
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        with self.lock:
+            self._sync()
+            rows = self._lookup(image_ids, signatures)
+            hit = rows >= 0
+            found = [image_id for image_id, ok in zip(image_ids, hit) if ok]
+            rows = rows[hit]
+            order = np.argsort(rows, kind='stable')
+            scores = np.empty(len(rows), dtype=np.float32)
+            scores[order] = self.codec.score(query, rows[order])
+            if rerank and self._raw is not None and len(rows):
+                top = np.argsort(-scores)[:rerank]
+                top = top[np.argsort(rows[top])]
+                scores[top] = np.asarray(self._raw.view(self.count)[rows[top]]) @ query
+        return found, scores
+
+    def memory_footprint(self):
+        """各部分映射文件的大小，与同等规模fp32对比"""
+        with self.lock:
+            self._sync()
+            count = self.count
+            code_bytes = self.codec.nbytes()
+            fp32_bytes = count * self.dim * 4
+            return {
+                'codec': self.codec.name,
+                'count': count,
+                'dim': self.dim,
+                'code_bytes': code_bytes,
+                'codebook_bytes': self.codec.codebook_nbytes(),
+                'id_bytes': self.ids.nbytes(),
+                'signature_bytes': self.signatures.nbytes(count),
+                'fp32_bytes': fp32_bytes,
+                'compression': round(fp32_bytes / code_bytes, 2) if code_bytes else None,
+                'raw_bytes': self._raw.nbytes(count) if self._raw is not None else 0,
+                'directory': self.directory,
+            }
+
+    def sample_vectors(self, limit, seed=0):
+        """取样若干全精度向量(无全精度副本时用当前编码解码)，用于编码对比评估"""
+        with self.lock:
+            self._sync()
+            count = self.count
+            rows = np.sort(np.random.default_rng(seed).choice(count, min(limit, count), replace=False))
+            if self._raw is not None:
+                return np.asarray(self._raw.view(count)[rows])
+            return self.codec.decode(rows)
+
+
+def load_corpus(corpus_dir):
+    """读取训练产物中的语料嵌入（train.py --embed-corpus 生成的 corpus/ 目录）
+
+    返回 (ids, vectors, meta)，vectors 为 (N, dim) 的只读fp16 memmap。
+    """
+    with open(os.path.join(corpus_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    with open(os.path.join(corpus_dir, 'ids.txt'), 'r', encoding='utf-8') as f:
+        ids = f.read().splitlines()
+    if len(ids) != meta['count']:
+        raise ValueError(f"语料 {corpus_dir} 的id数 {len(ids)} 与记录的行数 {meta['count']} 不一致")
+    if not ids:
+        return ids, np.zeros((0, meta['dim']), dtype=meta['dtype']), meta
+    vectors = np.memmap(os.path.join(corpus_dir, 'embeddings.f16'), dtype=meta['dtype'], mode='r',
+                        shape=(meta['count'], meta['dim']))
+    return ids, vectors, meta
+
+
+def import_corpus(store, corpus_dir, id_prefix='', model_fingerprint=None, batch_size=SCORE_BLOCK_ROWS):
+    """把语料嵌入批量导入EmbeddingStore，部署时不需要重新编码图片；已存在的id会被忽略
+
+    id_prefix 加在语料id前，映射为服务端的图片路径；语料记录的模型指纹与 model_fingerprint
+    （默认为存储的模型指纹）核对，不一致说明嵌入不是由当前部署的模型生成的。
+    服务端已有的图片记下当前的文件签名，之后被替换时会重新编码。
+    导入完成后在存储的 corpus.json 中登记，同一语料（指纹、行数、id_prefix相同）再次导入时直接跳过，
+    服务重启或多个worker启动时不重复导入。返回语料的行数。
+    """
+    model_fingerprint = model_fingerprint or store.model_fingerprint
+    ids, vectors, meta = load_corpus(corpus_dir)
+    if meta['dim'] != store.dim:
+        raise ValueError(f"语料嵌入维度 {meta['dim']} 与嵌入存储维度 {store.dim} 不一致")
+    if model_fingerprint and meta.get('model_fingerprint') != model_fingerprint:
+        raise ValueError(f"语料嵌入的模型指纹 {meta.get('model_fingerprint')} 与当前模型 {model_fingerprint} 不一致")
+    record = {'model_fingerprint': meta.get('model_fingerprint'), 'count': meta['count'], 'id_prefix': id_prefix}
+    record_path = os.path.join(store.directory, 'corpus.json')
+    imported = []
+    if os.path.exists(record_path):
+        with open(record_path, 'r') as f:
+            imported = json.load(f)
+    if record in imported:
+        logger.info(f"语料 {corpus_dir} 已导入过（{len(ids)} 个嵌入），跳过")
+        return len(ids)
+    for start in range(0, len(ids), batch_size):
+        paths = [id_prefix + image_id for image_id in ids[start:start + batch_size]]
+        store.add(paths, np.asarray(vectors[start:start + batch_size], dtype=np.float32), file_signatures(paths))
+    with open(record_path + '.tmp', 'w') as f:
+        json.dump(imported + [record], f)
+    os.replace(record_path + '.tmp', record_path)
+    logger.info(f"已从 {corpus_dir} 导入 {len(ids)} 个语料嵌入")
+    return len(ids)
+
+
+def evaluate_codecs(vectors, queries, k=10, codecs=None, pq_subspaces=None, rerank=100):
+    """对比各编码的内存占用与召回损失
+
+    以fp32精确top-k为基准，recall@k = 压缩打分top-k与精确top-k的重合比例；
+    recall_rerank 为压缩打分取前rerank个候选后再用fp32精确重排的结果。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    n, dim = vectors.shape
+    k = min(k, n)
+    rows = np.arange(n)
+    exact_scores = queries @ vectors.T
+    exact_topk = np.argsort(-exact_scores, axis=1)[:, :k]
+
+    report = []
+    for name in codecs or list(CODECS):
+        # 编码写在临时目录里，评估完即删除
+        with tempfile.TemporaryDirectory() as directory:
+            codec = make_codec(name, dim, directory, pq_subspaces, pq_train_size=n)
+            codec.add(0, vectors)
+            codec.sync(n)
+            hits = 0
+            rerank_hits = 0
+            for qi, query in enumerate(queries):
+                approx = codec.score(query, rows)
+                truth = set(exact_topk[qi].tolist())
+                hits += len(truth.intersection(np.argsort(-approx)[:k].tolist()))
+                candidates = np.argsort(-approx)[:max(rerank, k)]
+                reranked = candidates[np.argsort(-exact_scores[qi, candidates])[:k]]
+                rerank_hits += len(truth.intersection(reranked.tolist()))
+            # 码本是固定开销，不随向量数增长，单独列出
+            codebook_bytes = codec.codebook_nbytes()
+            bytes_per_vector = (codec.nbytes() - codebook_bytes) / n
+        recall = hits / (len(queries) * k)
+        report.append({
+            'codec': name,
+            'bytes_per_vector': round(bytes_per_vector, 2),
+            'codebook_bytes': codebook_bytes,
+            'bytes_per_million': int(bytes_per_vector * 1_000_000 + codebook_bytes),
+            'compression': round(dim * 4 / bytes_per_vector, 2),
+            f'recall@{k}': round(recall, 4),
+            'recall_loss': round(1.0 - recall, 4),
+            'recall_rerank': round(rerank_hits / (len(queries) * k), 4),
+        })
+    return report
@@ -1,54 +1,104 @@
 import os
 import json
+import errno
+import fcntl
 import shutil
-import random
+from concurrent.futures import ThreadPoolExecutor
+from train import split_annotations
 
 # === 配置参数 ===
 json_file = "annotations.json"       # 原始 JSON 文件路径
 image_base_dir = "images"          # 图片目录（原始图片路径指向这个文件夹）
 output_dir = "output"              # 输出目录，会自动创建
 
+# 划分的落地方式：
+#   manifest 不复制图片，JSONL 即清单，各划分的数据集直接从 image_base_dir 读取（默认，最快且不占额外空间）
+#   link     硬链接到 output/images/{split}，跨文件系统时尝试 reflink（写时复制），都不支持时复制
+#   copy     多线程并行复制
+MATERIALIZE_MODE = "manifest"
+COPY_WORKERS = 16
+FICLONE = 0x40049409               # Linux ioctl：reflink 克隆整个文件
+
+splits = ["train", "val", "test"]
+
 # === 创建输出子文件夹 ===
 os.makedirs(output_dir, exist_ok=True)
-for split in ["train", "val", "test"]:
-    os.makedirs(os.path.join(output_dir, "images", split), exist_ok=True)
-
-# === 读取 JSON 文件 ===
-with open(json_file, "r", encoding="utf-8") as f:
-    data = json.load(f)
-
-# === 只保留必要字段 ===
-filtered_data = [{"image_path": item["image_path"], "product_title": item["product_title"]} for item in data]
-
-# === 打乱并划分数据集 ===
-random.shuffle(filtered_data)
-n = len(filtered_data)
-train_data = filtered_data[:int(0.7 * n)]
-val_data = filtered_data[int(0.7 * n):int(0.85 * n)]
-test_data = filtered_data[int(0.85 * n):]
-
-# === 保存为 JSON 文件 ===
-def save_json(data, filename):
-    with open(os.path.join(output_dir, filename), "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-
-save_json(train_data, "train.json")
-save_json(val_data, "val.json")
-save_json(test_data, "test.json")
-
-# === 复制图片到对应目录 ===
-def copy_images(data, split):
-    for item in data:
-        src_path = os.path.join(image_base_dir, os.path.basename(item["image_path"]))
-        dst_path = os.path.join(output_dir, "images", split, os.path.basename(item["image_path"]))
-        if os.path.exists(src_path):
-            shutil.copy(src_path, dst_path)
-        else:
+if MATERIALIZE_MODE == "manifest":
+    split_image_roots = {split: image_base_dir for split in splits}
+else:
+    split_image_roots = {split: os.path.join(output_dir, "images", split) for split in splits}
+    for split in splits:
+        os.makedirs(split_image_roots[split], exist_ok=True)
+
+# === 流式读取 JSON 文件，按图片路径的哈希划分（70/15/15）并保存为 JSONL ===
+# 内存占用与标注文件大小无关，每次运行得到相同的划分，与 train.py 的划分一致
+split_files = {split: os.path.join(output_dir, f"{split}_data.json") for split in splits}
+outputs = {split: open(path, "w", encoding="utf-8") for split, path in split_files.items()}
+with open(json_file, "rb") as f:
+    counts, invalid = split_annotations(f, outputs)
+for out in outputs.values():
+    out.close()
+print(f"训练集 {counts['train']}，验证集 {counts['val']}，测试集 {counts['test']}，跳过无效标注 {invalid}")
+
+# === 按 MATERIALIZE_MODE 把图片放到对应目录 ===
+def reflink(src_path, dst_path):
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(dst_path)
+            raise
+
+def materialize(src_path, dst_path):
+    """放置单张图片，返回实际使用的方式；目标已存在且大小一致时跳过，重复运行只处理新增图片"""
+    if not os.path.exists(src_path):
+        return "missing"
+    if os.path.exists(dst_path) and os.path.getsize(dst_path) == os.path.getsize(src_path):
+        return "skipped"
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+    if MATERIALIZE_MODE == "link":
+        try:
+            os.link(src_path, dst_path)
+            return "hardlink"
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+        try:
+            reflink(src_path, dst_path)
+            return "reflink"
+        except OSError:
+            pass
+    shutil.copyfile(src_path, dst_path)
+    return "copy"
+
+def copy_images(split):
+    jobs = []
+    with open(split_files[split], "r", encoding="utf-8") as f:
+        for line in f:
+            name = os.path.basename(json.loads(line)["image_path"])
+            jobs.append((os.path.join(image_base_dir, name), os.path.join(split_image_roots[split], name)))
+    with ThreadPoolExecutor(COPY_WORKERS) as pool:
+        methods = list(pool.map(lambda job: materialize(*job), jobs))
+    for (src_path, _), method in zip(jobs, methods):
+        if method == "missing":
             print(f"⚠️ 图片不存在: {src_path}")
-
-copy_images(train_data, "train")
-copy_images(val_data, "val")
-copy_images(test_data, "test")
+    summary = {method: methods.count(method) for method in sorted(set(methods))}
+    print(f"{split}: {len(jobs)} 张图片 {summary}")
+
+if MATERIALIZE_MODE == "manifest":
+    # 只校验图片是否存在，数据集直接读取原目录
+    for split in splits:
+        with open(split_files[split], "r", encoding="utf-8") as f:
+            names = [os.path.basename(json.loads(line)["image_path"]) for line in f]
+        missing = [name for name in names if not os.path.exists(os.path.join(image_base_dir, name))]
+        for name in missing:
+            print(f"⚠️ 图片不存在: {os.path.join(image_base_dir, name)}")
+        print(f"{split}: {len(names)} 张图片，从 {image_base_dir} 读取")
+else:
+    for split in splits:
+        copy_images(split)
 
 
 import json
@@ -61,6 +111,9 @@ from tqdm import tqdm
 import os
 import matplotlib.pyplot as plt
 from torch.utils.data import Dataset, DataLoader
+from train import PreprocessedImageCache, CachedImageDataset, prepare_images
+from serving import Uint8Preprocess
+from train import evaluate as train_evaluate
 
 model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
 processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
@@ -82,16 +135,22 @@ NUM_EPOCHS = 2
 LR = 5e-6
 MAX_GRAD_NORM = 1.0
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# 预处理缓存目录（默认关闭，每个epoch都重新解码图片）。设为目录（如 "./preprocessed_cache"）后，
+# 训练、验证、测试集的全部图片都以 224×224×3 的uint8各存一份（每张约147KB，10万张约14GB），
+# 只在磁盘空间足够且解码是瓶颈时开启
+PREPROCESSED_CACHE_DIR = None
 
 # 加载 CLIP 模型和预处理器
 model, preprocess = clip.load("ViT-B/32", device=DEVICE, jit=False)
 model = model.to(DEVICE)
 model = model.float() 
 model.train()
+# 不使用预处理缓存时，图片只缩放裁剪为uint8，归一化在训练循环的 prepare_images 中按批完成
+image_preprocess = Uint8Preprocess(model.visual.input_resolution)
 
 # 加载训练数据
-json_path = "./train_data.json"
-image_root = "./images/train/"
+json_path = split_files["train"]
+image_root = split_image_roots["train"]
 
 input_data = []
 with open(json_path, 'r') as f:
@@ -100,8 +159,8 @@ with open(json_path, 'r') as f:
         input_data.append(obj)
 
 # 加载验证数据
-val_json_path = "./val_data.json"
-val_image_root = "./images/val/"
+val_json_path = split_files["val"]
+val_image_root = split_image_roots["val"]
 
 val_data = []
 with open(val_json_path, 'r') as f:
@@ -109,8 +168,8 @@ with open(val_json_path, 'r') as f:
         val_data.append(json.loads(line))
 
 # 加载验证数据
-test_json_path = "./test_data.json"
-test_image_root = "./images/test/"
+test_json_path = split_files["test"]
+test_image_root = split_image_roots["test"]
 
 test_data = []
 with open(test_json_path, 'r') as f:
@@ -118,40 +177,7 @@ with open(test_json_path, 'r') as f:
         test_data.append(json.loads(line))
 
 def evaluate(model, val_dataset, topk=(1, 5, 10, 20)):
-    model.eval()
-    with torch.no_grad():
-        # Step 1: 提取所有图片特征
-        all_image_features = []
-        image_paths = []
-
-        for image, _ in DataLoader(val_dataset, batch_size=64):
-            image = image.to(DEVICE)
-            with torch.amp.autocast(DEVICE):
-                image_feat = model.encode_image(image)
-                image_feat /= image_feat.norm(dim=-1, keepdim=True)
-            all_image_features.append(image_feat)
-
-        image_features = torch.cat(all_image_features, dim=0)  # (N_img, D)
-
-        # Step 2: 对每个文本提取特征，并匹配所有图像
-        topk_correct = {k: 0 for k in topk}
-        total = len(val_dataset)
-
-        for idx in range(total):
-            text = val_dataset.tokenized_texts[idx].unsqueeze(0).to(DEVICE)  # (1, context_length)
-            with torch.amp.autocast(DEVICE):
-                text_feat = model.encode_text(text)
-                text_feat /= text_feat.norm(dim=-1, keepdim=True)
-
-            similarity = text_feat @ image_features.T  # (1, N_img)
-            values, indices = similarity.topk(max(topk), dim=-1)  # indices: (1, topk)
-
-            for k in topk:
-                if idx in indices[0][:k]:
-                    topk_correct[k] += 1
-
-        accs = {f"top{k}": topk_correct[k] / total for k in topk}
-        return accs
+    return train_evaluate(model, val_dataset, torch.device(DEVICE), topk=topk)
 
 
 # 构建 Dataset
@@ -182,7 +208,7 @@ class FashionDataset(Dataset):
         return len(self.image_paths)
 
     def __getitem__(self, idx):
-        image = preprocess(Image.open(self.image_paths[idx]).convert("RGB"))
+        image = image_preprocess(Image.open(self.image_paths[idx]))
         text = self.tokenized_texts[idx]
         return image, text
     
@@ -190,6 +216,14 @@ dataset = FashionDataset(input_data, image_root)
 val_dataset = FashionDataset(val_data, val_image_root)
 test_dataset = FashionDataset(test_data, test_image_root)
 
+# 一次性把图像解码、缩放为uint8写入缓存，之后的epoch直接读取缓存
+if PREPROCESSED_CACHE_DIR:
+    cache = PreprocessedImageCache(PREPROCESSED_CACHE_DIR)
+    cache.build(dataset.image_paths + val_dataset.image_paths + test_dataset.image_paths)
+    dataset = CachedImageDataset(dataset, cache)
+    val_dataset = CachedImageDataset(val_dataset, cache)
+    test_dataset = CachedImageDataset(test_dataset, cache)
+
 train_loader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=0)
 
 # Loss & Optimizer
@@ -210,7 +244,7 @@ for epoch in range(NUM_EPOCHS):
     pbar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{NUM_EPOCHS}")
 
     for images, texts in pbar:
-        images, texts = images.to(DEVICE), texts.to(DEVICE)
+        images, texts = prepare_images(images, DEVICE), texts.to(DEVICE)
         optimizer.zero_grad()
         ground_truth = torch.arange(len(images), device=DEVICE)
 
@@ -269,14 +303,15 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
 # 加载模型和预处理器
 model, preprocess = clip.load("ViT-B/32", device=device)
 
-checkpoint = torch.load("finetuned_clip_epoch2.pt")
+checkpoint = torch.load(f"finetuned_clip_epoch{NUM_EPOCHS}.pt")
 model.load_state_dict(checkpoint['model_state_dict'])
 
 # 加载模型和预处理器
 raw_model, raw_preprocess = clip.load("ViT-B/32", device=device)
 
+# 测试集上对比微调前后的召回率（速度、内存和不同精度的对比用 benchmark.py）
 accs = evaluate(raw_model, test_dataset)
 print("微调前topk准确率为：", accs)
 
-accs = evaluate(raw_model, test_dataset)
-print("微调前topk准确率为：", accs)
+accs = evaluate(model, test_dataset)
+print("微调后topk准确率为：", accs)
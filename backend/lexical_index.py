@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter
+
+# 拉丁字母/数字按词切分；中日韩文字没有空格，按相邻两字（单字成段时取单字）切分
+_WORD = re.compile(r'[a-z0-9]+')
+_CJK = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+')
+
+FUSIONS = ('linear', 'rrf')
+
+
+def tokenize(text):
+    text = (text or '').lower()
+    tokens = _WORD.findall(text)
+    for run in _CJK.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def document_key(path):
+    """索引按规范化后的完整路径对应图片，不同目录下的同名文件是不同的文档"""
+    return os.path.normpath(path)
+
+
+def file_name_tokens(path):
+    return tokenize(os.path.splitext(os.path.basename(path))[0])
+
+
+class LexicalIndex:
+    """图片文本元数据上的倒排索引，用BM25给候选图片打分
+
+    每张图片的文档由文件名中的词和 product_title 等元数据组成，元数据从标注文件或索引请求加入。
+    打分是只读的：索引中没有的候选图片按文件名临时分词，请求附带的元数据也只在该次打分中生效，
+    都不会写入索引，不影响其他请求的排序和词频统计。
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.doc_ids = {}       # 规范化路径 -> 文档id
+        self.doc_lengths = []
+        self.doc_titles = []    # 已并入的元数据文本，避免重复添加
+        self.postings = {}      # 词 -> {文档id: 词频}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def _add_tokens(self, doc_id, tokens):
+        for token, tf in Counter(tokens).items():
+            postings = self.postings.setdefault(token, {})
+            postings[doc_id] = postings.get(doc_id, 0) + tf
+        self.doc_lengths[doc_id] += len(tokens)
+        self.total_length += len(tokens)
+
+    def _ensure(self, path):
+        key = document_key(path)
+        doc_id = self.doc_ids.get(key)
+        if doc_id is None:
+            doc_id = len(self.doc_lengths)
+            self.doc_ids[key] = doc_id
+            self.doc_lengths.append(0)
+            self.doc_titles.append(set())
+            self._add_tokens(doc_id, file_name_tokens(key))
+        return doc_id
+
+    def add(self, path, text=None):
+        """加入图片（文件名分词），text 为其元数据（如 product_title），同一文本只并入一次"""
+        with self.lock:
+            doc_id = self._ensure(path)
+            if text and text not in self.doc_titles[doc_id]:
+                self.doc_titles[doc_id].add(text)
+                self._add_tokens(doc_id, tokenize(text))
+
+    def add_many(self, items):
+        for path, text in items:
+            self.add(path, text)
+
+    def load_annotations(self, path, image_root=''):
+        """读取标注（JSON数组或JSONL，每条含 image_path 和 product_title），返回加入的条数
+
+        image_root 为标注中相对 image_path 的根目录，拼接后应与搜索请求中的图片路径一致。
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            head = f.read(1)
+            while head.isspace():
+                head = f.read(1)
+            f.seek(0)
+            items = json.load(f) if head == '[' else (json.loads(line) for line in f if line.strip())
+            count = 0
+            for item in items:
+                if item.get('image_path'):
+                    self.add(os.path.join(image_root, item['image_path']), item.get('product_title'))
+                    count += 1
+        return count
+
+    def score(self, query, paths, metadata=None):
+        """query 对各候选图片的BM25分数，只返回分数大于0的 {路径: 分数}
+
+        metadata 为本次请求附带的 {路径: 文本}，只在本次打分时并入对应图片的文档。
+        索引中没有的候选按文件名临时成为文档，文档数、平均长度和文档频率按本次的候选临时修正。
+        """
+        tokens = set(tokenize(query))
+        if not tokens:
+            return {}
+        metadata = metadata or {}
+        with self.lock:
+            n, total_length = len(self.doc_lengths), self.total_length
+            df = {token: len(self.postings.get(token, ())) for token in tokens}
+            docs = []  # (路径, 文档id或None, 临时附加的查询词词频, 文档长度)
+            for path in dict.fromkeys(paths):
+                doc_id = self.doc_ids.get(document_key(path))
+                extra = []
+                if doc_id is None:
+                    extra = file_name_tokens(path)
+                    n += 1
+                text = metadata.get(path)
+                if text and (doc_id is None or text not in self.doc_titles[doc_id]):
+                    extra = extra + tokenize(text)
+                counts = Counter(token for token in extra if token in tokens)
+                for token in counts:
+                    if doc_id is None or doc_id not in self.postings.get(token, ()):
+                        df[token] += 1
+                total_length += len(extra)
+                length = len(extra) + (self.doc_lengths[doc_id] if doc_id is not None else 0)
+                docs.append((path, doc_id, counts, length))
+            avg_length = total_length / n if n else 0
+            idf = {token: math.log(1 + (n - count + 0.5) / (count + 0.5)) for token, count in df.items() if count}
+            postings = {token: self.postings.get(token, {}) for token in idf}
+            scores = {}
+            for path, doc_id, counts, length in docs:
+                value = 0.0
+                norm = self.k1 * (1 - self.b + self.b * length / avg_length) if avg_length else self.k1
+                for token, weight in idf.items():
+                    tf = counts.get(token, 0) + (postings[token].get(doc_id, 0) if doc_id is not None else 0)
+                    if tf:
+                        value += weight * tf * (self.k1 + 1) / (tf + norm)
+                if value > 0:
+                    scores[path] = value
+            return scores
+
+    def stats(self):
+        with self.lock:
+            return {
+                'documents': len(self.doc_lengths),
+                'terms': len(self.postings),
+                'postings': sum(len(postings) for postings in self.postings.values()),
+                'avg_doc_length': round(self.total_length / len(self.doc_lengths), 2) if self.doc_lengths else 0,
+            }
+
+
+def fuse_scores(results, lexical_scores, fusion='linear', weight=0.3, rrf_k=60):
+    """把CLIP相似度与词法分数融合后按融合分数重新排序，results 为 [{'path', 'score'}]（score为CLIP相似度）
+
+    linear: (1 - weight) × CLIP相似度 + weight × 归一化到[0, 1]的BM25分数；
+    rrf: 两种排序的倒数排名融合 Σ 1 / (rrf_k + 名次)，没有词法分数的结果只计CLIP排名。
+    融合分数写入 fused_score，词法分数写入 lexical_score；score 仍是CLIP相似度，调用方按 min_score 过滤时不受影响。
+    """
+    for result in results:
+        result['lexical_score'] = lexical_scores.get(result['path'], 0.0)
+    if fusion == 'rrf':
+        clip_rank = {id(r): i for i, r in enumerate(sorted(results, key=lambda r: r['score'], reverse=True))}
+        lexical = sorted((r for r in results if r['lexical_score'] > 0), key=lambda r: r['lexical_score'], reverse=True)
+        lexical_rank = {id(r): i for i, r in enumerate(lexical)}
+        for result in results:
+            score = 1.0 / (rrf_k + clip_rank[id(result)] + 1)
+            if id(result) in lexical_rank:
+                score += 1.0 / (rrf_k + lexical_rank[id(result)] + 1)
+            result['fused_score'] = score
+    elif fusion == 'linear':
+        top = max(lexical_scores.values(), default=0.0)
+        for result in results:
+            lexical = result['lexical_score'] / top if top > 0 else 0.0
+            result['fused_score'] = (1 - weight) * result['score'] + weight * lexical
+    else:
+        raise ValueError(f"不支持的融合方式: {fusion}，可选: {', '.join(FUSIONS)}")
+    results.sort(key=lambda r: r['fused_score'], reverse=True)
+    return results
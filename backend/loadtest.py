@@ -0,0 +1,232 @@
+"""CLIP服务 /api/clip/* 路由的HTTP压测工具
+
+按给定并发和请求配比持续发请求，统计各路由的 p50/p95/p99 延迟、吞吐量和状态码分布。
+只依赖标准库，可完全离线运行；配合 local_endpoint.py 可以压测微调模型端点路径。
+
+用法:
+    python loadtest.py --url http://localhost:5000 --concurrency 8 --requests 200 \
+        --mix search=8,secondary_search=1,test-endpoint=1 --endpoint-name local \
+        --synthetic-images 500 --report loadtest_report.json
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import urllib.request
+import urllib.error
+from collections import defaultdict
+
+DEFAULT_QUERIES = [
+    '红色连衣裙',
+    '白色运动鞋',
+    '黑色皮夹克',
+    'blue denim jeans',
+    'striped cotton shirt',
+    'leather handbag',
+]
+
+ROUTES = ('search', 'secondary_search', 'test-endpoint')
+
+
+def parse_mix(mix):
+    """'search=8,secondary_search=1' -> [('search', 8.0), ('secondary_search', 1.0)]"""
+    weights = []
+    for part in mix.split(','):
+        route, _, weight = part.partition('=')
+        route = route.strip()
+        if route not in ROUTES:
+            raise ValueError(f"不支持的路由: {route}，可选: {', '.join(ROUTES)}")
+        weights.append((route, float(weight or 1)))
+    return weights
+
+
+def make_synthetic_images(count, directory):
+    """生成纯色测试图片，离线压测时代替真实图库"""
+    from PIL import Image
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    rng = random.Random(0)
+    for i in range(count):
+        path = os.path.join(directory, f'synthetic_{i:06d}.jpg')
+        if not os.path.exists(path):
+            color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            Image.new('RGB', (rng.randrange(200, 640), rng.randrange(200, 640)), color).save(path)
+        paths.append(path)
+    return paths
+
+
+def load_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class LoadTest:
+    def __init__(self, args, images, queries):
+        self.args = args
+        self.images = images
+        self.queries = queries
+        self.mix = parse_mix(args.mix)
+        self.lock = threading.Lock()
+        self.issued = 0
+        self.samples = defaultdict(list)  # route -> [(latency, status, incomplete)]
+
+    def build_request(self, route, rng):
+        args = self.args
+        payload = {'query': rng.choice(self.queries), 'min_score': args.min_score,
+                   'user_id': f'loadtest-{rng.randrange(args.users)}'}
+        if args.time_budget_ms:
+            payload['time_budget_ms'] = args.time_budget_ms
+        if args.endpoint_name:
+            payload['endpoint_name'] = args.endpoint_name
+        if route == 'search':
+            payload['images'] = rng.sample(self.images, min(args.images_per_request, len(self.images)))
+        elif route == 'secondary_search':
+            primary = rng.sample(self.images, min(args.images_per_request, len(self.images)))
+            payload['primary_results'] = [{'path': path, 'score': 0.2} for path in primary]
+        else:
+            payload = {'endpoint_name': args.endpoint_name, 'test_text': payload['query']}
+        return f"{args.url.rstrip('/')}/api/clip/{route}", payload
+
+    def next_request(self):
+        """在总请求数或持续时间内领取下一个请求，返回False表示结束"""
+        with self.lock:
+            if self.args.requests and self.issued >= self.args.requests:
+                return False
+            if self.args.duration and time.monotonic() - self.start >= self.args.duration:
+                return False
+            self.issued += 1
+            return True
+
+    def worker(self, worker_id):
+        rng = random.Random(worker_id)
+        routes = [route for route, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        while self.next_request():
+            route = rng.choices(routes, weights)[0]
+            url, payload = self.build_request(route, rng)
+            body = json.dumps(payload).encode('utf-8')
+            req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            incomplete = False
+            try:
+                with urllib.request.urlopen(req, timeout=self.args.timeout) as resp:
+                    resp.read()
+                    status = resp.status
+                    incomplete = resp.headers.get('X-Search-Incomplete') == 'true'
+            except urllib.error.HTTPError as e:
+                e.read()
+                status = e.code
+            except Exception:
+                status = 'error'
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.samples[route].append((latency, status, incomplete))
+
+    def run(self):
+        self.start = time.monotonic()
+        threads = [threading.Thread(target=self.worker, args=(i,)) for i in range(self.args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.report(time.monotonic() - self.start)
+
+    def report(self, elapsed):
+        def summarize(samples):
+            latencies = sorted(latency for latency, _, _ in samples)
+            statuses = defaultdict(int)
+            for _, status, _ in samples:
+                statuses[str(status)] += 1
+            ok = statuses.get('200', 0)
+            return {
+                'requests': len(samples),
+                'ok': ok,
+                'error_rate': round(1 - ok / len(samples), 4) if samples else None,
+                'incomplete': sum(1 for _, _, incomplete in samples if incomplete),
+                'status': dict(statuses),
+                'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+                'latency_ms': {
+                    'mean': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+                    'p50': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+                    'p95': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+                    'p99': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+                    'max': round(latencies[-1] * 1000, 2) if latencies else None,
+                },
+            }
+
+        all_samples = [s for samples in self.samples.values() for s in samples]
+        return {
+            'config': {
+                'url': self.args.url,
+                'concurrency': self.args.concurrency,
+                'mix': self.args.mix,
+                'images_per_request': self.args.images_per_request,
+                'endpoint_name': self.args.endpoint_name,
+            },
+            'elapsed_s': round(elapsed, 2),
+            'overall': summarize(all_samples),
+            'routes': {route: summarize(samples) for route, samples in self.samples.items()},
+        }
+
+
+def print_report(report):
+    print(f"耗时 {report['elapsed_s']}s，并发 {report['config']['concurrency']}")
+    print(f"{'路由':<20}{'请求数':>8}{'成功':>8}{'不完整':>8}{'吞吐(rps)':>12}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    rows = list(report['routes'].items()) + [('overall', report['overall'])]
+    for route, stats in rows:
+        latency = stats['latency_ms']
+        print(f"{route:<20}{stats['requests']:>8}{stats['ok']:>8}{stats['incomplete']:>8}"
+              f"{stats['throughput_rps']:>12}{latency['p50']:>10}{latency['p95']:>10}{latency['p99']:>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # 目标服务与请求配比
+    parser.add_argument('--url', type=str, default='http://localhost:5000')
+    parser.add_argument('--mix', type=str, default='search=1')
+    parser.add_argument('--endpoint-name', type=str, default=None)
+    parser.add_argument('--min-score', type=float, default=0.155)
+    parser.add_argument('--time-budget-ms', type=int, default=None)
+
+    # 负载规模
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=None)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=60)
+
+    # 查询和图片来源
+    parser.add_argument('--queries', type=str, default=None)
+    parser.add_argument('--images', type=str, default=None)
+    parser.add_argument('--synthetic-images', type=int, default=200)
+    parser.add_argument('--images-per-request', type=int, default=50)
+
+    parser.add_argument('--report', type=str, default=None)
+
+    args = parser.parse_args()
+    if args.duration:
+        args.requests = None
+    if any(route == 'test-endpoint' for route, _ in parse_mix(args.mix)) and not args.endpoint_name:
+        parser.error('请求配比包含 test-endpoint 时需要指定 --endpoint-name')
+
+    queries = load_lines(args.queries) if args.queries else DEFAULT_QUERIES
+    if args.images:
+        images = load_lines(args.images)
+    else:
+        images = make_synthetic_images(args.synthetic_images, os.path.join(tempfile.gettempdir(), 'clip-loadtest-images'))
+
+    report = LoadTest(args, images, queries).run()
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
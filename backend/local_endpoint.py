@@ -0,0 +1,166 @@
+"""本地SageMaker端点替身
+
+加载 prepare_model_artifacts 生成的 code/inference.py，按SageMaker的调用约定依次执行
+model_fn / input_fn / predict_fn / output_fn，并可注入延迟和错误，用于离线压测
+search_with_endpoint 和 test_endpoint。
+
+用法:
+    # 使用已有的模型工件目录（需包含 code/、model_info.json、model.f16 和 model.f16.json）
+    python local_endpoint.py --model-dir /path/to/model --port 8080
+
+    # 离线生成随机初始化权重的工件，不需要下载任何模型
+    python local_endpoint.py --synthetic ViT-B/32 --latency-ms 50 --error-rate 0.01
+
+clip_server.py 设置 SAGEMAKER_RUNTIME_ENDPOINT_URL=http://localhost:8080 后即通过本替身调用端点
+（boto3仍需要任意非空的 AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY 用于签名）。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import importlib.util
+import logging
+from flask import Flask, request, Response, jsonify
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 常用CLIP结构的超参数，用于离线构造随机初始化的同结构模型
+CLIP_ARCHITECTURES = {
+    'ViT-B/32': dict(embed_dim=512, image_resolution=224, vision_layers=12, vision_width=768,
+                     vision_patch_size=32, context_length=77, vocab_size=49408,
+                     transformer_width=512, transformer_heads=8, transformer_layers=12),
+    'ViT-B/16': dict(embed_dim=512, image_resolution=224, vision_layers=12, vision_width=768,
+                     vision_patch_size=16, context_length=77, vocab_size=49408,
+                     transformer_width=512, transformer_heads=8, transformer_layers=12),
+    'ViT-L/14': dict(embed_dim=768, image_resolution=224, vision_layers=24, vision_width=1024,
+                     vision_patch_size=14, context_length=77, vocab_size=49408,
+                     transformer_width=768, transformer_heads=12, transformer_layers=12),
+}
+
+
+def build_synthetic_model(arch):
+    """按结构构造随机初始化的CLIP模型及对应的预处理"""
+    from clip.model import CLIP
+    from clip.clip import _transform
+    config = CLIP_ARCHITECTURES[arch]
+    model = CLIP(**config).float().eval()
+    return model, _transform(config['image_resolution'])
+
+
+def build_synthetic_artifact(arch, model_dir):
+    """生成与训练产物结构一致的模型工件：model_info.json、model.f16 和 code/"""
+    from train import prepare_model_artifacts, clip_architecture
+    from serving import export_serving_weights
+
+    os.makedirs(model_dir, exist_ok=True)
+    model, _ = build_synthetic_model(arch)
+    export_serving_weights(model.state_dict(), model_dir)
+    with open(os.path.join(model_dir, 'model_info.json'), 'w') as f:
+        json.dump({'clip_model_type': arch, 'weights_format': 'fp16-mmap',
+                   'architecture': clip_architecture(model)}, f)
+    prepare_model_artifacts(model_dir)
+    logger.info(f"已生成离线模型工件: {model_dir} ({arch})")
+
+
+def load_handler(model_dir):
+    """以独立模块加载工件中的 code/inference.py"""
+    code_dir = os.path.join(model_dir, 'code')
+    spec = importlib.util.spec_from_file_location('inference', os.path.join(code_dir, 'inference.py'))
+    handler = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, code_dir)
+    spec.loader.exec_module(handler)
+    return handler
+
+
+def create_app(handler, model, latency_ms=0, jitter_ms=0, error_rate=0.0, error_status=500):
+    app = Flask(__name__)
+    stats = {'invocations': 0, 'injected_errors': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+
+    def invoke():
+        with stats_lock:
+            stats['invocations'] += 1
+        # 注入延迟与错误，模拟真实端点的网络和排队开销
+        delay = latency_ms + (random.uniform(-jitter_ms, jitter_ms) if jitter_ms else 0)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        if error_rate and random.random() < error_rate:
+            with stats_lock:
+                stats['injected_errors'] += 1
+            return jsonify({'ErrorCode': 'INJECTED_ERROR', 'Message': '注入的错误'}), error_status
+
+        content_type = request.content_type or 'application/json'
+        accept = request.headers.get('Accept', 'application/json')
+        if accept in ('*/*', ''):
+            accept = 'application/json'
+        try:
+            input_data = handler.input_fn(request.get_data(), content_type)
+            prediction = handler.predict_fn(input_data, model)
+            body, response_type = handler.output_fn(prediction, accept)
+        except Exception as e:
+            with stats_lock:
+                stats['failed'] += 1
+            logger.error(f"推理失败: {str(e)}")
+            return jsonify({'ErrorCode': 'MODEL_ERROR', 'Message': str(e)}), 500
+        return Response(body, mimetype=response_type)
+
+    @app.route('/ping', methods=['GET'])
+    def ping():
+        return '', 200
+
+    # SageMaker容器约定的路径
+    @app.route('/invocations', methods=['POST'])
+    def invocations():
+        return invoke()
+
+    # boto3 sagemaker-runtime 的 invoke_endpoint 请求路径
+    @app.route('/endpoints/<endpoint_name>/invocations', methods=['POST'])
+    def endpoint_invocations(endpoint_name):
+        return invoke()
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        with stats_lock:
+            return jsonify(dict(stats))
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # 模型工件
+    parser.add_argument('--model-dir', type=str, default=None)
+    parser.add_argument('--synthetic', type=str, default=None, choices=sorted(CLIP_ARCHITECTURES))
+
+    # 服务与故障注入
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+
+    args = parser.parse_args()
+
+    if not args.model_dir and not args.synthetic:
+        parser.error('需要指定 --model-dir 或 --synthetic')
+
+    model_dir = args.model_dir
+    if args.synthetic:
+        model_dir = model_dir or tempfile.mkdtemp(prefix='local-endpoint-')
+        if not os.path.exists(os.path.join(model_dir, 'model.f16.json')):
+            build_synthetic_artifact(args.synthetic, model_dir)
+
+    handler = load_handler(model_dir)
+    start = time.time()
+    model = handler.model_fn(model_dir)
+    logger.info(f"model_fn 加载耗时 {time.time() - start:.2f}s")
+
+    app = create_app(handler, model, args.latency_ms, args.jitter_ms, args.error_rate, args.error_status)
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -157,11 +157,16 @@ async function deleteEndpoint(deployment) {
       const tempDir = path.join(os.tmpdir(), `model-${Date.now()}`);
       fs.mkdirSync(tempDir, { recursive: true });
       
-      // 复制模型文件到临时目录
-      fs.copyFileSync(
-        path.join(modelDir, 'model.pt'),
-        path.join(tempDir, 'model.pt')
-      );
+      // 复制自包含的模型工件到临时目录：内存映射的fp16权重（model.f16 + 索引）、含结构配置的model_info.json，
+      // 以及推理代码（附带CLIP模型结构和分词器，端点启动时不下载权重也不安装依赖）
+      for (const file of ['model.f16', 'model.f16.json', 'model_info.json']) {
+        fs.copyFileSync(path.join(modelDir, file), path.join(tempDir, file));
+      }
+      fs.cpSync(path.join(modelDir, 'code'), path.join(tempDir, 'code'), { recursive: true });
+      // 训练时用 --embed-corpus 编码的语料嵌入随模型工件一起部署，搜索服务启动时直接导入
+      if (fs.existsSync(path.join(modelDir, 'corpus'))) {
+        fs.cpSync(path.join(modelDir, 'corpus'), path.join(tempDir, 'corpus'), { recursive: true });
+      }
       
       // 创建tar.gz文件
       const tarFile = path.join(os.tmpdir(), `model-${Date.now()}.tar.gz`);
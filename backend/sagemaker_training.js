@@ -5,20 +5,33 @@ const fs = require('fs');
 const path = require('path');
 
 /**
- * 上传训练脚本到S3
- * @param {string} localPath - 本地脚本路径
+ * 把训练脚本及其依赖的模块打包为 sourcedir.tar.gz 上传到S3（SageMaker解压到代码目录后运行 sagemaker_program）
+ * @param {string[]} localPaths - 本地脚本路径，打包后都位于压缩包根目录
  * @param {string} s3Key - S3目标路径
  * @returns {string} - S3 URI
  */
-async function uploadTrainingScript(localPath, s3Key) {
+async function uploadTrainingScript(localPaths, s3Key) {
   try {
-    const fileContent = fs.readFileSync(localPath);
+    const os = require('os');
+    const tar = require('tar');
     
+    const tarFile = path.join(os.tmpdir(), `sourcedir-${Date.now()}.tar.gz`);
+    await tar.create(
+      {
+        gzip: true,
+        file: tarFile,
+        cwd: path.dirname(localPaths[0])
+      },
+      localPaths.map(localPath => path.basename(localPath))
+    );
+    
+    const fileContent = fs.readFileSync(tarFile);
     await s3.upload({
       Bucket: awsConfig.s3Bucket,
       Key: s3Key,
       Body: fileContent
     }).promise();
+    fs.unlinkSync(tarFile);
     
     return `s3://${awsConfig.s3Bucket}/${s3Key}`;
   } catch (error) {
@@ -36,9 +49,12 @@ async function uploadTrainingScript(localPath, s3Key) {
  */
 async function createTrainingJob(dataset, model, hyperParams = {}) {
   try {
-    // 上传训练脚本
-    const scriptS3Key = `${awsConfig.modelsPrefix}scripts/train.py`;
-    await uploadTrainingScript(path.join(__dirname, 'train.py'), scriptS3Key);
+    // 上传训练脚本：train.py 与共用的预处理和部署权重模块 serving.py 一起打包
+    const scriptS3Key = `${awsConfig.modelsPrefix}scripts/sourcedir.tar.gz`;
+    await uploadTrainingScript(
+      ['train.py', 'serving.py'].map(name => path.join(__dirname, name)),
+      scriptS3Key
+    );
     
     // 创建唯一的训练作业名称
     const trainingJobName = `clip-finetune-${model.id.replace(/-/g, '')}`;
@@ -89,6 +105,11 @@ async function createTrainingJob(dataset, model, hyperParams = {}) {
       OutputDataConfig: {
         S3OutputPath: outputS3Uri
       },
+      // train.py 定期把检查点写到 LocalPath，SageMaker同步到S3；任务重启时同步回来并自动续训
+      CheckpointConfig: {
+        S3Uri: `${outputS3Uri.replace(/\/$/, '')}/checkpoints/${trainingJobName}`,
+        LocalPath: '/opt/ml/checkpoints'
+      },
       ResourceConfig: {
         InstanceType: "ml.m5.large",
         InstanceCount: 1,
@@ -10,15 +10,22 @@ const multer = require('multer');
 const path = require('path');
 const fs = require('fs');
 const fetch = require('node-fetch');
+const crypto = require('crypto');
 const CryptoJS = require('crypto-js');
 const AWS = require('aws-sdk');
 
 // 导入训练相关路由
 const trainingRoutes = require('./training-routes');
+const { mergeClipResults } = require('./clip-results');
 
 const app = express();
 const port = 3000;
 
+// CLIP 服务地址与超时配置
+const CLIP_SERVICE_URL = process.env.CLIP_SERVICE_URL || 'http://57.181.23.46:5000';
+const CLIP_REQUEST_TIMEOUT_MS = 50000;
+const CLIP_RESPONSE_MARGIN_MS = 5000;
+
 // 配置 AWS
 AWS.config.update({
   region: process.env.AWS_REGION || 'ap-northeast-1',
@@ -755,6 +762,11 @@ app.post('/api/images/search', authenticateToken, async (req, res) => {
           
           const data = await s3.getObject(params).promise();
           fs.writeFileSync(tempPath, data.Body);
+          // 修改时间设为S3对象的修改时间：CLIP服务按文件大小和修改时间判断图片是否变化，
+          // 每次重新下载的同一对象不会被当作新图片重新编码
+          if (data.LastModified) {
+            fs.utimesSync(tempPath, data.LastModified, data.LastModified);
+          }
           
           // 返回临时文件路径
           return tempPath;
@@ -771,15 +783,46 @@ app.post('/api/images/search', authenticateToken, async (req, res) => {
     // 过滤掉无效路径
     const validImagePaths = imagePaths.filter(path => path !== null);
 
-    // 设置超时
+    // 清理从S3下载的临时文件
+    const cleanupTempFiles = () => {
+      imagePaths.forEach(tempPath => {
+        if (tempPath && tempPath.startsWith('uploads/') && fs.existsSync(tempPath)) {
+          fs.unlinkSync(tempPath);
+        }
+      });
+    };
+
+    // 设置超时：超时后中止对CLIP服务的请求，并通知其取消仍在进行的编码
+    const clipRequestId = crypto.randomUUID();
+    const clipAbortController = new AbortController();
+    const cancelClipSearch = () => {
+      clipAbortController.abort();
+      fetch(`${CLIP_SERVICE_URL}/api/clip/cancel`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ request_id: clipRequestId }),
+      }).catch(error => console.error('取消CLIP搜索失败:', error));
+    };
     const clipRequestTimeout = setTimeout(() => {
       console.error('CLIP 请求超时');
-      res.status(504).json({ error: 'CLIP 服务请求超时' });
-    }, 50000);
+      cancelClipSearch();
+      if (!res.headersSent) {
+        res.status(504).json({ error: 'CLIP 服务请求超时' });
+      }
+    }, CLIP_REQUEST_TIMEOUT_MS);
+
+    // 客户端提前断开时同样取消CLIP搜索
+    const onClientClose = () => {
+      if (!res.writableEnded) {
+        clearTimeout(clipRequestTimeout);
+        cancelClipSearch();
+      }
+    };
+    res.on('close', onClientClose);
 
     // 调用 Python CLIP 服务
     try {
-      const clipResponse = await fetch('http://57.181.23.46:5000/api/clip/search', {
+      const clipResponse = await fetch(`${CLIP_SERVICE_URL}/api/clip/search`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -787,11 +830,25 @@ app.post('/api/images/search', authenticateToken, async (req, res) => {
         body: JSON.stringify({
           query,
           images: validImagePaths,
-          min_score: min_score
+          min_score: min_score,
+          user_id: userId,
+          priority: 'interactive',
+          request_id: clipRequestId,
+          // 预留合并结果的时间，让CLIP服务在本地超时之前返回部分结果
+          time_budget_ms: CLIP_REQUEST_TIMEOUT_MS - CLIP_RESPONSE_MARGIN_MS
         }),
+        signal: clipAbortController.signal,
       });
 
       clearTimeout(clipRequestTimeout); // 清除超时
+      res.off('close', onClientClose);
+
+      // CLIP服务已饱和，直接把429和重试时间转给客户端
+      if (clipResponse.status === 429) {
+        const retryAfter = clipResponse.headers.get('Retry-After') || '1';
+        res.set('Retry-After', retryAfter);
+        return res.status(429).json({ error: 'CLIP 服务繁忙，请稍后重试', retry_after: Number(retryAfter) });
+      }
 
       if (!clipResponse.ok) {
         const errorText = await clipResponse.text();
@@ -799,39 +856,33 @@ app.post('/api/images/search', authenticateToken, async (req, res) => {
       }
 
       const clipResults = await clipResponse.json();
+      const clipIncomplete = clipResponse.headers.get('X-Search-Incomplete') === 'true';
+      if (clipIncomplete) {
+        console.warn(`CLIP 搜索超出时间预算，仅返回 ${clipResponse.headers.get('X-Search-Scored')}/${clipResponse.headers.get('X-Search-Total')} 张图片的结果`);
+      }
 
       // 将结果与图片信息合并并过滤低相似度结果
-      const results = clipResults
-        .filter(result => result.score >= min_score)
-        .map(result => {
-          // 查找匹配的图片，考虑可能使用临时路径的情况
-          const image = images.find(img => 
-            img.file_path === result.path || 
-            path.basename(img.file_path) === path.basename(result.path)
-          );
-          if (!image) return null;
-          return {
-            ...image,
-            url: image.s3_url || `http://57.181.23.46/${image.file_path}`,
-            score: result.score,
-          };
-        }).filter(item => item !== null);
-
-      // 清理临时文件
-      imagePaths.forEach(tempPath => {
-        if (tempPath && tempPath.startsWith('uploads/') && fs.existsSync(tempPath)) {
-          fs.unlinkSync(tempPath);
-        }
-      });
+      const results = mergeClipResults(clipResults, images, min_score);
 
+      res.set('X-Search-Incomplete', clipIncomplete ? 'true' : 'false');
       res.json(results);
     } catch (error) {
-      clearTimeout(clipRequestTimeout);
+      // 超时或客户端断开导致的中止已经处理过，不再重复响应
+      if (error.name === 'AbortError') {
+        return;
+      }
       throw error;
+    } finally {
+      // 无论成功、出错、超时还是客户端断开，都清理计时器、监听器和从S3下载的临时文件
+      clearTimeout(clipRequestTimeout);
+      res.off('close', onClientClose);
+      cleanupTempFiles();
     }
   } catch (error) {
     console.error('CLIP 搜索错误:', error);
-    res.status(500).json({ error: 'CLIP 搜索失败: ' + error.message });
+    if (!res.headersSent) {
+      res.status(500).json({ error: 'CLIP 搜索失败: ' + error.message });
+    }
   }
 });
 
@@ -0,0 +1,168 @@
+import os
+import json
+import math
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import clip
+from PIL import Image
+
+# 训练（train.py）与在线服务（clip_server.py）共用的部分：CLIP图片预处理和部署权重的导出、加载
+# 只依赖 torch、clip、Pillow 和 numpy；SageMaker训练任务与 train.py 一起上传
+
+logger = logging.getLogger(__name__)
+
+# CLIP预处理使用的归一化参数
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+def rgb_image(image):
+    """转为RGB；已是RGB时不再复制（Image.convert 对相同模式也会复制一份）"""
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+def resize_crop_uint8(image, size=224, out=None):
+    """PIL图片缩放、中心裁剪为 size×size 的uint8 HWC数组，与CLIP预处理的Resize+CenterCrop逐像素一致
+
+    out 为预分配的 (size, size, 3) uint8数组时直接写入其中。
+    """
+    image = rgb_image(image)
+    w, h = image.size
+    # 短边缩放到size，长边按比例截断取整（与torchvision.transforms.Resize相同）
+    if w <= h:
+        new_w, new_h = size, int(size * h / w)
+    else:
+        new_w, new_h = int(size * w / h), size
+    image = image.resize((new_w, new_h), Image.BICUBIC)
+    left = int(round((new_w - size) / 2.0))
+    top = int(round((new_h - size) / 2.0))
+    image = image.crop((left, top, left + size, top + size))
+    if out is None:
+        return np.array(image, dtype=np.uint8)
+    out[...] = np.asarray(image)
+    return out
+
+def load_image_uint8(path, size=224, out=None):
+    """解码图片（路径或文件对象）并缩放、中心裁剪为 size×size 的uint8 HWC数组"""
+    return resize_crop_uint8(Image.open(path), size, out)
+
+def normalize_batch(images, out=None):
+    """uint8 NHWC批次 -> 归一化后的float NCHW批次，整批一次完成
+
+    (x / 255 - mean) / std 合并为 x × scale - shift，只遍历两遍数据；out 为预分配的float张量时直接写入其中。
+    """
+    std = torch.tensor(CLIP_STD, device=images.device).view(1, 3, 1, 1)
+    scale = 1.0 / (255.0 * std)
+    shift = torch.tensor(CLIP_MEAN, device=images.device).view(1, 3, 1, 1) / std
+    images = images.permute(0, 3, 1, 2)
+    images = torch.mul(images, scale, out=out) if out is not None else images * scale
+    return images.sub_(shift)
+
+class Uint8Preprocess:
+    """CLIP预处理中的Resize+CenterCrop：PIL图片 -> uint8 HWC张量
+
+    ToTensor+Normalize 由 prepare_images 在设备上按批完成，DataLoader worker 不再为每张图片分配中间的float张量，
+    worker 传回主进程的数据量也只有float的1/4。
+    """
+
+    def __init__(self, size=224):
+        self.size = size
+
+    def __call__(self, image):
+        return torch.from_numpy(resize_crop_uint8(image, self.size))
+
+class BatchPreprocessor:
+    """按批预处理图片，用于在线编码（如 clip_server 的图片编码）
+
+    每张图片解码后直接缩放裁剪进预分配的uint8缓冲区，再对整批做一次归一化，写入预分配的float输出张量；
+    两块缓冲区在批次之间复用，批次变大时才重新分配。workers > 1 时在线程池中解码（Pillow解码和缩放时释放GIL）。
+    返回的张量是输出缓冲区的视图，在下一次调用前有效；实例不是线程安全的，并发时每个线程使用各自的实例。
+    """
+
+    def __init__(self, size=224, max_batch=16, workers=0):
+        self.size = size
+        self.buffer = np.empty((max_batch, size, size, 3), dtype=np.uint8)
+        self.output = torch.empty(max_batch, 3, size, size)
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+
+    def _load(self, row, image):
+        try:
+            if isinstance(image, Image.Image):
+                resize_crop_uint8(image, self.size, self.buffer[row])
+            else:
+                load_image_uint8(image, self.size, self.buffer[row])
+            return True
+        except Exception as e:
+            logger.error(f"加载图像错误 {image}: {e}")
+            return False
+
+    def __call__(self, images):
+        """images 为图片路径、文件对象或PIL图片的列表，返回 ((n, 3, size, size) 的float张量, 每张图片是否加载成功)
+
+        加载失败的图片对应的行内容无意义，由调用方按返回的标记过滤。
+        """
+        n = len(images)
+        if n > len(self.buffer):
+            self.buffer = np.empty((n, self.size, self.size, 3), dtype=np.uint8)
+            self.output = torch.empty(n, 3, self.size, self.size)
+        if self.pool is not None and n > 1:
+            ok = list(self.pool.map(self._load, range(n), images))
+        else:
+            ok = [self._load(row, image) for row, image in enumerate(images)]
+        return normalize_batch(torch.from_numpy(self.buffer[:n]), out=self.output[:n]), ok
+
+def export_serving_weights(state, model_dir, name='model.f16'):
+    """把权重写成可内存映射的半精度文件
+
+    name 中按64字节对齐连续存放各张量（浮点张量转为fp16），name.json 记录每个张量的偏移、形状和类型。
+    """
+    path = os.path.join(model_dir, name)
+    tensors = {}
+    offset = 0
+    with open(path + '.tmp', 'wb') as f:
+        for key, tensor in state.items():
+            tensor = tensor.detach().cpu()
+            if tensor.is_floating_point():
+                tensor = tensor.half()
+            array = tensor.contiguous().numpy()
+            padding = -offset % 64
+            f.write(b'\0' * padding)
+            offset += padding
+            f.write(array.tobytes())
+            tensors[key] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+            offset += array.nbytes
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump({'format': 'fp16-mmap', 'tensors': tensors}, f)
+    os.replace(path + '.tmp', path)
+    os.replace(path + '.json.tmp', path + '.json')
+    logger.info(f"导出部署权重 {path}（{offset / 1024 ** 2:.1f}MB）")
+
+def load_serving_weights(model_dir, name='model.f16'):
+    """以内存映射方式读取 export_serving_weights 导出的权重，返回state_dict"""
+    path = os.path.join(model_dir, name)
+    with open(path + '.json', 'r') as f:
+        index = json.load(f)
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    state = {}
+    for key, entry in index['tensors'].items():
+        dtype = np.dtype(entry['dtype'])
+        nbytes = math.prod(entry['shape']) * dtype.itemsize
+        array = data[entry['offset']:entry['offset'] + nbytes].view(dtype).reshape(entry['shape'])
+        state[key] = torch.from_numpy(array)
+    return state
+
+def artifact_fingerprint(model_dir):
+    """部署权重文件内容的哈希，用于核对语料嵌入与部署的模型是否一致"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in ['model.f16', 'model.f16.json']:
+        with open(os.path.join(model_dir, name), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def build_serving_model(model_dir, architecture):
+    """与部署端一致地构建模型：按结构配置构造CLIP并加载导出的部署权重（最佳epoch）"""
+    model = clip.model.CLIP(**architecture)
+    model.load_state_dict(load_serving_weights(model_dir))
+    return model.float().eval()
@@ -0,0 +1,327 @@
+"""本地并行超参数搜索
+
+在本机同时运行多个 train.py 试验，每个试验分到互不重叠的一组CPU核心（CPU亲和性 + 计算线程数）。
+数据集只准备一次（解压/划分、清单、预处理缓存或分片），所有试验通过 --reuse-prepared 共用；
+按验证集召回率做中位数剪枝：试验在某个epoch的最佳指标低于其他试验在同一epoch的中位数时提前终止。
+每结束一个试验就更新 work_dir/leaderboard.json。
+
+用法:
+    python sweep.py --train /path/to/data --work-dir sweep_runs --parallel 2 \
+        --grid learning-rate=5e-6,1e-5,2e-5 --grid batch-size=32,64 \
+        -- --dataset-mode zip --epochs 5
+
+'--' 之后的参数原样传给每个试验的 train.py；--grid 可重复，取所有取值的笛卡尔积。
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import itertools
+import statistics
+import subprocess
+from collections import deque
+from train import build_parser, load_datasets
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+
+
+def parse_grid(specs):
+    """['learning-rate=5e-6,1e-5', ...] -> [('learning-rate', ['5e-6', '1e-5']), ...]"""
+    grid = []
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        name = name.strip().lstrip('-').replace('_', '-')
+        values = [value.strip() for value in values.split(',') if value.strip()]
+        if not name or not values:
+            raise ValueError(f"无效的搜索范围: {spec}，格式为 name=v1,v2")
+        grid.append((name, values))
+    return grid
+
+
+def expand_trials(grid, max_trials=None, seed=0):
+    """网格的笛卡尔积；超过 max_trials 时按seed随机抽取"""
+    names = [name for name, _ in grid]
+    combos = [dict(zip(names, values)) for values in itertools.product(*(values for _, values in grid))]
+    if max_trials and len(combos) > max_trials:
+        combos = random.Random(seed).sample(combos, max_trials)
+    return combos
+
+
+def split_cores(parallel):
+    """把本进程可用的核心分成 parallel 组互不重叠的核心；核心数不够时多个试验共用核心"""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    per_slot = max(1, len(cores) // parallel)
+    slots = []
+    for i in range(parallel):
+        cores_of_slot = cores[i * per_slot:(i + 1) * per_slot]
+        slots.append(cores_of_slot or [cores[i % len(cores)]])
+    return slots
+
+
+class Trial:
+    def __init__(self, trial_id, params, trial_dir):
+        self.id = trial_id
+        self.params = params
+        self.dir = trial_dir
+        self.status = 'pending'
+        self.process = None
+        self.log_file = None
+        self.cores = None
+        self.start = None
+        self.elapsed = None
+        self.returncode = None
+        self.evals = {}  # epoch -> eval记录
+        self._offset = 0
+
+    @property
+    def metrics_path(self):
+        return os.path.join(self.dir, 'metrics.jsonl')
+
+    def command(self, train_argv, shared_argv):
+        argv = [sys.executable, TRAIN_SCRIPT, *train_argv]
+        for name, value in self.params.items():
+            argv += [f'--{name}', value]
+        return argv + shared_argv + [
+            '--reuse-prepared',
+            '--model-dir', os.path.join(self.dir, 'model'),
+            '--checkpoint-dir', os.path.join(self.dir, 'checkpoints'),
+            '--metrics-log', self.metrics_path,
+            '--profile-dir', os.path.join(self.dir, 'profile'),
+            '--frozen-cache', os.path.join(self.dir, 'frozen_features'),
+            '--teacher-cache', os.path.join(self.dir, 'teacher_features'),
+            '--threads-per-proc', str(len(self.cores)),
+        ]
+
+    def launch(self, train_argv, shared_argv, cores):
+        # 每次从头训练：清掉上一次搜索留下的检查点和指标
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.dir, 'model'), exist_ok=True)
+        self.cores = cores
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+        preexec_fn = None
+        if hasattr(os, 'sched_setaffinity'):
+            preexec_fn = lambda: os.sched_setaffinity(0, cores)
+        self.log_file = open(os.path.join(self.dir, 'train.log'), 'w')
+        self.process = subprocess.Popen(self.command(train_argv, shared_argv), stdout=self.log_file,
+                                        stderr=subprocess.STDOUT, env=env, preexec_fn=preexec_fn)
+        self.status = 'running'
+        self.start = time.monotonic()
+
+    def read_evals(self):
+        """读取指标文件中新增的eval记录，返回是否有新的记录"""
+        if not os.path.exists(self.metrics_path):
+            return False
+        updated = False
+        with open(self.metrics_path, 'r') as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                self._offset += len(line.encode('utf-8'))
+                record = json.loads(line)
+                if record.get('type') == 'eval':
+                    self.evals[record['epoch']] = record
+                    updated = True
+        return updated
+
+    def best(self, metric, upto=None):
+        """截至第upto个epoch（含）的最佳指标及其epoch"""
+        values = [(record.get(metric), epoch) for epoch, record in self.evals.items()
+                  if upto is None or epoch <= upto]
+        values = [(value, epoch) for value, epoch in values if value is not None]
+        return max(values) if values else (None, None)
+
+    def stop(self, status):
+        self.status = status
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def finish(self):
+        self.read_evals()
+        self.returncode = self.process.returncode
+        self.elapsed = time.monotonic() - self.start
+        self.log_file.close()
+        if self.status == 'running':
+            self.status = 'completed' if self.returncode == 0 else 'failed'
+
+    def summary(self, metric):
+        best, best_epoch = self.best(metric)
+        return {
+            'trial': self.id,
+            'params': self.params,
+            'status': self.status,
+            'best_' + metric: best,
+            'best_epoch': best_epoch,
+            'epochs': max(self.evals) if self.evals else 0,
+            'evals': [self.evals[epoch] for epoch in sorted(self.evals)],
+            'elapsed_s': round(self.elapsed if self.elapsed is not None
+                               else time.monotonic() - self.start, 1) if self.start else None,
+            'cores': self.cores,
+            'returncode': self.returncode,
+            'model_dir': os.path.join(self.dir, 'model'),
+        }
+
+
+def should_prune(trial, trials, metric, prune_after, min_trials):
+    """中位数剪枝：最新epoch的最佳指标低于其他已到达该epoch的试验的中位数时剪枝"""
+    if not trial.evals:
+        return False
+    epoch = max(trial.evals)
+    if epoch < prune_after:
+        return False
+    peers = [other.best(metric, upto=epoch)[0] for other in trials
+             if other is not trial and other.evals and max(other.evals) >= epoch]
+    peers = [value for value in peers if value is not None]
+    value = trial.best(metric, upto=epoch)[0]
+    if value is None or len(peers) + 1 < min_trials:
+        return False
+    return value < statistics.median(peers)
+
+
+def prepare_shared_data(train_argv, shared_argv):
+    """在父进程中准备一次数据集，之后各试验以 --reuse-prepared 直接使用"""
+    args = build_parser().parse_args(train_argv + shared_argv)
+    load_datasets(args, preprocess=None)
+
+
+def shared_data_argv(train_args, defaults, data_dir):
+    """各试验共用的数据位置：未显式指定的清单、预处理缓存和分片目录都放到 data_dir 下"""
+    argv = ['--data-dir', data_dir]
+    if train_args.manifest == defaults.manifest:
+        argv += ['--manifest', os.path.join(data_dir, 'manifest.npz')]
+    if train_args.dataset_mode == 'shards':
+        if train_args.shard_dir == defaults.shard_dir:
+            argv += ['--shard-dir', os.path.join(data_dir, 'shards')]
+    elif not train_args.preprocessed_cache:
+        argv += ['--preprocessed-cache', os.path.join(data_dir, 'preprocessed_cache')]
+    return argv
+
+
+def write_leaderboard(path, trials, metric, config):
+    rows = sorted((trial.summary(metric) for trial in trials),
+                  key=lambda row: (row['best_' + metric] is None, -(row['best_' + metric] or 0)))
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'config': config, 'metric': metric, 'trials': rows}, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+    return rows
+
+
+def print_leaderboard(rows, metric):
+    print(f"{'排名':<6}{'试验':<10}{'状态':<12}{metric:>10}{'最佳epoch':>12}{'epoch数':>10}{'耗时(s)':>10}  参数")
+    for rank, row in enumerate(rows, 1):
+        best = row['best_' + metric]
+        best = f"{best * 100:.2f}%" if best is not None else '-'
+        params = ' '.join(f"{name}={value}" for name, value in row['params'].items())
+        print(f"{rank:<6}{row['trial']:<10}{row['status']:<12}{best:>10}{str(row['best_epoch'] or '-'):>12}"
+              f"{row['epochs']:>10}{str(row['elapsed_s']):>10}  {params}")
+
+
+def run_sweep(args, train_argv):
+    grid = parse_grid(args.grid)
+    combos = expand_trials(grid, args.max_trials, args.seed)
+    os.makedirs(args.work_dir, exist_ok=True)
+    data_dir = os.path.join(args.work_dir, 'data')
+
+    parser = build_parser()
+    defaults = parser.parse_args([])
+    train_args = parser.parse_args(train_argv + ['--train', args.train])
+    # 并行试验各自只有少量核心，未指定时每个试验只用1个DataLoader worker
+    if train_args.workers == defaults.workers:
+        train_argv = train_argv + ['--workers', '1']
+    shared_argv = ['--train', args.train] + shared_data_argv(train_args, defaults, data_dir)
+
+    start = time.monotonic()
+    print(f"准备共用数据集: {data_dir}")
+    prepare_shared_data(train_argv, shared_argv)
+    print(f"数据集准备完成，耗时 {time.monotonic() - start:.1f}s；共 {len(combos)} 个试验，并行 {args.parallel} 个")
+
+    trials = [Trial(f'trial-{i:03d}', params, os.path.join(args.work_dir, f'trial-{i:03d}'))
+              for i, params in enumerate(combos)]
+    slots = split_cores(args.parallel)
+    config = {
+        'train': args.train,
+        'grid': dict(grid),
+        'train_args': train_argv,
+        'parallel': args.parallel,
+        'core_slots': slots,
+        'prune': not args.no_prune,
+        'prune_after': args.prune_after,
+        'prune_min_trials': args.prune_min_trials,
+    }
+    leaderboard_path = os.path.join(args.work_dir, 'leaderboard.json')
+    pending = deque(trials)
+    running = {}  # 核心组下标 -> 试验
+    try:
+        while pending or running:
+            for slot, cores in enumerate(slots):
+                if slot not in running and pending:
+                    trial = pending.popleft()
+                    trial.launch(train_argv, shared_argv, cores)
+                    running[slot] = trial
+                    print(f"启动 {trial.id}（核心 {cores}）: {trial.params}")
+            time.sleep(args.poll)
+            for slot, trial in list(running.items()):
+                if trial.read_evals() and not args.no_prune and \
+                        should_prune(trial, trials, args.metric, args.prune_after, args.prune_min_trials):
+                    epoch = max(trial.evals)
+                    print(f"剪枝 {trial.id}: 第 {epoch} 个epoch的 {args.metric} "
+                          f"{trial.best(args.metric, upto=epoch)[0]:.4f} 低于其他试验的中位数")
+                    trial.stop('pruned')
+                if trial.process.poll() is not None:
+                    trial.finish()
+                    del running[slot]
+                    print(f"{trial.id} 结束: {trial.status}，最佳 {args.metric} {trial.best(args.metric)[0]}")
+                    write_leaderboard(leaderboard_path, trials, args.metric, config)
+    except KeyboardInterrupt:
+        print("中断，终止运行中的试验")
+        for trial in running.values():
+            trial.stop('interrupted')
+            trial.finish()
+
+    rows = write_leaderboard(leaderboard_path, trials, args.metric, config)
+    print(f"搜索完成，耗时 {time.monotonic() - start:.1f}s，排行榜: {leaderboard_path}")
+    print_leaderboard(rows, args.metric)
+    return rows
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    train_argv = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, train_argv = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser()
+
+    # 数据和工作目录（共用数据集、各试验的模型/检查点/指标、排行榜）
+    parser.add_argument('--train', type=str, required=True)
+    parser.add_argument('--work-dir', type=str, default='sweep_runs')
+
+    # 搜索范围：--grid name=v1,v2 可重复，name 为 train.py 的参数名
+    parser.add_argument('--grid', type=str, action='append', required=True)
+    parser.add_argument('--max-trials', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+
+    # 并行与核心划分
+    parser.add_argument('--parallel', type=int, default=2)
+    parser.add_argument('--poll', type=float, default=5)
+
+    # 剪枝：从第 --prune-after 个epoch起，至少 --prune-min-trials 个试验到达同一epoch时按中位数剪枝
+    parser.add_argument('--metric', type=str, default='top1')
+    parser.add_argument('--prune-after', type=int, default=1)
+    parser.add_argument('--prune-min-trials', type=int, default=3)
+    parser.add_argument('--no-prune', action='store_true')
+
+    args = parser.parse_args(argv)
+    run_sweep(args, train_argv)
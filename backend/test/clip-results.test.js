@@ -0,0 +1,36 @@
+const test = require('node:test');
+const assert = require('node:assert');
+const { mergeClipResults } = require('../clip-results');
+
+const images = [
+  { id: 1, file_path: 'user1/red-dress.jpg', s3_url: 'https://bucket/red-dress.jpg' },
+  { id: 2, file_path: 'user1/blue-shirt.jpg', s3_url: null },
+  { id: 3, file_path: 'user1/green-coat.jpg', s3_url: null },
+];
+
+test('min_score 按CLIP相似度过滤，不受RRF融合分数的量级影响', () => {
+  // CLIP 服务 hybrid + rrf 模式的输出：按 fused_score 降序，fused_score 远小于默认阈值 0.155
+  const clipResults = [
+    { path: 'uploads/blue-shirt.jpg', score: 0.21, fused_score: 0.0325, lexical_score: 3.2 },
+    { path: 'uploads/red-dress.jpg', score: 0.24, fused_score: 0.0164, lexical_score: 0 },
+    { path: 'uploads/green-coat.jpg', score: 0.12, fused_score: 0.0161, lexical_score: 0 },
+  ];
+  const results = mergeClipResults(clipResults, images, 0.155);
+  assert.deepStrictEqual(results.map(r => r.id), [2, 1]);
+  assert.strictEqual(results[0].score, 0.21);
+  assert.strictEqual(results[0].fused_score, 0.0325);
+  assert.strictEqual(results[0].lexical_score, 3.2);
+});
+
+test('linear融合不改变阈值的含义', () => {
+  // CLIP相似度 0.16 没有词法命中时融合分数为 0.144，仍应保留
+  const clipResults = [{ path: 'user1/green-coat.jpg', score: 0.16, fused_score: 0.144, lexical_score: 0 }];
+  const results = mergeClipResults(clipResults, images, 0.155);
+  assert.strictEqual(results.length, 1);
+  assert.strictEqual(results[0].url, 'http://57.181.23.46/user1/green-coat.jpg');
+});
+
+test('未启用词法融合时结果格式不变', () => {
+  const results = mergeClipResults([{ path: 'uploads/red-dress.jpg', score: 0.3 }], images, 0.155);
+  assert.deepStrictEqual(Object.keys(results[0]).sort(), ['file_path', 'id', 's3_url', 'score', 'url']);
+});
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+class Budget:
+    """与 clip_server.SearchBudget 相同的接口：exhausted() 在取消后为真"""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def exhausted(self):
+        return self.cancelled.is_set()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            raise AssertionError('等待超时')
+        time.sleep(0.01)
+
+
+class Queue:
+    """占住唯一的执行名额，依次提交排队请求，释放后记录各请求获得名额的顺序"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.order = []
+        self.errors = []
+        self.threads = []
+        self.holder = controller.admit('holder')
+        self.holder.__enter__()
+
+    def submit(self, name, user, priority='interactive', budget=None):
+        def run():
+            try:
+                with self.controller.admit(user, priority, budget):
+                    self.order.append(name)
+            except AdmissionRejected as e:
+                self.errors.append((name, e))
+
+        queued = self.controller.queued
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        # 等它进入队列再提交下一个，保证入队顺序确定
+        wait_until(lambda: self.controller.queued > queued or not thread.is_alive())
+        return thread
+
+    def release(self):
+        self.holder.__exit__(None, None, None)
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+
+def test_priority_order():
+    queue = Queue(AdmissionController(max_concurrency=1))
+    queue.submit('indexing', 'u1', 'indexing')
+    queue.submit('bulk', 'u2', 'bulk')
+    queue.submit('interactive', 'u3', 'interactive')
+    queue.release()
+    assert queue.order == ['interactive', 'bulk', 'indexing']
+
+
+def test_round_robin_between_users():
+    queue = Queue(AdmissionController(max_concurrency=1))
+    for i in range(3):
+        queue.submit(f'a{i}', 'a')
+    for i in range(2):
+        queue.submit(f'b{i}', 'b')
+    queue.release()
+    assert queue.order == ['a0', 'b0', 'a1', 'b1', 'a2']
+
+
+def test_queue_full_and_user_limit_rejected():
+    controller = AdmissionController(max_concurrency=1, max_queue=2, max_queue_per_user=1)
+    queue = Queue(controller)
+    queue.submit('a0', 'a')
+    with pytest.raises(AdmissionRejected) as user_limit:
+        with controller.admit('a'):
+            pass
+    queue.submit('b0', 'b')
+    with pytest.raises(AdmissionRejected) as queue_full:
+        with controller.admit('c'):
+            pass
+    assert user_limit.value.retry_after >= 1 and queue_full.value.retry_after >= 1
+    queue.release()
+    assert queue.order == ['a0', 'b0']
+    counters = controller.metrics()['counters']
+    assert counters['rejected_user_limit'] == 1
+    assert counters['rejected_queue_full'] == 1
+
+
+def test_cancelled_budget_expires_in_queue():
+    controller = AdmissionController(max_concurrency=1)
+    queue = Queue(controller)
+    budget = Budget()
+    thread = queue.submit('cancelled', 'a', budget=budget)
+    queue.submit('kept', 'b')
+    budget.cancelled.set()
+    thread.join(timeout=5)
+    assert [name for name, _ in queue.errors] == ['cancelled']
+    assert controller.queued == 1
+    queue.release()
+    assert queue.order == ['kept']
+    metrics = controller.metrics()
+    assert metrics['counters']['expired_in_queue'] == 1
+    assert metrics['queued'] == 0 and metrics['in_flight'] == 0
@@ -0,0 +1,125 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from embedding_store import CODECS, EmbeddingStore, file_signatures, import_corpus
+
+DIM = 16
+
+
+def unit_vectors(n, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def open_store(directory, codec='fp32', fingerprint='model-a'):
+    # PQ码本累计8个向量后训练，测试同时覆盖训练前的fp32暂存和训练后的PQ码
+    return EmbeddingStore(str(directory), DIM, codec=codec, pq_subspaces=4, pq_train_size=8,
+                          model_fingerprint=fingerprint)
+
+
+def write_image(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+@pytest.mark.parametrize('codec', list(CODECS))
+def test_add_score_reopen(tmp_path, codec):
+    ids = [f'images/{i}.jpg' for i in range(12)]
+    vectors = unit_vectors(len(ids))
+    store = open_store(tmp_path, codec)
+    store.add(ids[:6], vectors[:6])
+    store.add(ids[6:], vectors[6:])
+    assert len(store) == len(ids)
+    assert store.missing(ids + ['images/new.jpg']) == ['images/new.jpg']
+
+    query = vectors[3]
+    found, scores = store.score(query, ids[::-1])
+    assert found == ids[::-1]
+    np.testing.assert_allclose(scores, vectors[::-1] @ query, atol=0.1 if codec == 'pq' else 0.02)
+    # 压缩编码下与查询自身的相似度仍是最高的
+    assert found[int(np.argmax(scores))] == ids[3]
+
+    # 重新打开只需映射已有文件，内容不变；重复加入的id被忽略
+    reopened = open_store(tmp_path, codec)
+    assert len(reopened) == len(ids)
+    reopened.add(ids[:2], vectors[:2])
+    assert len(reopened) == len(ids)
+    found_again, scores_again = reopened.score(query, ids[::-1])
+    assert found_again == found
+    np.testing.assert_allclose(scores_again, scores, atol=1e-6)
+
+
+def test_replaced_file_is_reencoded(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    path = write_image(images / 'a.jpg', b'old')
+    other = write_image(images / 'b.jpg', b'other')
+    old, new, second = unit_vectors(3)
+    store = open_store(tmp_path / 'store')
+    store.add([path, other], np.stack([old, second]), file_signatures([path, other]))
+    assert store.missing([path, other], file_signatures([path, other])) == []
+
+    # 同一路径换成另一张图片：大小和修改时间都变了
+    write_image(images / 'a.jpg', b'replaced image')
+    os.utime(path, ns=(1, 1))
+    signatures = file_signatures([path, other])
+    assert store.missing([path, other], signatures) == [path]
+    found, _ = store.score(old, [path, other], signatures=signatures)
+    assert found == [other]
+
+    # 重新编码后以最新的一行为准，重新打开后也一样
+    store.add([path], new[None], signatures[:1])
+    assert store.missing([path, other], signatures) == []
+    for current in (store, open_store(tmp_path / 'store')):
+        found, scores = current.score(new, [path], signatures=signatures[:1])
+        assert found == [path]
+        assert scores[0] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_model_fingerprint_change_clears_store(tmp_path):
+    ids = ['a.jpg', 'b.jpg']
+    store = open_store(tmp_path, fingerprint='model-a')
+    store.add(ids, unit_vectors(2))
+    assert len(open_store(tmp_path, fingerprint='model-a')) == 2
+
+    rebuilt = open_store(tmp_path, fingerprint='model-b')
+    assert len(rebuilt) == 0
+    assert rebuilt.missing(ids) == ids
+    with open(tmp_path / 'meta.json', 'r') as f:
+        assert json.load(f)['model_fingerprint'] == 'model-b'
+
+    # 指纹之外的配置不同时拒绝打开，而不是清空
+    with pytest.raises(ValueError):
+        open_store(tmp_path, codec='fp16', fingerprint='model-b')
+
+
+def write_corpus(directory, ids, vectors, fingerprint):
+    os.makedirs(directory)
+    vectors.astype(np.float16).tofile(os.path.join(directory, 'embeddings.f16'))
+    with open(os.path.join(directory, 'ids.txt'), 'w', encoding='utf-8') as f:
+        f.write(''.join(image_id + '\n' for image_id in ids))
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({'count': len(ids), 'dim': DIM, 'dtype': 'float16', 'model_fingerprint': fingerprint}, f)
+    return str(directory)
+
+
+def test_import_corpus_once(tmp_path):
+    ids = ['a.jpg', 'b.jpg', 'c.jpg']
+    vectors = unit_vectors(len(ids))
+    corpus_dir = write_corpus(tmp_path / 'corpus', ids, vectors, 'model-a')
+    store = open_store(tmp_path / 'store')
+    assert import_corpus(store, corpus_dir, 'images/') == len(ids)
+    found, scores = store.score(vectors[1], ['images/' + image_id for image_id in ids])
+    assert len(found) == len(ids)
+    assert found[int(np.argmax(scores))] == 'images/b.jpg'
+
+    # 再次启动时跳过已导入的语料；换模型时存储连同导入登记一起清空，旧模型的语料被拒绝
+    assert import_corpus(open_store(tmp_path / 'store'), corpus_dir, 'images/') == len(ids)
+    assert len(open_store(tmp_path / 'store')) == len(ids)
+    with pytest.raises(ValueError):
+        import_corpus(open_store(tmp_path / 'store', fingerprint='model-b'), corpus_dir, 'images/')
+    assert not os.path.exists(tmp_path / 'store' / 'corpus.json')
@@ -1,16 +1,37 @@
 import os
+import io
+import math
+import hashlib
+import contextlib
+import time
 import json
+import random
+import shutil
+import tarfile
+import threading
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.distributed.nn as dist_nn
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
 import clip
 from PIL import Image
 import argparse
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 import logging
 import zipfile
 import boto3
 import numpy as np
 from tqdm import tqdm
+from serving import (rgb_image, load_image_uint8, normalize_batch, Uint8Preprocess, export_serving_weights,
+                     artifact_fingerprint, build_serving_model)
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -38,83 +59,388 @@ def extract_dataset(input_data_dir):
         logger.info("未找到ZIP文件，使用输入目录作为数据集目录")
         return input_data_dir
 
-def prepare_dataset(data_dir):
-    """准备数据集，划分为训练、验证和测试集"""
-    logger.info(f"正在准备数据集: {data_dir}")
+class LocalFiles:
+    """本地文件系统上的数据集文件，路径即文件路径"""
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def stream(self, path):
+        """只顺序读取的文件对象"""
+        return open(path, 'rb')
+
+    def signature(self, path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+
+class ZipSource:
+    """不解压、直接从ZIP中读取数据集文件
+
+    路径是相对annotations.json所在目录的成员名。ZipFile句柄在每个进程中按需打开，
+    DataLoader的worker进程各自持有自己的句柄。
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            infos = [info for info in zf.infolist() if not info.is_dir()]
+        # ZIP里可能带一层顶级目录，以annotations.json所在目录为根
+        annotations = [info.filename for info in infos
+                       if os.path.basename(info.filename) == 'annotations.json']
+        self.prefix = min(annotations, key=len)[:-len('annotations.json')] if annotations else ''
+        self.members = {
+            info.filename[len(self.prefix):]: (info.file_size, info.CRC)
+            for info in infos if info.filename.startswith(self.prefix)
+        }
+        self._zf = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_zf'] = None
+        state['_pid'] = None
+        return state
+
+    def _zipfile(self):
+        if self._zf is None or self._pid != os.getpid():
+            self._zf = zipfile.ZipFile(self.zip_path, 'r')
+            self._pid = os.getpid()
+        return self._zf
+
+    def exists(self, path):
+        return path in self.members
+
+    def open(self, path):
+        return io.BytesIO(self._zipfile().read(self.prefix + path))
+
+    def stream(self, path):
+        """边解压边读取，不把整个成员读入内存（不支持高效的seek）"""
+        return self._zipfile().open(self.prefix + path)
+
+    def signature(self, path):
+        return self.members[path]
+
+def open_dataset_source(input_data_dir, mode='extract'):
+    """按数据集读取方式返回 (source, data_dir)
+
+    extract: 解压ZIP到/tmp/dataset（原有方式）；zip/shards: 直接从ZIP读取，不解压。
+    输入目录中没有ZIP时都直接使用输入目录。
+    """
+    if mode == 'extract':
+        return LocalFiles(), extract_dataset(input_data_dir)
+    zip_files = sorted(f for f in os.listdir(input_data_dir) if f.endswith('.zip'))
+    if not zip_files:
+        logger.info("未找到ZIP文件，使用输入目录作为数据集目录")
+        return LocalFiles(), input_data_dir
+    zip_path = os.path.join(input_data_dir, zip_files[0])
+    source = ZipSource(zip_path)
+    logger.info(f"直接从ZIP读取数据集: {zip_path}（{len(source.members)} 个文件）")
+    return source, ''
+
+class _JsonStream:
+    """按块读取的JSON文本，raw_decode逐个解析其中的值，内存占用与单个值的大小有关，与文件大小无关"""
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = io.TextIOWrapper(f, encoding='utf-8-sig')
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """跳过空白，返回下一个字符（文件结束时为空字符串）"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"JSON格式错误: 期望 {char!r}，实际为 {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # 值恰好在缓冲区末尾时可能被截断（如数字），读入更多再解析
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def array_items(self):
+        """逐个产出当前位置数组的元素"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect(']')
+            return
+
+def iter_annotations(f):
+    """流式读取annotations.json（二进制文件对象）中的标注记录
+
+    支持顶层为记录数组，或顶层对象中的 "images" 数组；对象中的其他字段逐个解析后丢弃。
+    """
+    stream = _JsonStream(f)
+    if stream.peek() == '[':
+        yield from stream.array_items()
+        return
+    stream.expect('{')
+    while stream.peek() != '}':
+        key = stream.value()
+        stream.expect(':')
+        if key == 'images':
+            yield from stream.array_items()
+            return
+        stream.value()
+        if stream.peek() == ',':
+            stream.pos += 1
+    raise ValueError("annotations.json 中没有标注数组")
+
+SPLIT_RATIOS = (('train', 0.7), ('val', 0.15), ('test', 0.15))
+
+def assign_split(image_path, seed=0):
+    """按图片路径的稳定哈希分配到train/val/test（70/15/15），与记录顺序和运行次数无关"""
+    digest = hashlib.md5(f'{seed}/{image_path}'.encode('utf-8')).digest()
+    u = int.from_bytes(digest[:8], 'big') / 2 ** 64
+    for split, ratio in SPLIT_RATIOS:
+        if u < ratio:
+            return split
+        u -= ratio
+    return SPLIT_RATIOS[-1][0]
+
+def split_annotations(f, outputs, seed=0):
+    """把标注流式划分并写入 outputs[split]（文本文件对象）的JSONL中，返回各划分的记录数及无效记录数"""
+    counts = {split: 0 for split, _ in SPLIT_RATIOS}
+    invalid = 0
+    for item in iter_annotations(f):
+        # 过滤并只保留必要的字段
+        if not (isinstance(item, dict) and 'image_path' in item and 'product_title' in item):
+            invalid += 1
+            continue
+        split = assign_split(item['image_path'], seed)
+        record = {'image_path': item['image_path'], 'product_title': item['product_title']}
+        outputs[split].write(json.dumps(record) + '\n')
+        counts[split] += 1
+    return counts, invalid
+
+def prepare_dataset(data_dir, source=None, seed=0, output_dir='/tmp/data'):
+    """流式读取标注，按图片路径的哈希划分为训练、验证和测试集并写成JSONL
+
+    内存占用与标注文件大小无关；同一份标注（和seed）每次得到相同的划分。
+    划分结果和图片来源同时记录在 output_dir/prepared.json 中，可由 load_prepared_dataset 直接复用。
+    """
+    source = source or LocalFiles()
+    logger.info(f"正在准备数据集: {data_dir or getattr(source, 'zip_path', '')}")
     
     # 查找annotations.json文件
     annotations_path = os.path.join(data_dir, 'annotations.json')
-    if not os.path.exists(annotations_path):
+    if not source.exists(annotations_path):
         logger.error(f"找不到annotations.json文件: {annotations_path}")
         raise FileNotFoundError(f"找不到annotations.json文件: {annotations_path}")
     
-    # 读取JSON文件
-    with open(annotations_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    # 检查文件结构
-    if isinstance(data, dict) and 'images' in data:
-        # 如果是嵌套结构，提取images列表
-        data = data['images']
-    
-    # 过滤并只保留必要的字段
-    filtered_data = []
-    for item in data:
-        if isinstance(item, dict) and 'image_path' in item and 'product_title' in item:
-            filtered_data.append({
-                'image_path': item['image_path'],
-                'product_title': item['product_title']
-            })
-    
-    # 打乱并划分数据集
-    np.random.shuffle(filtered_data)
-    n = len(filtered_data)
-    train_data = filtered_data[:int(0.7 * n)]
-    val_data = filtered_data[int(0.7 * n):int(0.85 * n)]
-    test_data = filtered_data[int(0.85 * n):]
-    
-    # 创建JSON文件
-    os.makedirs('/tmp/data', exist_ok=True)
-    
-    def save_jsonl(data, filepath):
-        with open(filepath, 'w', encoding='utf-8') as f:
-            for item in data:
-                f.write(json.dumps(item) + '\n')
-    
-    train_path = '/tmp/data/train_data.json'
-    val_path = '/tmp/data/val_data.json'
-    test_path = '/tmp/data/test_data.json'
-    
-    save_jsonl(train_data, train_path)
-    save_jsonl(val_data, val_path)
-    save_jsonl(test_data, test_path)
-    
-    logger.info(f"数据集已划分: 训练集 {len(train_data)}, 验证集 {len(val_data)}, 测试集 {len(test_data)}")
-    return {
-        'train_path': train_path,
-        'val_path': val_path,
-        'test_path': test_path,
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {split: os.path.join(output_dir, f'{split}_data.json') for split, _ in SPLIT_RATIOS}
+    with contextlib.ExitStack() as stack:
+        outputs = {split: stack.enter_context(open(path, 'w', encoding='utf-8')) for split, path in paths.items()}
+        with source.stream(annotations_path) as f:
+            counts, invalid = split_annotations(f, outputs, seed)
+    
+    if invalid:
+        logger.warning(f"跳过 {invalid} 条缺少 image_path 或 product_title 的标注")
+    logger.info(f"数据集已划分: 训练集 {counts['train']}, 验证集 {counts['val']}, 测试集 {counts['test']}")
+    dataset_paths = {
+        'train_path': paths['train'],
+        'val_path': paths['val'],
+        'test_path': paths['test'],
         'image_dir': os.path.join(data_dir, 'images')
     }
+    with open(os.path.join(output_dir, 'prepared.json'), 'w') as f:
+        json.dump({'dataset_paths': dataset_paths, 'zip_path': getattr(source, 'zip_path', None)}, f)
+    return dataset_paths
+
+def load_prepared_dataset(output_dir):
+    """读取 prepare_dataset 已经写好的划分，返回 (source, dataset_paths)，不重新解压和划分"""
+    with open(os.path.join(output_dir, 'prepared.json'), 'r') as f:
+        prepared = json.load(f)
+    source = ZipSource(prepared['zip_path']) if prepared['zip_path'] else LocalFiles()
+    return source, prepared['dataset_paths']
+
+def image_candidates(item, image_root):
+    """标注对应图片的候选路径：先按文件名查找，再按原始路径查找"""
+    candidates = [os.path.join(image_root, os.path.basename(item['image_path'])),
+                  os.path.join(image_root, item['image_path'])]
+    return tuple(dict.fromkeys(candidates))
+
+def inspect_image(data):
+    """读取图片头部得到宽高并检查文件结构，返回 (width, height, ok)"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            image.verify()
+        return width, height, True
+    except Exception:
+        return 0, 0, False
+
+class _ManifestDataset(Dataset):
+    """构建数据集清单时用于并行查找、校验图片的数据集
+
+    每一项为一条标注的候选路径，返回 (路径, 签名, 校验结果)；签名与known中相同时不读取文件，校验结果为None。
+    """
+
+    def __init__(self, candidates, source, known):
+        self.candidates = candidates
+        self.source = source
+        self.known = known
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __getitem__(self, idx):
+        for path in self.candidates[idx]:
+            try:
+                sig = tuple(self.source.signature(path))
+            except (OSError, KeyError):
+                continue
+            if self.known.get(path) == sig:
+                return path, sig, None
+            with self.source.open(path) as f:
+                data = f.read()
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            return path, sig, inspect_image(data) + (digest,)
+        return None, None, None
+
+class DatasetManifest:
+    """数据集图片清单：每张图片的签名、宽高、内容哈希以及能否解码
+
+    按列保存在一个npz文件中（路径以换行拼接成utf-8字节），之后的运行直接加载。
+    重新构建时签名（本地文件为大小和修改时间，ZIP成员为大小和CRC）未变化的图片沿用上次的结果，不再读取文件。
+    """
+
+    COLUMNS = ('size', 'stamp', 'width', 'height', 'ok', 'digest')
+
+    def __init__(self, paths, columns):
+        self.paths = paths
+        self.columns = columns
+        self.row_of = {path: row for row, path in enumerate(paths)}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.row_of
+
+    def ok(self, path):
+        return bool(self.columns['ok'][self.row_of[path]])
+
+    @classmethod
+    def load(cls, manifest_path):
+        with np.load(manifest_path) as data:
+            paths = data['paths'].tobytes().decode('utf-8').split('\n') if data['paths'].size else []
+            return cls(paths, {name: data[name] for name in cls.COLUMNS})
+
+    def save(self, manifest_path):
+        os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+        with open(manifest_path + '.tmp', 'wb') as f:
+            np.savez(f, paths=np.frombuffer('\n'.join(self.paths).encode('utf-8'), dtype=np.uint8),
+                     **self.columns)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    @classmethod
+    def build(cls, manifest_path, jsonl_paths, image_root, source=None, workers=0, batch_size=256):
+        """查找并校验各JSONL中所有标注对应的图片，写入manifest_path"""
+        source = source or LocalFiles()
+        start = time.perf_counter()
+        candidates = []
+        for jsonl_path in jsonl_paths:
+            with open(jsonl_path, 'r') as f:
+                candidates.extend(image_candidates(json.loads(line), image_root) for line in f)
+        candidates = list(dict.fromkeys(candidates))
+
+        previous = None
+        known = {}
+        if os.path.exists(manifest_path):
+            try:
+                previous = cls.load(manifest_path)
+                known = {path: (int(size), int(stamp)) for path, size, stamp in
+                         zip(previous.paths, previous.columns['size'], previous.columns['stamp'])}
+            except Exception as e:
+                logger.warning(f"无法读取已有的数据集清单 {manifest_path}，重新构建: {e}")
+
+        rows = {}
+        missing = reused = 0
+        loader = DataLoader(_ManifestDataset(candidates, source, known),
+                            batch_size=batch_size, num_workers=workers, collate_fn=list)
+        for results in tqdm(loader, desc="校验数据集图片"):
+            for path, sig, info in results:
+                if path is None:
+                    missing += 1
+                elif path not in rows:
+                    if info is None:
+                        row = previous.row_of[path]
+                        rows[path] = tuple(previous.columns[name][row] for name in cls.COLUMNS)
+                        reused += 1
+                    else:
+                        rows[path] = sig + info
+
+        paths = list(rows)
+        values = list(zip(*rows.values())) or [()] * len(cls.COLUMNS)
+        dtypes = (np.int64, np.int64, np.int32, np.int32, np.bool_, 'S16')
+        manifest = cls(paths, {name: np.array(column, dtype=dtype)
+                               for name, column, dtype in zip(cls.COLUMNS, values, dtypes)})
+        manifest.save(manifest_path)
+        corrupt = int((~manifest.columns['ok']).sum())
+        logger.info(f"数据集清单: {len(paths)} 张图片（沿用 {reused} 张，新校验 {len(paths) - reused} 张），"
+                    f"{missing} 条标注找不到图片，{corrupt} 张图片损坏，耗时 {time.perf_counter() - start:.1f}s")
+        return manifest
 
 class FashionDataset(Dataset):
-    def __init__(self, jsonl_path, image_root, preprocess_fn):
+    def __init__(self, jsonl_path, image_root, preprocess_fn, source=None, manifest=None):
+        """manifest 为 DatasetManifest 时按清单查找图片并跳过损坏的图片，不再逐条检查文件是否存在"""
         self.image_paths = []
         self.texts = []
         self.preprocess = preprocess_fn
+        self.source = source or LocalFiles()
+        skipped = 0
         
         # 读取JSONL文件
         with open(jsonl_path, 'r') as f:
             for line in f:
                 item = json.loads(line)
-                img_name = os.path.basename(item['image_path'])
-                img_path = os.path.join(image_root, img_name)
-                
-                if not os.path.exists(img_path):
-                    # 尝试从原始路径加载
-                    img_path = os.path.join(image_root, item['image_path'])
-                    if not os.path.exists(img_path):
+                # 先按文件名查找，再尝试原始路径
+                if manifest is not None:
+                    img_path = next((path for path in image_candidates(item, image_root) if path in manifest), None)
+                    if img_path is not None and not manifest.ok(img_path):
+                        skipped += 1
                         continue
+                else:
+                    img_path = next((path for path in image_candidates(item, image_root)
+                                     if self.source.exists(path)), None)
+                if img_path is None:
+                    continue
                 
                 # 使用product_title作为caption
                 caption = f"{item['product_title'][:77]}"
@@ -123,189 +449,1590 @@ class FashionDataset(Dataset):
         
         # 一次性tokenize文本
         self.tokenized_texts = clip.tokenize(self.texts)
-        logger.info(f"加载了 {len(self.image_paths)} 个图像-文本对")
+        logger.info(f"加载了 {len(self.image_paths)} 个图像-文本对" + (f"，跳过 {skipped} 张损坏的图片" if skipped else ""))
 
     def __len__(self):
         return len(self.image_paths)
 
     def __getitem__(self, idx):
         try:
-            image = self.preprocess(Image.open(self.image_paths[idx]).convert("RGB"))
+            with self.source.open(self.image_paths[idx]) as f:
+                image = self.preprocess(rgb_image(Image.open(f)))
             text = self.tokenized_texts[idx]
             return image, text
         except Exception as e:
             logger.error(f"加载图像错误 {self.image_paths[idx]}: {e}")
             # 返回一个替代项
-            return torch.zeros(3, 224, 224), self.tokenized_texts[0]
+            return blank_image(self.preprocess), self.tokenized_texts[0]
 
-def evaluate(model, val_dataset, device, topk=(1, 5, 10)):
-    model.eval()
+def blank_image(preprocess_fn):
+    """图片加载失败时的替代图像，格式与 preprocess_fn 的输出一致"""
+    if isinstance(preprocess_fn, Uint8Preprocess):
+        return torch.zeros(preprocess_fn.size, preprocess_fn.size, 3, dtype=torch.uint8)
+    return torch.zeros(3, 224, 224)
+
+def prepare_images(images, device, channels_last=False):
+    """把DataLoader给出的图像批次转成模型输入；来自预处理缓存的uint8批次在这里统一归一化"""
+    images = images.to(device)
+    if images.dtype == torch.uint8:
+        images = normalize_batch(images)
+    if channels_last:
+        images = images.contiguous(memory_format=torch.channels_last)
+    return images
+
+class _DecodeDataset(Dataset):
+    """构建预处理缓存时用于并行解码的数据集"""
+
+    def __init__(self, image_paths, size, source):
+        self.image_paths = image_paths
+        self.size = size
+        self.source = source
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        try:
+            with self.source.open(self.image_paths[idx]) as f:
+                return torch.from_numpy(load_image_uint8(f, self.size)), True
+        except Exception as e:
+            logger.error(f"加载图像错误 {self.image_paths[idx]}: {e}")
+            return torch.zeros(self.size, self.size, 3, dtype=torch.uint8), False
+
+class PreprocessedImageCache:
+    """预处理后的图像缓存
+
+    cache_dir/images.u8 按行保存 N×size×size×3 的uint8图像（memmap读取），
+    cache_dir/index.json 保存每行对应的图片路径及其签名（本地文件为大小和修改时间，ZIP成员为大小和CRC），
+    签名变化时重新解码该行。
+    """
+
+    def __init__(self, cache_dir, size=224):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.data_path = os.path.join(cache_dir, 'images.u8')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.paths = []
+        self.signatures = []
+        self.row_of = {}
+        self._array = None
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index['size'] == size:
+                self.paths = index['paths']
+                self.signatures = [tuple(sig) for sig in index['signatures']]
+                self.row_of = {path: row for row, path in enumerate(self.paths)}
+
+    def build(self, image_paths, workers=0, batch_size=64, source=None):
+        """解码缓存中缺失或已变化的图片；已缓存且未变化的图片不再解码"""
+        source = source or LocalFiles()
+        todo = []
+        for path in dict.fromkeys(image_paths):
+            sig = tuple(source.signature(path))
+            row = self.row_of.get(path)
+            if row is None:
+                row = len(self.paths)
+                self.paths.append(path)
+                self.signatures.append(sig)
+                self.row_of[path] = row
+                todo.append(row)
+            elif self.signatures[row] != sig:
+                self.signatures[row] = sig
+                todo.append(row)
+        if not todo:
+            logger.info(f"预处理缓存已是最新: {len(self.paths)} 张图片")
+            return
+
+        logger.info(f"构建预处理缓存: 需要解码 {len(todo)} 张图片，缓存目录 {self.cache_dir}")
+        row_bytes = self.size * self.size * 3
+        with open(self.data_path, 'ab') as f:
+            f.truncate(len(self.paths) * row_bytes)
+        array = np.memmap(self.data_path, dtype=np.uint8, mode='r+',
+                          shape=(len(self.paths), self.size, self.size, 3))
+        loader = DataLoader(_DecodeDataset([self.paths[row] for row in todo], self.size, source),
+                            batch_size=batch_size, num_workers=workers)
+        failed = 0
+        start = 0
+        for images, ok in tqdm(loader, desc="预处理图像"):
+            rows = todo[start:start + len(images)]
+            array[rows] = images.numpy()
+            failed += int((~ok).sum())
+            start += len(images)
+        array.flush()
+        del array
+        self._array = None
+
+        # 解码完成后再写索引，中途中断时下次会重新解码
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump({'size': self.size, 'paths': self.paths,
+                       'signatures': [list(sig) for sig in self.signatures]}, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        logger.info(f"预处理缓存构建完成: 共 {len(self.paths)} 张图片，其中 {failed} 张解码失败（以全零图像代替）")
+
+    def array(self):
+        if self._array is None:
+            self._array = np.memmap(self.data_path, dtype=np.uint8, mode='r',
+                                    shape=(len(self.paths), self.size, self.size, 3))
+        return self._array
+
+    def rows(self, image_paths):
+        return [self.row_of[path] for path in image_paths]
+
+class CachedImageDataset(Dataset):
+    """从预处理缓存读取uint8图像的数据集包装，归一化在训练循环中按批完成"""
+
+    def __init__(self, dataset, cache):
+        self.image_paths = dataset.image_paths
+        self.texts = dataset.texts
+        self.tokenized_texts = dataset.tokenized_texts
+        self.cache = cache
+        self.rows = cache.rows(dataset.image_paths)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        image = torch.from_numpy(np.array(self.cache.array()[self.rows[idx]]))
+        return image, self.tokenized_texts[idx]
+
+def shards_ready(shard_dir):
+    return os.path.exists(os.path.join(shard_dir, 'index.json'))
+
+def convert_to_shards(dataset, shard_dir, shard_size=1000):
+    """把数据集写成若干tar分片，只需转换一次
+
+    每个样本在分片中占两个相邻成员：{key}.jpg 为原始图像字节，{key}.txt 为caption。
+    shard_dir/index.json 记录分片列表、每个分片的样本数以及按顺序排列的全部caption。
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    tar = None
+    # 标注文件可能按类目排列，按固定的随机顺序写入，使每个分片内的样本分布接近整体
+    order = np.random.RandomState(0).permutation(len(dataset))
+    texts = [dataset.texts[i] for i in order]
+    image_paths = [dataset.image_paths[i] for i in order]
+    for i, (path, caption) in enumerate(tqdm(zip(image_paths, texts),
+                                             total=len(dataset), desc=f"写入分片 {shard_dir}")):
+        if i % shard_size == 0:
+            if tar is not None:
+                tar.close()
+            name = f'shard-{len(shards):05d}.tar'
+            shards.append({'name': name, 'count': 0})
+            tar = tarfile.open(os.path.join(shard_dir, name), 'w')
+        key = f'{i:09d}'
+        with dataset.source.open(path) as f:
+            image_bytes = f.read()
+        text_bytes = caption.encode('utf-8')
+        for member, data in ((f'{key}.jpg', image_bytes), (f'{key}.txt', text_bytes)):
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        shards[-1]['count'] += 1
+    if tar is not None:
+        tar.close()
+
+    # 分片全部写完后再写索引，中途中断时下次会重新转换
+    with open(os.path.join(shard_dir, 'index.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump({'shards': shards, 'texts': texts}, f, ensure_ascii=False)
+    os.replace(os.path.join(shard_dir, 'index.json.tmp'), os.path.join(shard_dir, 'index.json'))
+    logger.info(f"已写入 {len(shards)} 个分片，共 {len(dataset)} 个样本: {shard_dir}")
+
+class ShardedTarDataset(IterableDataset):
+    """顺序读取tar分片的流式数据集
+
+    每个DataLoader worker（以及分布式训练中的每个rank）只读取分给自己的分片；
+    shuffle_buffer>0 时每个epoch打乱分片顺序，并在缓冲区内随机抽取样本。
+    shuffle_buffer=0 时按写入顺序输出，顺序与texts/tokenized_texts一致，可用于验证。
+    """
+
+    def __init__(self, shard_dir, preprocess_fn, shuffle_buffer=0, seed=0):
+        with open(os.path.join(shard_dir, 'index.json'), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.shard_dir = shard_dir
+        self.shards = [shard['name'] for shard in index['shards']]
+        self.counts = {shard['name']: shard['count'] for shard in index['shards']}
+        self.texts = index['texts']
+        self.preprocess = preprocess_fn
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.skip_batches = 0
+        self.batch_size = 1
+        self.rank = 0
+        self.world_size = 1
+        self._tokenized_texts = None
+        logger.info(f"加载了 {len(self.shards)} 个分片，共 {len(self.texts)} 个图像-文本对")
+
+    @property
+    def tokenized_texts(self):
+        if self._tokenized_texts is None:
+            self._tokenized_texts = clip.tokenize(self.texts)
+        return self._tokenized_texts
+
+    def set_epoch(self, epoch, skip_batches=0, batch_size=1):
+        """skip_batches为续训时本epoch已经用过的批次数；DataLoader按worker轮流取批次，各worker分别跳过自己的部分"""
+        self.epoch = epoch
+        self.skip_batches = skip_batches
+        self.batch_size = batch_size
+
+    def _rank_shards(self, rank=None, world_size=None):
+        rank = self.rank if rank is None else rank
+        world_size = self.world_size if world_size is None else world_size
+        shards = list(self.shards)
+        if self.shuffle_buffer:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[rank::world_size]
+
+    def __len__(self):
+        return sum(self.counts[name] for name in self._rank_shards())
+
+    def min_rank_length(self):
+        """本epoch各rank分到的样本数中的最小值"""
+        shards = self._rank_shards(rank=0, world_size=1)
+        return min(sum(self.counts[name] for name in shards[r::self.world_size])
+                   for r in range(self.world_size))
+
+    def _samples(self, shards):
+        """按顺序读取分片，成对产出 (图像字节, caption)"""
+        for name in shards:
+            with tarfile.open(os.path.join(self.shard_dir, name), 'r|') as tar:
+                pending = {}
+                for member in tar:
+                    key, ext = os.path.splitext(member.name)
+                    data = tar.extractfile(member).read()
+                    sample = pending.setdefault(key, {})
+                    sample[ext] = data
+                    if len(sample) == 2:
+                        del pending[key]
+                        yield sample['.jpg'], sample['.txt'].decode('utf-8')
+
+    def _decode(self, sample):
+        image_bytes, caption = sample
+        try:
+            image = self.preprocess(rgb_image(Image.open(io.BytesIO(image_bytes))))
+        except Exception as e:
+            logger.error(f"解码分片中的图像错误: {e}")
+            image = blank_image(self.preprocess)
+        return image, clip.tokenize([caption])[0]
+
+    def __iter__(self):
+        shards = self._rank_shards()
+        worker = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker is not None:
+            worker_id, num_workers = worker.id, worker.num_workers
+            shards = shards[worker.id::worker.num_workers]
+        skip = max(0, self.skip_batches - worker_id + num_workers - 1) // num_workers * self.batch_size
+        for i, sample in enumerate(self._shuffled(shards, worker_id)):
+            # 跳过的样本不解码
+            if i >= skip:
+                yield self._decode(sample)
+
+    def _shuffled(self, shards, worker_id):
+        if not self.shuffle_buffer:
+            yield from self._samples(shards)
+            return
+
+        # 缓冲区中保存未解码的原始字节，取出时才解码
+        rng = random.Random(f'{self.seed}-{self.epoch}-{self.rank}-{worker_id}')
+        buffer = []
+        for sample in self._samples(shards):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+def _recall_at_k(queries, keys, topk, block_size):
+    """第i个query的正确结果是第i个key；按块计算相似度，统计正确结果排在前k位的比例
+
+    正确结果的名次 = 相似度严格高于它的key的个数，因此不需要对整行排序，
+    每次只占用 block_size × N 的相似度矩阵。
+    """
+    hits = torch.zeros(len(topk), dtype=torch.long)
+    ks = torch.tensor(topk).view(-1, 1)
+    for start in range(0, len(queries), block_size):
+        block = queries[start:start + block_size]
+        sims = block @ keys.T  # (B, N)
+        rows = torch.arange(len(block))
+        correct = sims[rows, rows + start].unsqueeze(1)
+        ranks = (sims > correct).sum(dim=1)
+        hits += (ranks.unsqueeze(0) < ks).sum(dim=1)
+    return {k: hits[i].item() / len(queries) for i, k in enumerate(topk)}
+
+def embed_dataset(features_model, dataset, device, batch_size=64, workers=0):
+    """按数据集顺序提取所有样本的图片和文本特征，返回归一化的 (N, D) 特征"""
+    all_image_features = []
+    all_text_features = []
     with torch.no_grad():
-        # 提取所有图片特征
-        all_image_features = []
-        for images, _ in DataLoader(val_dataset, batch_size=64):
-            images = images.to(device)
+        for batch in DataLoader(dataset, batch_size=batch_size, num_workers=workers):
+            inputs, _ = split_teacher(prepare_batch(batch, device))
             with torch.amp.autocast(device.type):
-                image_feat = model.encode_image(images)
-                image_feat /= image_feat.norm(dim=-1, keepdim=True)
-            all_image_features.append(image_feat)
-        
-        image_features = torch.cat(all_image_features, dim=0)  # (N_img, D)
-        
-        # 对每个文本提取特征，并匹配所有图像
-        topk_correct = {k: 0 for k in topk}
-        total = len(val_dataset)
+                image_feat, text_feat, _ = features_model(*inputs)
+            all_image_features.append(image_feat.float())
+            all_text_features.append(text_feat.float())
+    image_features = torch.cat(all_image_features, dim=0)
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    text_features = torch.cat(all_text_features, dim=0)
+    text_features /= text_features.norm(dim=-1, keepdim=True)
+    return image_features, text_features
+
+def hard_negative_neighbors(image_features, text_features, k, block_size=1024):
+    """每个样本最相似的k个其他样本，相似度为图片相似度与文本相似度的平均
+
+    标题完全相同的样本对比学习中无法区分，不作为负样本。返回 (N, k) 的下标，不足k个时用-1补齐。
+    """
+    n = len(image_features)
+    k = min(k, n - 1)
+    neighbors = torch.empty(n, k, dtype=torch.long)
+    for start in range(0, n, block_size):
+        text_sims = text_features[start:start + block_size] @ text_features.T
+        sims = (image_features[start:start + block_size] @ image_features.T + text_sims) / 2
+        sims[text_sims >= 1 - 1e-4] = float('-inf')  # 包括样本自身
+        rows = torch.arange(len(sims))
+        sims[rows, rows + start] = float('-inf')
+        values, indices = sims.topk(k, dim=1)
+        indices[values == float('-inf')] = -1
+        neighbors[start:start + len(sims)] = indices
+    return neighbors
+
+def evaluate(model, val_dataset, device, topk=(1, 5, 10), batch_size=64, block_size=1024, features_model=None):
+    """验证集上的检索召回率
+
+    top{k} 为文本检索图像（text→image）的recall@k，i2t_top{k} 为图像检索文本（image→text）的recall@k。
+    features_model 为空时用完整的CLIP模型编码；冻结特征缓存需要传入对应的 FrozenPrefixFeatures。
+    """
+    model.eval()
+    image_features, text_features = embed_dataset(features_model or CLIPFeatures(model), val_dataset, device, batch_size)
+    with torch.no_grad():
+        t2i = _recall_at_k(text_features, image_features, topk, block_size)
+        i2t = _recall_at_k(image_features, text_features, topk, block_size)
+        accs = {f"top{k}": t2i[k] for k in topk}
+        accs.update({f"i2t_top{k}": i2t[k] for k in topk})
+        return accs
+
+class LoRALinear(nn.Module):
+    """在冻结的Linear上叠加低秩增量：y = base(x) + scale·x·Aᵀ·Bᵀ，只训练A和B"""
+
+    def __init__(self, base, rank, alpha):
+        super().__init__()
+        self.base = base
+        self.scale = alpha / rank
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features, device=base.weight.device))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank, device=base.weight.device))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+
+    def forward(self, x):
+        return self.base(x) + (x @ self.lora_A.T @ self.lora_B.T) * self.scale
+
+def configure_peft(model, mode, lora_rank=8, lora_alpha=16, lora_layers=0):
+    """冻结骨干，只保留投影层、logit_scale（lora模式下再加最后lora_layers个残差块MLP上的LoRA）可训练
+
+    返回 (vision_split, text_split)：两个塔中从这个残差块开始才有可训练参数，之前的部分完全冻结。
+    """
+    for param in model.parameters():
+        param.requires_grad_(False)
+    splits = []
+    for blocks in (model.visual.transformer.resblocks, model.transformer.resblocks):
+        split = len(blocks)
+        if mode == 'lora':
+            split = max(0, len(blocks) - lora_layers) if lora_layers else 0
+            for block in list(blocks)[split:]:
+                block.mlp.c_fc = LoRALinear(block.mlp.c_fc, lora_rank, lora_alpha)
+                block.mlp.c_proj = LoRALinear(block.mlp.c_proj, lora_rank, lora_alpha)
+        splits.append(split)
+    model.visual.proj.requires_grad_(True)
+    model.text_projection.requires_grad_(True)
+    model.logit_scale.requires_grad_(True)
+    trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    logger.info(f"{mode} 微调: 可训练参数 {trainable / 1e6:.2f}M，"
+                f"冻结视觉塔前 {splits[0]} 个残差块、文本塔前 {splits[1]} 个残差块")
+    return tuple(splits)
+
+def adapter_state_dict(model):
+    """只包含可训练参数（LoRA、投影层、logit_scale）的权重，用于导出轻量工件"""
+    return {name: param.detach().clone() for name, param in model.named_parameters() if param.requires_grad}
+
+def merge_adapter(model, adapter, lora_scale):
+    """把adapter_state_dict合并进原始CLIP权重：LoRA增量加到对应Linear的权重上，其余参数直接替换"""
+    state = model.state_dict()
+    for name, tensor in adapter.items():
+        if name.endswith('.lora_B'):
+            continue
+        if name.endswith('.lora_A'):
+            prefix = name[:-len('.lora_A')]
+            delta = lora_scale * adapter[prefix + '.lora_B'].float() @ tensor.float()
+            state[prefix + '.weight'] += delta.to(state[prefix + '.weight'].dtype)
+        else:
+            state[name] = tensor
+    model.load_state_dict(state)
+    return model
+
+def encode_image_prefix(visual, images, split):
+    """视觉塔中冻结部分（前split个残差块）的输出；split为全部残差块时输出投影前的池化特征"""
+    x = visual.conv1(images.type(visual.conv1.weight.dtype))
+    x = x.reshape(x.shape[0], x.shape[1], -1).permute(0, 2, 1)
+    x = torch.cat([visual.class_embedding.to(x.dtype) + torch.zeros(x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device), x], dim=1)
+    x = visual.ln_pre(x + visual.positional_embedding.to(x.dtype))
+    blocks = visual.transformer.resblocks
+    x = blocks[:split](x.permute(1, 0, 2)).permute(1, 0, 2)
+    if split == len(blocks):
+        x = visual.ln_post(x[:, 0, :])
+    return x
+
+def encode_image_suffix(visual, x, split):
+    blocks = visual.transformer.resblocks
+    if split < len(blocks):
+        x = blocks[split:](x.permute(1, 0, 2)).permute(1, 0, 2)
+        x = visual.ln_post(x[:, 0, :])
+    return x @ visual.proj
+
+def encode_text_prefix(model, texts, split):
+    """文本塔中冻结部分的输出；split为全部残差块时输出EOT位置投影前的特征"""
+    x = model.token_embedding(texts) + model.positional_embedding
+    blocks = model.transformer.resblocks
+    x = blocks[:split](x.permute(1, 0, 2)).permute(1, 0, 2)
+    if split == len(blocks):
+        x = model.ln_final(x)[torch.arange(x.shape[0]), texts.argmax(dim=-1)]
+    return x
+
+def encode_text_suffix(model, x, eot, split):
+    blocks = model.transformer.resblocks
+    if split < len(blocks):
+        x = blocks[split:](x.permute(1, 0, 2)).permute(1, 0, 2)
+        x = model.ln_final(x)[torch.arange(x.shape[0]), eot]
+    return x @ model.text_projection
+
+class FrozenFeatureDataset(Dataset):
+    """冻结部分输出的缓存：cache_dir/images.f16、texts.f16（fp16 memmap）、eot.npy 和 meta.json"""
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.cache_dir = cache_dir
+        self.eot = np.load(os.path.join(cache_dir, 'eot.npy'))
+        self._arrays = None
+
+    @staticmethod
+    def build(model, dataset, splits, cache_dir, device, batch_size=64, workers=0):
+        """逐批计算并写入冻结部分的输出；数据集和冻结位置不变时复用已有缓存"""
+        fingerprint = hashlib.sha1(json.dumps({
+            'splits': list(splits),
+            'texts': list(dataset.texts),
+            'image_paths': list(getattr(dataset, 'image_paths', [])),
+        }).encode('utf-8')).hexdigest()
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                if json.load(f).get('fingerprint') == fingerprint:
+                    logger.info(f"复用冻结特征缓存: {cache_dir}")
+                    return
         
-        for idx in range(total):
-            text = val_dataset.tokenized_texts[idx].unsqueeze(0).to(device)
-            with torch.amp.autocast(device.type):
-                text_feat = model.encode_text(text)
-                text_feat /= text_feat.norm(dim=-1, keepdim=True)
-            
-            similarity = text_feat @ image_features.T  # (1, N_img)
-            values, indices = similarity.topk(max(topk), dim=-1)
-            
-            for k in topk:
-                if idx in indices[0][:k]:
-                    topk_correct[k] += 1
+        os.makedirs(cache_dir, exist_ok=True)
+        count = len(dataset.texts)
+        model.eval()
+        arrays = {}
+        eot = np.zeros(count, dtype=np.int64)
+        row = 0
+        with torch.no_grad():
+            for images, texts in tqdm(DataLoader(dataset, batch_size=batch_size, num_workers=workers),
+                                      desc=f"预计算冻结特征 {cache_dir}"):
+                images, texts = prepare_images(images, device), texts.to(device)
+                outputs = {
+                    'images': encode_image_prefix(model.visual, images, splits[0]),
+                    'texts': encode_text_prefix(model, texts, splits[1]),
+                }
+                for name, output in outputs.items():
+                    if name not in arrays:
+                        arrays[name] = np.memmap(os.path.join(cache_dir, f'{name}.f16'), dtype=np.float16,
+                                                 mode='w+', shape=(count,) + tuple(output.shape[1:]))
+                    arrays[name][row:row + len(output)] = output.cpu().numpy()
+                eot[row:row + len(texts)] = texts.argmax(dim=-1).cpu().numpy()
+                row += len(texts)
+        for array in arrays.values():
+            array.flush()
+        np.save(os.path.join(cache_dir, 'eot.npy'), eot)
+        with open(meta_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'count': count,
+                       'shapes': {name: list(array.shape) for name, array in arrays.items()}}, f)
+        size = sum(array.nbytes for array in arrays.values())
+        logger.info(f"冻结特征缓存完成: {count} 个样本，{size / 1024 ** 2:.1f}MB")
+
+    def __len__(self):
+        return self.meta['count']
+
+    def __getitem__(self, idx):
+        # memmap在各进程中按需打开，DataLoader worker不需要序列化数组
+        if self._arrays is None:
+            self._arrays = {
+                name: np.memmap(os.path.join(self.cache_dir, f'{name}.f16'), dtype=np.float16,
+                                mode='r', shape=tuple(shape))
+                for name, shape in self.meta['shapes'].items()
+            }
+        return (torch.from_numpy(np.array(self._arrays['images'][idx])),
+                torch.from_numpy(np.array(self._arrays['texts'][idx])),
+                int(self.eot[idx]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+class TeacherFeatureDataset(Dataset):
+    """在数据集样本后附加教师模型的归一化嵌入：(图像, token, 教师图像嵌入, 教师文本嵌入)
+
+    嵌入缓存在 cache_dir/images.npy、texts.npy（fp16）和 meta.json 中，教师模型只需要编码一次。
+    """
+
+    def __init__(self, dataset, cache_dir):
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.dataset = dataset
+        self.cache_dir = cache_dir
+        self._arrays = None
+
+    @staticmethod
+    def fingerprint(teacher_name, dataset):
+        return hashlib.sha1(json.dumps({
+            'teacher': teacher_name,
+            'texts': list(dataset.texts),
+            'image_paths': list(getattr(dataset, 'image_paths', [])),
+        }).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def build(teacher_name, datasets, cache_dir, resolution, device, batch_size=64, workers=0):
+        """用教师模型编码各数据集并写入 cache_dir/{名称}/；数据集和教师不变时复用已有缓存
+
+        datasets 为 {名称: 数据集}。图片沿用学生的预处理，要求教师的输入分辨率与学生相同。
+        返回教师的结构超参数和编码延迟（记录在 cache_dir/teacher.json 中）。
+        """
+        teacher_path = os.path.join(cache_dir, 'teacher.json')
+        pending = {}
+        for name, dataset in datasets.items():
+            fingerprint = TeacherFeatureDataset.fingerprint(teacher_name, dataset)
+            meta_path = os.path.join(cache_dir, name, 'meta.json')
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    if json.load(f).get('fingerprint') == fingerprint:
+                        logger.info(f"复用教师嵌入缓存: {os.path.join(cache_dir, name)}")
+                        continue
+            pending[name] = (dataset, fingerprint)
+        if not pending and os.path.exists(teacher_path):
+            with open(teacher_path, 'r') as f:
+                return json.load(f)
         
-        accs = {f"top{k}": topk_correct[k] / total for k in topk}
-        return accs
+        teacher, _ = clip.load(teacher_name, device=device, jit=False)
+        teacher = teacher.float().eval()
+        if teacher.visual.input_resolution != resolution:
+            raise ValueError(f"教师模型 {teacher_name} 的输入分辨率 {teacher.visual.input_resolution} "
+                             f"与学生模型的 {resolution} 不同，无法复用学生的图片预处理")
+        info = {'teacher': teacher_name, 'architecture': clip_architecture(teacher),
+                'latency_ms': encode_latency(teacher, device)}
+        for name, (dataset, fingerprint) in pending.items():
+            split_dir = os.path.join(cache_dir, name)
+            os.makedirs(split_dir, exist_ok=True)
+            image_features, text_features = embed_dataset(CLIPFeatures(teacher), dataset, device, batch_size, workers)
+            np.save(os.path.join(split_dir, 'images.npy'), image_features.half().cpu().numpy())
+            np.save(os.path.join(split_dir, 'texts.npy'), text_features.half().cpu().numpy())
+            with open(os.path.join(split_dir, 'meta.json'), 'w') as f:
+                json.dump({'fingerprint': fingerprint, 'count': len(image_features),
+                           'dim': image_features.shape[1]}, f)
+            logger.info(f"教师嵌入缓存完成: {split_dir}，{len(image_features)} 个样本")
+        with open(teacher_path, 'w') as f:
+            json.dump(info, f)
+        del teacher
+        return info
+
+    def features(self):
+        """全部教师嵌入 (N, D) 的float张量"""
+        return tuple(torch.from_numpy(np.load(os.path.join(self.cache_dir, f'{name}.npy'))).float()
+                     for name in ('images', 'texts'))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if self._arrays is None:
+            self._arrays = [np.load(os.path.join(self.cache_dir, f'{name}.npy'), mmap_mode='r')
+                            for name in ('images', 'texts')]
+        return (*self.dataset[idx], *(torch.from_numpy(np.array(array[idx])) for array in self._arrays))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+def checkpoint_weights(model, finetune_mode, lora_scale):
+    """完整微调保存全部权重；参数高效微调只保存可训练参数（几MB），加载时由merge_adapter合并"""
+    if finetune_mode == 'full':
+        return {'model_state_dict': model.state_dict()}
+    return {'adapter_state_dict': adapter_state_dict(model), 'finetune_mode': finetune_mode,
+            'lora_scale': lora_scale}
+
+def serving_state_dict(model):
+    """部署用的原始CLIP结构权重：LoRA增量合并进对应的Linear"""
+    state = {name.replace('.base.', '.'): tensor for name, tensor in model.state_dict().items()
+             if '.lora_' not in name}
+    for name, module in model.named_modules():
+        if isinstance(module, LoRALinear):
+            state[name + '.weight'] = state[name + '.weight'] + module.scale * (module.lora_B @ module.lora_A).detach()
+    return state
+
+def _snapshot(obj):
+    """复制状态中的所有张量，后台写盘期间训练可以继续修改参数"""
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return {key: _snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value) for value in obj)
+    return obj
+
+class AsyncWriter:
+    """在后台线程中执行写盘任务，同一时间只有一个任务；提交新任务前等待上一个完成
+
+    后台任务的异常会保存下来，在下一次 wait()（submit 也会先 wait）时重新抛出，
+    写盘失败不会被静默跳过，之后的指纹计算和上传不会用到缺失或不完整的文件。
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def submit(self, fn, *args):
+        self.wait()
+        self.thread = threading.Thread(target=self._run, args=(fn,) + args, daemon=True)
+        self.thread.start()
+
+    def _run(self, fn, *args):
+        try:
+            fn(*args)
+        except BaseException as e:
+            logger.error(f"后台写入失败: {e}")
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"后台写入失败: {error}") from error
+
+def write_checkpoint(state, checkpoint_dir, keep):
+    """写入 ckpt-{global_step}.pt 并只保留最近keep个"""
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, f"ckpt-{state['global_step']:08d}.pt")
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    for old in list_checkpoints(checkpoint_dir)[:-keep]:
+        os.remove(old)
+    logger.info(f"保存检查点 {path}")
+
+def list_checkpoints(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    return sorted(os.path.join(checkpoint_dir, f) for f in os.listdir(checkpoint_dir)
+                  if f.startswith('ckpt-') and f.endswith('.pt'))
+
+# 决定检查点能否续训的参数：这些参数不同的检查点来自另一次训练，不能接着训练
+RESUME_CONFIG_KEYS = (
+    'train', 'dataset_mode', 'finetune_mode', 'lora_rank', 'lora_alpha', 'lora_layers',
+    'batch_size', 'learning_rate', 'seed', 'hard_negatives', 'distill_teacher',
+)
+
+def resume_config(args):
+    return {key: getattr(args, key, None) for key in RESUME_CONFIG_KEYS}
+
+def training_state(model, optimizer, scaler, args, epoch, step_in_epoch, global_step, best_top1):
+    """可恢复训练的完整状态：权重、优化器、随机数状态、数据读取位置以及训练参数"""
+    return {
+        'config': resume_config(args),
+        'epoch': epoch,
+        'step_in_epoch': step_in_epoch,
+        'global_step': global_step,
+        'best_top1': best_top1,
+        **checkpoint_weights(model, args.finetune_mode, args.lora_alpha / args.lora_rank),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scaler_state_dict': scaler.state_dict(),
+        'rng': {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+        },
+    }
+
+def restore_training_state(path, model, optimizer, scaler, args):
+    """加载检查点并恢复权重、优化器和随机数状态，返回检查点内容
+
+    检查点记录的训练参数与本次不同时拒绝续训（换一个 --checkpoint-dir 或用 --no-resume 从头训练）。
+    """
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    saved = state.get('config')
+    if saved is None:
+        raise ValueError(f"检查点 {path} 没有记录训练参数，无法确认属于本次训练，请使用 --no-resume 或换一个 --checkpoint-dir")
+    current = resume_config(args)
+    changed = {key: (saved.get(key), current[key]) for key in current if saved.get(key) != current[key]}
+    if changed:
+        details = ', '.join(f"{key}: {old!r} -> {new!r}" for key, (old, new) in changed.items())
+        raise ValueError(f"检查点 {path} 来自参数不同的训练（{details}），请使用 --no-resume 或换一个 --checkpoint-dir")
+    if 'adapter_state_dict' in state:
+        model.load_state_dict(state['adapter_state_dict'], strict=False)
+    else:
+        model.load_state_dict(state['model_state_dict'])
+    optimizer.load_state_dict(state['optimizer_state_dict'])
+    scaler.load_state_dict(state['scaler_state_dict'])
+    random.setstate(state['rng']['python'])
+    np.random.set_state(state['rng']['numpy'])
+    torch.set_rng_state(state['rng']['torch'])
+    logger.info(f"从检查点 {path} 恢复: epoch {state['epoch'] + 1}，已完成 {state['step_in_epoch']} 步")
+    return state
+
+class EpochSampler(torch.utils.data.Sampler):
+    """每个epoch的样本顺序只由 (seed, epoch) 决定，因此可以从epoch中间的位置继续
+
+    world_size>1 时与DistributedSampler相同：补齐到能被world_size整除后按rank间隔取样。
+    """
+
+    def __init__(self, size, shuffle=True, seed=0, rank=0, world_size=1):
+        self.size = size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.num_samples = math.ceil(size / world_size)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """start为本rank在该epoch中已经用过的样本数"""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.size, generator=generator).tolist()
+        else:
+            order = list(range(self.size))
+        order += order[:self.num_samples * self.world_size - self.size]
+        return iter(order[self.rank::self.world_size][self.start:])
+
+    def __len__(self):
+        return max(0, self.num_samples - self.start)
+
+class HardNegativeSampler(EpochSampler):
+    """把样本和它的近邻放进同一批次，批内负样本就是图片或标题相近的其他商品
+
+    neighbors 为 hard_negative_neighbors 返回的 (N, k) 近邻下标，为空时与EpochSampler一样随机排列。
+    每个epoch按 (seed, epoch) 随机选取未用过的样本作为锚点，依次接上它未用过的近邻，每组最多group_size个；
+    分布式训练时按整批（而不是按样本）在rank之间轮流分配，近邻组不会被拆到不同rank。
+    """
+
+    def __init__(self, size, batch_size, group_size=4, seed=0, rank=0, world_size=1):
+        super().__init__(size, shuffle=True, seed=seed, rank=rank, world_size=world_size)
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.neighbors = None
+        span = batch_size * world_size
+        self.num_samples = math.ceil(size / span) * batch_size if world_size > 1 else size
+
+    def _order(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        anchors = torch.randperm(self.size, generator=generator).tolist()
+        if self.neighbors is None:
+            return anchors
+        neighbors = self.neighbors.tolist()
+        used = np.zeros(self.size, dtype=bool)
+        order = []
+        for anchor in anchors:
+            if used[anchor]:
+                continue
+            group = [anchor]
+            used[anchor] = True
+            for j in neighbors[anchor]:
+                if len(group) >= self.group_size:
+                    break
+                if j >= 0 and not used[j]:
+                    group.append(j)
+                    used[j] = True
+            order.extend(group)
+        return order
+
+    def __iter__(self):
+        order = self._order()
+        if self.world_size > 1:
+            # 补齐到能被 batch_size × world_size 整除，各rank分到相同数量的完整批次
+            span = self.batch_size * self.world_size
+            order += order[:-len(order) % span]
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        mine = [index for batch in batches[self.rank::self.world_size] for index in batch]
+        return iter(mine[self.start:])
+
+def load_datasets(args, preprocess, rank=0, world_size=1):
+    """创建训练集和验证集，返回 (train_dataset, val_dataset, corpus)
+
+    分布式训练时只由rank 0解压、划分数据集、转换分片和构建预处理缓存，
+    其余rank等待rank 0完成后直接使用同一份划分结果。--reuse-prepared 时所有rank都直接使用
+    --data-dir 中已准备好的划分、清单和预处理缓存（超参数搜索的各个试验共用一份数据）。
+    corpus 为训练结束后编码语料所需的全部划分及其图片来源；直接使用已有分片时为None。
+    """
+    corpus = None
+    if args.dataset_mode == 'shards' and shards_ready(os.path.join(args.shard_dir, 'train')):
+        # 已转换好的分片直接流式读取，不再读取标注和划分数据集
+        logger.info(f"使用已有的数据分片: {args.shard_dir}")
+    else:
+        builder = rank == 0 and not args.reuse_prepared
+        prepared = [None]
+        if args.reuse_prepared:
+            prepared = [load_prepared_dataset(args.data_dir)]
+        elif rank == 0:
+            source, dataset_dir = open_dataset_source(args.train, args.dataset_mode)
+            prepared = [(source, prepare_dataset(dataset_dir, source, args.seed, args.data_dir))]
+        if world_size > 1 and not args.reuse_prepared:
+            dist.broadcast_object_list(prepared, src=0)
+        source, dataset_paths = prepared[0]
+        # 并行查找和校验所有图片，损坏的图片在这里剔除，而不是训练时以全零图像代替
+        manifest = None
+        if args.manifest:
+            if builder:
+                manifest = DatasetManifest.build(
+                    args.manifest, [dataset_paths['train_path'], dataset_paths['val_path']],
+                    dataset_paths['image_dir'], source, workers=args.workers)
+            if world_size > 1:
+                dist.barrier()
+            if not builder:
+                manifest = DatasetManifest.load(args.manifest)
+        corpus = {
+            'source': source,
+            'jsonl_paths': [dataset_paths[f'{split}_path'] for split in ('train', 'val', 'test')],
+            'image_dir': dataset_paths['image_dir'],
+            'manifest': manifest,
+        }
+        train_dataset = FashionDataset(
+            dataset_paths['train_path'], 
+            dataset_paths['image_dir'], 
+            preprocess,
+            source,
+            manifest
+        )
+        val_dataset = FashionDataset(
+            dataset_paths['val_path'], 
+            dataset_paths['image_dir'], 
+            preprocess,
+            source,
+            manifest
+        )
+        if args.dataset_mode == 'shards' and builder:
+            convert_to_shards(val_dataset, os.path.join(args.shard_dir, 'val'), args.shard_size)
+            convert_to_shards(train_dataset, os.path.join(args.shard_dir, 'train'), args.shard_size)
+    
+    if args.dataset_mode == 'shards':
+        if world_size > 1:
+            dist.barrier()
+        train_dataset = ShardedTarDataset(os.path.join(args.shard_dir, 'train'), preprocess,
+                                          shuffle_buffer=args.shuffle_buffer, seed=args.seed)
+        train_dataset.rank = rank
+        train_dataset.world_size = world_size
+        val_dataset = ShardedTarDataset(os.path.join(args.shard_dir, 'val'), preprocess)
+        if args.preprocessed_cache:
+            logger.warning("分片模式下不使用预处理缓存，忽略 --preprocessed-cache")
+    elif args.preprocessed_cache:
+        # 可选：一次性把图像解码、缩放为uint8写入缓存，之后的epoch直接读取缓存
+        if builder:
+            cache = PreprocessedImageCache(args.preprocessed_cache)
+            cache.build(train_dataset.image_paths + val_dataset.image_paths, workers=args.workers, source=source)
+        if world_size > 1:
+            dist.barrier()
+        if not builder:
+            cache = PreprocessedImageCache(args.preprocessed_cache)
+        train_dataset = CachedImageDataset(train_dataset, cache)
+        val_dataset = CachedImageDataset(val_dataset, cache)
+    return train_dataset, val_dataset, corpus
+
+class CLIPFeatures(nn.Module):
+    """前向输出归一化后的图像、文本特征和logit_scale，供跨rank收集特征计算对比损失"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images, texts):
+        image_features = self.model.encode_image(images)
+        text_features = self.model.encode_text(texts)
+        image_features = image_features / image_features.norm(dim=1, keepdim=True)
+        text_features = text_features / text_features.norm(dim=1, keepdim=True)
+        return image_features, text_features, self.model.logit_scale.exp()
+
+class FrozenPrefixFeatures(nn.Module):
+    """从冻结特征缓存出发只计算可训练的部分，输出与CLIPFeatures相同"""
+
+    def __init__(self, model, splits):
+        super().__init__()
+        self.model = model
+        self.splits = splits
+
+    def forward(self, image_prefix, text_prefix, eot):
+        image_features = encode_image_suffix(self.model.visual, image_prefix.float(), self.splits[0])
+        text_features = encode_text_suffix(self.model, text_prefix.float(), eot, self.splits[1])
+        image_features = image_features / image_features.norm(dim=1, keepdim=True)
+        text_features = text_features / text_features.norm(dim=1, keepdim=True)
+        return image_features, text_features, self.model.logit_scale.exp()
+
+def prepare_batch(batch, device, channels_last=False):
+    """DataLoader批次 -> 特征模型的输入：图文数据集为 (图像, token)，冻结特征缓存为 (图像特征, 文本特征, EOT位置)
+
+    蒸馏时图文批次后面还附带 (教师图像嵌入, 教师文本嵌入)，由 split_teacher 拆开。
+    """
+    if len(batch) == 3:
+        return tuple(t.to(device) for t in batch)
+    images, texts, *teacher = batch
+    return (prepare_images(images, device, channels_last), texts.to(device),
+            *(t.to(device).float() for t in teacher))
+
+def split_teacher(inputs):
+    """prepare_batch的输出 -> (特征模型的输入, 教师嵌入)，不是蒸馏批次时教师嵌入为None"""
+    if len(inputs) == 4:
+        return inputs[:2], inputs[2:]
+    return inputs, None
+
+def contrastive_loss(image_features, text_features, logit_scale, rank=0, world_size=1):
+    """对称的图文对比损失，返回 (loss, logits_per_image, ground_truth)
+
+    分布式训练时先收集所有rank的特征（反向传播时梯度会传回各自的rank），
+    本rank的每个样本以全局批次中的其他样本为负样本，负样本数随进程数增长。
+    """
+    if world_size > 1:
+        all_image_features = torch.cat(dist_nn.all_gather(image_features), dim=0)
+        all_text_features = torch.cat(dist_nn.all_gather(text_features), dim=0)
+    else:
+        all_image_features, all_text_features = image_features, text_features
+    logits_per_image = logit_scale * image_features @ all_text_features.T
+    logits_per_text = logit_scale * text_features @ all_image_features.T
+    ground_truth = torch.arange(len(image_features), device=image_features.device) + rank * len(image_features)
+    loss = (F.cross_entropy(logits_per_image, ground_truth) +
+            F.cross_entropy(logits_per_text, ground_truth)) / 2
+    return loss, logits_per_image, ground_truth
+
+def distillation_loss(image_features, text_features, teacher_image, teacher_text, temperature=0.01):
+    """学生特征向教师嵌入空间对齐
+
+    余弦项让学生的嵌入与教师的嵌入逐样本对齐（两者可以互相检索，已有的教师图像嵌入无需重新编码）；
+    KL项让批内图文相似度的分布接近教师的分布，学到教师对负样本的排序。
+    """
+    image_features, text_features = image_features.float(), text_features.float()
+    cosine = (2 - (image_features * teacher_image).sum(dim=1) - (text_features * teacher_text).sum(dim=1)).mean()
+    student_logits = image_features @ text_features.T / temperature
+    teacher_logits = teacher_image @ teacher_text.T / temperature
+    kl = (F.kl_div(F.log_softmax(student_logits, dim=1), F.log_softmax(teacher_logits, dim=1),
+                   reduction='batchmean', log_target=True) +
+          F.kl_div(F.log_softmax(student_logits.T, dim=1), F.log_softmax(teacher_logits.T, dim=1),
+                   reduction='batchmean', log_target=True)) / 2
+    return cosine + kl
+
+def grad_cache_step(features_model, inputs, chunk_size, scaler, rank=0, world_size=1):
+    """梯度缓存：以恒定内存在大批次上计算对比损失并反向传播
+
+    1. 不建计算图，分块计算整批的特征；
+    2. 在整批特征上计算对比损失，只对特征（和logit_scale）求梯度；
+    3. 逐块重新前向计算特征，用第2步缓存的梯度反向传播到模型参数。
+    CLIP没有dropout，两次前向结果一致。返回值与contrastive_loss相同（已分离计算图）。
+    """
+    device_type = inputs[0].device.type
+    starts = list(range(0, len(inputs[0]), chunk_size))
+    
+    image_chunks, text_chunks = [], []
+    with torch.no_grad():
+        for start in starts:
+            with torch.amp.autocast(device_type):
+                image_feat, text_feat, logit_scale = features_model(
+                    *(t[start:start + chunk_size] for t in inputs))
+            image_chunks.append(image_feat.float())
+            text_chunks.append(text_feat.float())
+    image_features = torch.cat(image_chunks).requires_grad_()
+    text_features = torch.cat(text_chunks).requires_grad_()
+    logit_scale = logit_scale.float().requires_grad_()
+    
+    loss, logits_per_image, ground_truth = contrastive_loss(
+        image_features, text_features, logit_scale, rank, world_size)
+    scaler.scale(loss).backward()
+    
+    for i, start in enumerate(starts):
+        last = i == len(starts) - 1
+        # 分布式训练时只在最后一块同步梯度
+        sync = contextlib.nullcontext() if last or not isinstance(features_model, DDP) else features_model.no_sync()
+        with sync:
+            with torch.amp.autocast(device_type):
+                image_feat, text_feat, chunk_scale = features_model(
+                    *(t[start:start + chunk_size] for t in inputs))
+            # logit_scale的梯度只在最后一块传回，其余块传零（保证每块都用到全部参数）
+            scale_grad = logit_scale.grad if last else torch.zeros_like(logit_scale.grad)
+            torch.autograd.backward(
+                [image_feat, text_feat, chunk_scale],
+                [image_features.grad[start:start + chunk_size].to(image_feat.dtype),
+                 text_features.grad[start:start + chunk_size].to(text_feat.dtype),
+                 scale_grad.to(chunk_scale.dtype)])
+    return loss.detach(), logits_per_image.detach(), ground_truth
+
+def peak_memory_mb():
+    """本进程的内存峰值（MB），Linux上ru_maxrss的单位为KB；DataLoader worker进程不计入"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class MetricsLogger:
+    """训练指标按行写入JSONL，每条记录带type字段（step/epoch/eval）；path为空时不记录"""
+
+    def __init__(self, path):
+        self.file = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.file = open(path, 'a')
+
+    def log(self, kind, **record):
+        if self.file is None:
+            return
+        self.file.write(json.dumps({'type': kind, 'time': round(time.time(), 3), **record}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class StepProfiler:
+    """在 [start, end) 的全局步内用torch.profiler记录，结束后导出chrome trace并输出耗时最多的算子"""
+
+    def __init__(self, window, trace_dir, rank=0):
+        self.start, self.end = (int(step) for step in window.split(':')) if window else (None, None)
+        self.trace_dir = trace_dir
+        self.rank = rank
+        self.profiler = None
+
+    def step(self, global_step):
+        """每步开始前调用"""
+        if global_step == self.start:
+            self.profiler = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU],
+                record_shapes=True,
+                profile_memory=True)
+            self.profiler.__enter__()
+            logger.info(f"开始性能分析: 第 {self.start} 到 {self.end} 步")
+        elif global_step == self.end:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f'trace-rank{self.rank}-steps{self.start}-{self.end}.json')
+        self.profiler.export_chrome_trace(path)
+        logger.info(f"性能分析结果已导出到 {path}（可在 chrome://tracing 或 Perfetto 中查看）\n"
+                    + self.profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+        self.profiler = None
+
+def clip_architecture(model):
+    """CLIP(ViT)的结构超参数，写入model_info.json，部署时据此构建模型而不需要下载原始权重"""
+    return {
+        'embed_dim': model.text_projection.shape[1],
+        'image_resolution': model.visual.input_resolution,
+        'vision_layers': len(model.visual.transformer.resblocks),
+        'vision_width': model.visual.conv1.out_channels,
+        'vision_patch_size': model.visual.conv1.kernel_size[0],
+        'context_length': model.context_length,
+        'vocab_size': model.vocab_size,
+        'transformer_width': model.ln_final.weight.shape[0],
+        'transformer_heads': model.transformer.resblocks[0].attn.num_heads,
+        'transformer_layers': len(model.transformer.resblocks),
+    }
+
+def export_serving(model, args, writer):
+    """在后台导出部署权重到model_dir（SageMaker会自动保存/opt/ml/model/目录下的内容）
+
+    所有微调模式都导出合并后的完整fp16权重（参数高效微调的LoRA增量合并进对应Linear），
+    部署时按结构配置直接构建模型，不依赖原始CLIP权重；只含适配器的小文件仍保存在检查点中。
+    """
+    writer.submit(export_serving_weights, _snapshot(serving_state_dict(model)), args.model_dir)
+
+def set_projection(model, visual_proj, text_projection):
+    """替换图像和文本的投影矩阵，输出维度随之改变（部署时由clip_architecture记录的embed_dim构建）"""
+    model.visual.proj = nn.Parameter(visual_proj)
+    model.text_projection = nn.Parameter(text_projection)
+    model.visual.output_dim = visual_proj.shape[1]
+
+def fit_teacher_projection(model, dataset, device, batch_size=64, workers=0, max_samples=4096, ridge=1e-3):
+    """把学生的投影换成输出教师维度的投影，初始值为投影前的池化特征到教师嵌入的岭回归解
+
+    dataset 为 TeacherFeatureDataset，只使用前 max_samples 个样本。
+    """
+    visual_width, text_width = model.visual.proj.shape[0], model.text_projection.shape[0]
+    set_projection(model, torch.eye(visual_width, device=device), torch.eye(text_width, device=device))
+    pooled = [[], [], [], []]
+    model.eval()
+    with torch.no_grad():
+        subset = torch.utils.data.Subset(dataset, range(min(max_samples, len(dataset))))
+        for batch in DataLoader(subset, batch_size=batch_size, num_workers=workers):
+            (images, texts), teacher = split_teacher(prepare_batch(batch, device))
+            outputs = (model.encode_image(images), model.encode_text(texts)) + teacher
+            for outs, output in zip(pooled, outputs):
+                outs.append(output.float())
+    
+    def solve(x, y):
+        gram = x.T @ x
+        gram += ridge * gram.diagonal().mean() * torch.eye(len(gram), device=gram.device)
+        return torch.linalg.solve(gram, x.T @ y)
+    
+    image_pooled, text_pooled, teacher_image, teacher_text = (torch.cat(outs) for outs in pooled)
+    set_projection(model, solve(image_pooled, teacher_image), solve(text_pooled, teacher_text))
+    model.train()
+    logger.info(f"学生投影已替换为 {visual_width}/{text_width} -> {teacher_image.shape[1]} 维，"
+                f"用 {len(image_pooled)} 个样本拟合初始值")
+
+def encode_latency(model, device, runs=20):
+    """单张图片、单条文本的编码延迟中位数（毫秒）"""
+    model.eval()
+    resolution = model.visual.input_resolution
+    inputs = {
+        'image': (model.encode_image, torch.randn(1, 3, resolution, resolution, device=device)),
+        'text': (model.encode_text, torch.zeros(1, model.context_length, dtype=torch.long, device=device)),
+    }
+    latency = {}
+    with torch.no_grad():
+        for name, (encode, x) in inputs.items():
+            encode(x)
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                encode(x)
+                times.append(time.perf_counter() - start)
+            latency[name] = round(sorted(times)[len(times) // 2] * 1000, 2)
+    return latency
+
+def distillation_report(student, val_dataset, teacher_cache, teacher_info, device, topk=(1, 5, 10),
+                        batch_size=64, workers=0, block_size=1024):
+    """验证集上学生与教师的召回率对比、跨模型检索召回率和编码延迟
+
+    student_text_teacher_image 为学生编码查询文本、在教师编码的图像中检索，
+    即部署学生模型后沿用已有教师图像嵌入时的效果。
+    """
+    teacher_image, teacher_text = teacher_cache.features()
+    student_image, student_text = embed_dataset(CLIPFeatures(student), val_dataset, device, batch_size, workers)
+    pairs = {
+        'teacher': (teacher_text, teacher_image),
+        'student': (student_text, student_image),
+        'student_text_teacher_image': (student_text, teacher_image),
+        'teacher_text_student_image': (teacher_text, student_image),
+    }
+    report = {}
+    with torch.no_grad():
+        for name, (texts, images) in pairs.items():
+            t2i = _recall_at_k(texts, images, topk, block_size)
+            report[name] = {f"top{k}": t2i[k] for k in topk}
+            if name in ('teacher', 'student'):
+                i2t = _recall_at_k(images, texts, topk, block_size)
+                report[name].update({f"i2t_top{k}": i2t[k] for k in topk})
+    report['teacher_model'] = teacher_info['teacher']
+    report['latency_ms'] = {'teacher': teacher_info['latency_ms'], 'student': encode_latency(student, device)}
+    return report
+
+def corpus_images(corpus, corpus_list=None):
+    """返回需要编码的语料图片 [(id, 路径)] 及读取它们的source
+
+    corpus_list 为每行一个本地图片路径的文本文件，id即路径；否则为数据集全部划分中的图片，
+    id为标注中的image_path。
+    """
+    if corpus_list:
+        with open(corpus_list, 'r', encoding='utf-8') as f:
+            paths = [line.strip() for line in f if line.strip()]
+        return [(path, path) for path in dict.fromkeys(paths)], LocalFiles()
+    source, manifest = corpus['source'], corpus['manifest']
+    items = {}
+    for jsonl_path in corpus['jsonl_paths']:
+        with open(jsonl_path, 'r') as f:
+            for line in f:
+                item = json.loads(line)
+                for path in image_candidates(item, corpus['image_dir']):
+                    if manifest is not None and path in manifest:
+                        if manifest.ok(path):
+                            items.setdefault(item['image_path'], path)
+                        break
+                    if source.exists(path):
+                        items.setdefault(item['image_path'], path)
+                        break
+    return list(items.items()), source
+
+def export_corpus_embeddings(model, items, source, out_dir, device, meta, batch_size=64, workers=0,
+                             channels_last=False):
+    """编码语料图片并写入out_dir，部署时直接导入搜索索引，不需要重新编码
+
+    embeddings.f16 按行保存归一化后的fp16图像嵌入，ids.txt 每行一个对应的id，
+    meta.json 记录行数、维度和模型指纹（最后写入，存在即表示导出完整）。解码失败的图片不写入。
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    loader = DataLoader(_DecodeDataset([path for _, path in items], model.visual.input_resolution, source),
+                        batch_size=batch_size, num_workers=workers)
+    count = 0
+    start = 0
+    model.eval()
+    with open(os.path.join(out_dir, 'embeddings.f16'), 'wb') as emb_file, \
+            open(os.path.join(out_dir, 'ids.txt'), 'w', encoding='utf-8') as id_file, torch.no_grad():
+        for images, ok in tqdm(loader, desc="编码语料图片"):
+            ids = [image_id for (image_id, _), good in zip(items[start:start + len(images)], ok.tolist()) if good]
+            start += len(images)
+            if not ids:
+                continue
+            features = model.encode_image(prepare_images(images[ok], device, channels_last)).float()
+            features = F.normalize(features, dim=-1)
+            emb_file.write(features.half().cpu().numpy().tobytes())
+            id_file.write(''.join(image_id + '\n' for image_id in ids))
+            count += len(ids)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'count': count, 'dim': model.visual.output_dim, 'dtype': 'float16', 'normalized': True,
+                   **meta}, f)
+    logger.info(f"语料嵌入已导出到 {out_dir}: {count} 张图片（{len(items) - count} 张解码失败）")
 
-def train(args):
+def train_worker(rank, args):
+    """分布式训练的单个进程：初始化gloo进程组后执行train"""
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.dist_port))
+    dist.init_process_group('gloo', rank=rank, world_size=args.nproc)
+    try:
+        train(args, rank, args.nproc)
+    finally:
+        dist.destroy_process_group()
+
+def train(args, rank=0, world_size=1):
     # 设置设备 - 强制使用CPU
     device = torch.device("cpu")
-    logger.info(f"使用设备: {device}")
+    is_main = rank == 0
     
-    # 提取数据集
-    dataset_dir = extract_dataset(args.train)
-    dataset_paths = prepare_dataset(dataset_dir)
+    # 多进程时每个进程只使用分到的核数，避免线程数超过物理核心互相争抢；
+    # CPU性能模式下再给DataLoader的解码worker预留核心，并把inter-op线程数降到1
+    available = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    threads = args.threads_per_proc
+    if not threads and (world_size > 1 or args.cpu_perf):
+        reserved = args.workers if args.cpu_perf else 0
+        threads = max(1, available // world_size - reserved)
+    if threads:
+        torch.set_num_threads(threads)
+    interop_threads = args.interop_threads or (1 if args.cpu_perf else 0)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logger.warning(f"无法设置inter-op线程数: {e}")
+    logger.info(f"使用设备: {device}，rank {rank}/{world_size}，计算线程数 {torch.get_num_threads()}")
     
-    # 加载CLIP模型
-    model, preprocess = clip.load("ViT-B/32", device=device, jit=False)
+    # 固定随机种子（LoRA初始化等），续训时随机数状态由检查点恢复
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    
+    # 加载CLIP模型；图片在DataLoader中只缩放裁剪为uint8，归一化在 prepare_images 中按批完成
+    model, _ = clip.load("ViT-B/32", device=device, jit=False)
+    preprocess = Uint8Preprocess(model.visual.input_resolution)
     model = model.to(device)
     model = model.float()
+    if args.cpu_perf:
+        # 视觉塔的卷积使用channels-last内存布局
+        model.visual = model.visual.to(memory_format=torch.channels_last)
     model.train()
     
     # 创建数据集
-    train_dataset = FashionDataset(
-        dataset_paths['train_path'], 
-        dataset_paths['image_dir'], 
-        preprocess
-    )
-    val_dataset = FashionDataset(
-        dataset_paths['val_path'], 
-        dataset_paths['image_dir'], 
-        preprocess
-    )
+    train_dataset, val_dataset, corpus = load_datasets(args, preprocess, rank, world_size)
+    checkpoints = list_checkpoints(args.checkpoint_dir) if args.resume else []
+    
+    # 知识蒸馏：教师模型只编码一次训练集和验证集并缓存嵌入；学生的投影换成输出教师维度，
+    # 训练后学生的嵌入与教师兼容（续训时投影的权重由检查点恢复，不需要重新拟合）
+    teacher_info = None
+    if args.distill_teacher:
+        if rank == 0:
+            teacher_info = TeacherFeatureDataset.build(
+                args.distill_teacher, {'train': train_dataset, 'val': val_dataset}, args.teacher_cache,
+                model.visual.input_resolution, device, args.batch_size, args.workers)
+        if world_size > 1:
+            dist.barrier()
+        train_dataset = TeacherFeatureDataset(train_dataset, os.path.join(args.teacher_cache, 'train'))
+        if checkpoints:
+            dim = train_dataset.meta['dim']
+            set_projection(model, model.visual.proj.new_zeros(model.visual.proj.shape[0], dim),
+                           model.text_projection.new_zeros(model.text_projection.shape[0], dim))
+        else:
+            fit_teacher_projection(model, train_dataset, device, args.batch_size, args.workers)
     
+    # 参数高效微调：冻结骨干；冻结部分的输出与训练无关，只计算一次并缓存
+    eval_features_model = None
+    if args.finetune_mode != 'full':
+        splits = configure_peft(model, args.finetune_mode, args.lora_rank, args.lora_alpha, args.lora_layers)
+        if args.precompute_frozen:
+            if isinstance(train_dataset, IterableDataset):
+                # 按写入顺序完整读取分片，不分rank、不打乱
+                train_dataset = ShardedTarDataset(train_dataset.shard_dir, preprocess)
+            cache_dirs = [os.path.join(args.frozen_cache, name) for name in ('train', 'val')]
+            if rank == 0:
+                for dataset, cache_dir in zip((train_dataset, val_dataset), cache_dirs):
+                    FrozenFeatureDataset.build(model, dataset, splits, cache_dir, device, workers=args.workers)
+            if world_size > 1:
+                dist.barrier()
+            train_dataset, val_dataset = (FrozenFeatureDataset(cache_dir) for cache_dir in cache_dirs)
+            eval_features_model = FrozenPrefixFeatures(model, splits)
+    
+    # 流式数据集自行打乱（分片顺序 + 缓冲区），不能再交给DataLoader打乱；
+    # 其余数据集的顺序由EpochSampler按(seed, epoch)确定，续训时可以从中断的位置继续
+    streaming = isinstance(train_dataset, IterableDataset)
+    sampler = None
+    if args.hard_negatives and streaming:
+        logger.warning("流式分片数据集不支持难负样本采样，忽略 --hard-negatives")
+    if not streaming and args.hard_negatives:
+        sampler = HardNegativeSampler(len(train_dataset), args.batch_size, args.hard_negative_group,
+                                      seed=args.seed, rank=rank, world_size=world_size)
+    elif not streaming:
+        sampler = EpochSampler(len(train_dataset), shuffle=True, seed=args.seed, rank=rank, world_size=world_size)
+    # 分布式训练要求各rank每步的批大小相同，丢弃最后不完整的批次
     train_loader = DataLoader(
         train_dataset, 
         batch_size=args.batch_size, 
-        shuffle=True, 
-        num_workers=args.workers
+        sampler=sampler,
+        num_workers=args.workers,
+        drop_last=world_size > 1
     )
     
-    # 定义损失函数和优化器
-    loss_img = nn.CrossEntropyLoss()
-    loss_txt = nn.CrossEntropyLoss()
-    optimizer = torch.optim.AdamW(
-        model.parameters(), 
+    features_model = eval_features_model or CLIPFeatures(model)
+    if world_size > 1:
+        features_model = DDP(features_model)
+    if args.compile:
+        features_model = torch.compile(features_model)
+    
+    # 定义优化器
+    optimizer_kwargs = dict(
         lr=args.learning_rate, 
         betas=(0.9, 0.98), 
         eps=1e-6, 
         weight_decay=0.2
     )
+    if args.cpu_perf:
+        # 融合实现一次更新所有参数，不支持时退回foreach实现
+        params = [p for p in model.parameters() if p.requires_grad]
+        try:
+            optimizer = torch.optim.AdamW(params, fused=True, **optimizer_kwargs)
+        except (RuntimeError, TypeError):
+            optimizer = torch.optim.AdamW(params, foreach=True, **optimizer_kwargs)
+    else:
+        optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], **optimizer_kwargs)
     
-    # 使用混合精度训练
-    scaler = torch.amp.GradScaler()
+    # 使用混合精度训练；CPU上autocast使用bf16，指数范围与fp32相同，性能模式下不做损失缩放
+    scaler = torch.amp.GradScaler(enabled=not args.cpu_perf)
     
-    # 训练循环
-    best_top1 = 0.0
+    # 从最近的检查点恢复（SageMaker在任务重启时会把S3上的检查点同步回checkpoint_dir）
+    start_epoch, resume_step, global_step = 0, 0, 0
+    best_top1 = -1.0
+    if checkpoints:
+        state = restore_training_state(checkpoints[-1], model, optimizer, scaler, args)
+        start_epoch, resume_step = state['epoch'], state['step_in_epoch']
+        global_step, best_top1 = state['global_step'], state['best_top1']
+        del state
+    
+    # 检查点和部署权重在后台线程写盘，训练不等待
+    writer = AsyncWriter()
+    
+    def save_checkpoint(epoch, step_in_epoch):
+        state = training_state(model, optimizer, scaler, args, epoch, step_in_epoch, global_step, best_top1)
+        writer.submit(write_checkpoint, _snapshot(state), args.checkpoint_dir, args.keep_checkpoints)
     
-    for epoch in range(args.epochs):
+    # 逐步指标只由rank 0记录；性能分析每个rank各自导出
+    metrics = MetricsLogger(args.metrics_log if is_main else None)
+    profiler = StepProfiler(args.profile_steps, args.profile_dir, rank)
+    
+    # 训练循环
+    for epoch in range(start_epoch, args.epochs):
+        max_steps = None
+        skip_steps = resume_step if epoch == start_epoch else 0
+        if streaming:
+            train_dataset.set_epoch(epoch, skip_steps, args.batch_size)
+            if world_size > 1:
+                # 各rank分到的分片样本数不同，按最少的rank截断，保证每步都能一起收集特征
+                max_steps = train_dataset.min_rank_length() // args.batch_size - skip_steps
+        else:
+            sampler.set_epoch(epoch, skip_steps * args.batch_size)
+        if isinstance(sampler, HardNegativeSampler) and (epoch % args.hard_negative_refresh == 0
+                                                         or sampler.neighbors is None):
+            # 用当前模型重新编码训练集并建立近邻索引；只由rank 0计算，再广播给其余rank
+            index_start = time.perf_counter()
+            holder = [None]
+            if is_main:
+                model.eval()
+                image_features, text_features = embed_dataset(
+                    eval_features_model or CLIPFeatures(model), train_dataset, device, args.batch_size, args.workers)
+                holder = [hard_negative_neighbors(image_features, text_features, args.hard_negative_neighbors)]
+            if world_size > 1:
+                dist.broadcast_object_list(holder, src=0)
+            sampler.neighbors = holder[0]
+            index_time = time.perf_counter() - index_start
+            logger.info(f"难负样本近邻索引已更新: {len(train_dataset)} 个样本，耗时 {index_time:.1f}s")
+            metrics.log('index', epoch=epoch + 1, step=global_step, time_s=round(index_time, 3),
+                        samples=len(train_dataset))
         model.train()
         total_loss = 0
         correct = 0
         total = 0
-        pbar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{args.epochs}")
+        steps = 0
+        data_time = 0.0
+        epoch_start = time.perf_counter()
+        pbar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{args.epochs}", total=max_steps, disable=not is_main)
         
-        for images, texts in pbar:
-            images, texts = images.to(device), texts.to(device)
+        # 数据等待时间：上一步结束到本步输入准备好（含搬到设备）
+        step_end = time.perf_counter()
+        for batch in pbar:
+            if max_steps is not None and steps >= max_steps:
+                break
+            profiler.step(global_step)
+            inputs, teacher = split_teacher(prepare_batch(batch, device, args.cpu_perf))
+            step_start = time.perf_counter()
             optimizer.zero_grad()
-            ground_truth = torch.arange(len(images), device=device)
-            
-            with torch.amp.autocast(device.type):
-                logits_per_image, logits_per_text = model(images, texts)
-                loss = (loss_img(logits_per_image, ground_truth) + 
-                        loss_txt(logits_per_text, ground_truth)) / 2
-            
-            scaler.scale(loss).backward()
             
-            # 梯度裁剪
-            scaler.unscale_(optimizer)
-            nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+            forward_s = backward_s = None
+            if args.grad_cache:
+                # 梯度缓存的前向和反向交替进行，只记录合计的计算时间
+                with torch.profiler.record_function('grad_cache_step'):
+                    loss, logits_per_image, ground_truth = grad_cache_step(
+                        features_model, inputs, args.chunk_size, scaler, rank, world_size)
+            else:
+                with torch.profiler.record_function('forward'), torch.amp.autocast(device.type):
+                    image_features, text_features, logit_scale = features_model(*inputs)
+                    loss, logits_per_image, ground_truth = contrastive_loss(
+                        image_features, text_features, logit_scale, rank, world_size)
+                    if teacher is not None:
+                        loss = loss + args.distill_weight * distillation_loss(
+                            image_features, text_features, *teacher, args.distill_temperature)
+                forward_end = time.perf_counter()
+                with torch.profiler.record_function('backward'):
+                    scaler.scale(loss).backward()
+                forward_s = round(forward_end - step_start, 6)
+                backward_s = round(time.perf_counter() - forward_end, 6)
+            compute_end = time.perf_counter()
             
-            scaler.step(optimizer)
-            scaler.update()
+            with torch.profiler.record_function('optimizer'):
+                # 梯度裁剪
+                scaler.unscale_(optimizer)
+                nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                
+                scaler.step(optimizer)
+                scaler.update()
+            optimizer_end = time.perf_counter()
             
             # 计算top-1 acc
             _, pred = logits_per_image.softmax(dim=-1).max(dim=-1)
             correct += (pred == ground_truth).sum().item()
-            total += len(images)
+            total += len(ground_truth)
             
             total_loss += loss.item()
+            steps += 1
+            global_step += 1
             pbar.set_postfix(loss=loss.item(), acc=f"{100*correct/total:.2f}%")
+            
+            data_s = step_start - step_end
+            data_time += data_s
+            step_s = optimizer_end - step_end
+            metrics.log('step', epoch=epoch + 1, step=global_step, loss=loss.item(),
+                        batch_size=len(ground_truth),
+                        data_s=round(data_s, 6),
+                        forward_s=forward_s,
+                        backward_s=backward_s,
+                        compute_s=round(compute_end - step_start, 6),
+                        optimizer_s=round(optimizer_end - compute_end, 6),
+                        step_s=round(step_s, 6),
+                        samples_per_sec=round(len(ground_truth) * world_size / step_s, 2),
+                        peak_memory_mb=peak_memory_mb())
+            
+            # 各rank的参数相同，只由rank 0保存
+            if is_main and args.checkpoint_steps and global_step % args.checkpoint_steps == 0:
+                save_checkpoint(epoch, skip_steps + steps)
+            step_end = time.perf_counter()
+        
+        epoch_time = time.perf_counter() - epoch_start
+        samples_per_sec = total * world_size / epoch_time
+        
+        # 验证和保存只在rank 0进行，其余rank等待
+        if not is_main:
+            dist.barrier()
+            continue
         
-        epoch_loss = total_loss / len(train_loader)
-        epoch_acc = 100 * correct / total
-        logger.info(f"Epoch {epoch+1} - Loss: {epoch_loss:.4f}, Acc: {epoch_acc:.2f}%")
+        epoch_loss = total_loss / max(steps, 1)
+        epoch_acc = 100 * correct / max(total, 1)
+        data_fraction = data_time / max(epoch_time, 1e-9)
+        logger.info(f"Epoch {epoch+1} - Loss: {epoch_loss:.4f}, Acc: {epoch_acc:.2f}%, "
+                    f"吞吐: {samples_per_sec:.1f} samples/s, 数据等待占比: {data_fraction*100:.1f}%")
+        metrics.log('epoch', epoch=epoch + 1, step=global_step, loss=epoch_loss, acc=epoch_acc / 100,
+                    steps=steps, time_s=round(epoch_time, 3), samples_per_sec=round(samples_per_sec, 2),
+                    data_fraction=round(data_fraction, 4), peak_memory_mb=peak_memory_mb())
         
         # 验证
-        accs = evaluate(model, val_dataset, device)
+        eval_start = time.perf_counter()
+        accs = evaluate(model, val_dataset, device, features_model=eval_features_model)
         val_top1 = accs["top1"]
-        logger.info(f"Validation - Top1: {val_top1*100:.2f}%, Top5: {accs['top5']*100:.2f}%")
+        metrics.log('eval', epoch=epoch + 1, step=global_step, time_s=round(time.perf_counter() - eval_start, 3),
+                    **accs)
+        logger.info(f"Validation - Top1: {val_top1*100:.2f}%, Top5: {accs['top5']*100:.2f}%, "
+                    f"I2T Top1: {accs['i2t_top1']*100:.2f}%, I2T Top5: {accs['i2t_top5']*100:.2f}%")
         
-        # 保存最佳模型
+        # 导出最佳模型，部署工件只包含权重，不含优化器状态
         if val_top1 > best_top1:
             best_top1 = val_top1
-            # SageMaker会自动保存/opt/ml/model/目录下的内容
-            model_path = os.path.join(args.model_dir, 'model.pt')
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'val_top1': val_top1
-            }, model_path)
-            logger.info(f"保存最佳模型到 {model_path}")
-    
-    # 保存最终模型
-    final_model_path = os.path.join(args.model_dir, 'model_final.pt')
-    torch.save({
-        'epoch': args.epochs,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'val_top1': val_top1
-    }, final_model_path)
-    logger.info(f"保存最终模型到 {final_model_path}")
+            export_serving(model, args, writer)
+        
+        # epoch结束时保存检查点，续训从下一个epoch开始
+        save_checkpoint(epoch + 1, 0)
+        
+        if world_size > 1:
+            dist.barrier()
     
-    # 导出为TorchScript模型，便于部署
-    model.eval()
-    sample_input = torch.zeros(1, 3, 224, 224).to(device)
-    with torch.no_grad():
-        model_scripted = torch.jit.trace(model.encode_image, sample_input)
+    profiler.stop()
+    metrics.close()
+    if not is_main:
+        return model
     
-    script_model_path = os.path.join(args.model_dir, 'model.scripted.pt')
-    model_scripted.save(script_model_path)
-    logger.info(f"保存TorchScript模型到 {script_model_path}")
+    # 任务在训练结束后重启时，本次运行没有导出过部署权重（/opt/ml/model不会随检查点同步）
+    if not os.path.exists(os.path.join(args.model_dir, 'model.f16.json')):
+        logger.warning("本次运行没有导出最佳模型，导出当前权重")
+        export_serving(model, args, writer)
+    writer.wait()
+    fingerprint = artifact_fingerprint(args.model_dir)
+    architecture = clip_architecture(model)
+    serving_model = None
+    if args.embed_corpus or args.distill_teacher:
+        serving_model = build_serving_model(args.model_dir, architecture).to(device)
     
-    # 将模型打包成tar.gz
-    try:
-        import tarfile
-        with tarfile.open(os.path.join(args.model_dir, "model.tar.gz"), "w:gz") as tar:
-            tar.add(model_path, arcname=os.path.basename(model_path))
-    except Exception as e:
-        logger.error(f"打包模型时出错: {e}")
+    # 蒸馏：用部署权重对比学生与教师在验证集上的召回率和编码延迟
+    distillation = None
+    if args.distill_teacher:
+        distillation = distillation_report(
+            serving_model, val_dataset, TeacherFeatureDataset(val_dataset, os.path.join(args.teacher_cache, 'val')),
+            teacher_info, device, batch_size=args.batch_size, workers=args.workers)
+        latency = distillation['latency_ms']
+        logger.info(f"蒸馏效果（验证集 text→image Top1）: 教师 {distillation['teacher']['top1']*100:.2f}%，"
+                    f"学生 {distillation['student']['top1']*100:.2f}%，"
+                    f"学生文本检索教师图像 {distillation['student_text_teacher_image']['top1']*100:.2f}%；"
+                    f"编码延迟 图像 {latency['teacher']['image']}ms -> {latency['student']['image']}ms，"
+                    f"文本 {latency['teacher']['text']}ms -> {latency['student']['text']}ms")
+    
+    # 可选：用部署权重编码语料图片，部署时直接导入搜索索引
+    if args.embed_corpus:
+        if corpus is None and not args.corpus_list:
+            logger.warning("直接使用已有分片时没有语料图片列表，跳过语料嵌入（可用 --corpus-list 指定）")
+        else:
+            items, source = corpus_images(corpus, args.corpus_list)
+            export_corpus_embeddings(
+                serving_model, items, source, os.path.join(args.model_dir, 'corpus'), device,
+                {'model_fingerprint': fingerprint, 'clip_model_type': 'ViT-B/32'},
+                batch_size=args.batch_size, workers=args.workers, channels_last=args.cpu_perf)
     
     # 将模型和训练配置保存到一个目录中
     model_info = {
@@ -313,8 +2040,14 @@ def train(args):
         'epochs': args.epochs,
         'batch_size': args.batch_size,
         'learning_rate': args.learning_rate,
+        'finetune_mode': args.finetune_mode,
+        'weights_format': 'fp16-mmap',
+        'architecture': architecture,
+        'model_fingerprint': fingerprint,
         'val_top1': best_top1
     }
+    if distillation:
+        model_info['distillation'] = distillation
     
     with open(os.path.join(args.model_dir, 'model_info.json'), 'w') as f:
         json.dump(model_info, f)
@@ -325,21 +2058,117 @@ def train(args):
     return model
 
 def prepare_model_artifacts(model_dir):
-    """准备模型工件，复制推理代码到模型目录中"""
+    """准备模型工件，复制推理代码和CLIP的模型结构/分词器代码到模型目录中
+
+    工件自包含：推理只依赖镜像自带的torch、numpy和Pillow，按model_info.json中的结构配置构建模型，
+    以内存映射方式加载model.f16，冷启动不需要下载原始CLIP权重，也不需要pip安装CLIP。
+    """
     code_dir = os.path.join(model_dir, 'code')
     os.makedirs(code_dir, exist_ok=True)
     
+    # 附带clip包中的模型结构和分词器（不含依赖torchvision/pkg_resources的clip/__init__和clip/clip.py）
+    vendor_dir = os.path.join(code_dir, 'clip_vendor')
+    os.makedirs(vendor_dir, exist_ok=True)
+    clip_dir = os.path.dirname(clip.model.__file__)
+    for name in ('model.py', 'simple_tokenizer.py', 'bpe_simple_vocab_16e6.txt.gz'):
+        shutil.copyfile(os.path.join(clip_dir, name), os.path.join(vendor_dir, name))
+    open(os.path.join(vendor_dir, '__init__.py'), 'w').close()
+    
     # 创建inference.py
-    inference_code = """
+    inference_code = r"""
 import os
+import re
+import io
+import sys
 import json
+import types
+import base64
+import unicodedata
 import torch
-import clip
 from PIL import Image
-import io
-import base64
 import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+def install_tokenizer_fallbacks():
+    # 镜像没有ftfy/regex时用标准库近似：ftfy只做NFC规范化；
+    # regex的\p{L}/\p{N}换成re的等价写法（上标数字等少数字符会被归入字母）
+    try:
+        import ftfy
+    except ImportError:
+        ftfy = types.ModuleType('ftfy')
+        ftfy.fix_text = lambda text: unicodedata.normalize('NFC', text)
+        sys.modules['ftfy'] = ftfy
+    try:
+        import regex
+    except ImportError:
+        regex = types.ModuleType('regex')
+        replacements = [(r'[^\s\p{L}\p{N}]+', r'(?:[^\s\w]|_)+'), (r'[\p{L}]+', r'[^\W\d_]+'), (r'[\p{N}]', r'\d')]
+        
+        def compile_pattern(pattern, flags=0):
+            for unicode_class, equivalent in replacements:
+                pattern = pattern.replace(unicode_class, equivalent)
+            return re.compile(pattern, flags)
+        
+        regex.compile = compile_pattern
+        regex.sub = re.sub
+        regex.findall = re.findall
+        regex.IGNORECASE = re.IGNORECASE
+        sys.modules['regex'] = regex
+
+install_tokenizer_fallbacks()
+from clip_vendor.model import CLIP, build_model, convert_weights
+from clip_vendor.simple_tokenizer import SimpleTokenizer
+
+# 权重随后全部被部署权重覆盖，跳过构造时的随机初始化
+CLIP.initialize_parameters = lambda self: None
+
+_tokenizer = SimpleTokenizer()
+
+def tokenize(texts, context_length=77):
+    sot = _tokenizer.encoder['<|startoftext|>']
+    eot = _tokenizer.encoder['<|endoftext|>']
+    result = torch.zeros(len(texts), context_length, dtype=torch.long)
+    for i, text in enumerate(texts):
+        tokens = [sot] + _tokenizer.encode(text) + [eot]
+        if len(tokens) > context_length:
+            tokens = tokens[:context_length]
+            tokens[-1] = eot
+        result[i, :len(tokens)] = torch.tensor(tokens)
+    return result
+
+def make_preprocess(resolution):
+    # 与CLIP的预处理一致：短边双三次缩放到resolution、中心裁剪、按CLIP均值方差归一化
+    def preprocess(image):
+        width, height = image.size
+        if width <= height:
+            size = (resolution, int(resolution * height / width))
+        else:
+            size = (int(resolution * width / height), resolution)
+        image = image.convert('RGB').resize(size, Image.BICUBIC)
+        left = int(round((size[0] - resolution) / 2.0))
+        top = int(round((size[1] - resolution) / 2.0))
+        image = image.crop((left, top, left + resolution, top + resolution))
+        array = (np.asarray(image, dtype=np.float32) / 255.0 - CLIP_MEAN) / CLIP_STD
+        return torch.from_numpy(array.transpose(2, 0, 1).copy())
+    return preprocess
+
+def load_serving_weights(model_dir, name='model.f16'):
+    path = os.path.join(model_dir, name)
+    with open(path + '.json', 'r') as f:
+        index = json.load(f)
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    state = {}
+    for key, entry in index['tensors'].items():
+        dtype = np.dtype(entry['dtype'])
+        nbytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        array = data[entry['offset']:entry['offset'] + nbytes].view(dtype).reshape(entry['shape'])
+        state[key] = torch.from_numpy(array)
+    return state
+
 def model_fn(model_dir):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     
@@ -347,17 +2176,23 @@ def model_fn(model_dir):
     with open(os.path.join(model_dir, 'model_info.json'), 'r') as f:
         model_info = json.load(f)
     
-    # 加载基础CLIP模型
-    model, preprocess = clip.load(model_info['clip_model_type'], device=device, jit=False)
-    
-    # 加载微调的权重
-    checkpoint = torch.load(os.path.join(model_dir, 'model.pt'), map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    # 按结构配置构建模型并加载内存映射的fp16权重，不需要下载原始CLIP权重
+    state = load_serving_weights(model_dir)
+    if 'architecture' in model_info:
+        model = CLIP(**model_info['architecture'])
+        model.load_state_dict(state)
+        if device.type == 'cuda':
+            convert_weights(model)
+    else:
+        model = build_model(state)
+    model = model.to(device)
+    if device.type == 'cpu':
+        model = model.float()
     model.eval()
     
     return {
         'model': model,
-        'preprocess': preprocess,
+        'preprocess': make_preprocess(model.visual.input_resolution),
         'device': device
     }
 
@@ -396,7 +2231,7 @@ def predict_fn(input_data, model_dict):
         
         # 处理文本
         if text:
-            text_tensor = clip.tokenize([text]).to(device)
+            text_tensor = tokenize([text]).to(device)
             text_features = model.encode_text(text_tensor)
             text_features /= text_features.norm(dim=-1, keepdim=True)
         
@@ -428,22 +2263,14 @@ def output_fn(prediction, response_content_type):
     with open(os.path.join(code_dir, 'inference.py'), 'w') as f:
         f.write(inference_code)
     
-    # 创建requirements.txt
-    requirements = """
-torch>=1.10.0
-torchvision>=0.11.1
-Pillow>=8.4.0
-numpy>=1.21.0
-git+https://github.com/openai/CLIP.git
-"""
-    
-    with open(os.path.join(code_dir, 'requirements.txt'), 'w') as f:
-        f.write(requirements)
+    # 推理不再需要额外安装依赖；删除旧版本工件中的requirements.txt，避免容器启动时pip安装
+    requirements_path = os.path.join(code_dir, 'requirements.txt')
+    if os.path.exists(requirements_path):
+        os.remove(requirements_path)
     
     # 创建serve文件(入口点)
     serve_script = """#!/bin/bash
 cd /opt/ml/model/code
-pip install -r requirements.txt
 cp -r /opt/ml/model/* /opt/program/
 """
     
@@ -455,7 +2282,7 @@ cp -r /opt/ml/model/* /opt/program/
     
     logger.info(f"模型工件已准备完成: {code_dir}")
 
-if __name__ == '__main__':
+def build_parser():
     parser = argparse.ArgumentParser()
     
     # 数据、模型和输出目录
@@ -468,8 +2295,90 @@ if __name__ == '__main__':
     parser.add_argument('--learning-rate', type=float, default=5e-6)
     parser.add_argument('--max-grad-norm', type=float, default=1.0)
     parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    
+    # 划分后的JSONL写到 --data-dir；--reuse-prepared 直接使用其中已准备好的划分、清单和预处理缓存
+    parser.add_argument('--data-dir', type=str, default='/tmp/data')
+    parser.add_argument('--reuse-prepared', action='store_true')
+    
+    # 数据集清单（图片签名、宽高、内容哈希、能否解码），已有清单时只重新校验变化的图片；空字符串为不使用
+    parser.add_argument('--manifest', type=str, default='/tmp/data/manifest.npz')
+    
+    # 预处理缓存目录（为空则每个epoch都重新解码图片）
+    parser.add_argument('--preprocessed-cache', type=str, default=None)
+    
+    # 数据集读取方式：extract 解压ZIP；zip 直接从ZIP读取；shards 转换为tar分片后流式读取（已转换则直接使用）
+    parser.add_argument('--dataset-mode', type=str, default='extract', choices=['extract', 'zip', 'shards'])
+    parser.add_argument('--shard-dir', type=str, default=os.environ.get('SM_CHANNEL_SHARDS', '/tmp/shards'))
+    parser.add_argument('--shard-size', type=int, default=1000)
+    parser.add_argument('--shuffle-buffer', type=int, default=1000)
+    
+    # 梯度缓存：--batch-size 为逻辑批大小，每次前向/反向只处理 --chunk-size 个样本
+    parser.add_argument('--grad-cache', action='store_true')
+    parser.add_argument('--chunk-size', type=int, default=32)
+    
+    # 参数高效微调：lora 在最后 --lora-layers 个残差块（0为全部）的MLP上加LoRA；proj 只训练投影层
+    parser.add_argument('--finetune-mode', type=str, default='full', choices=['full', 'lora', 'proj'])
+    parser.add_argument('--lora-rank', type=int, default=8)
+    parser.add_argument('--lora-alpha', type=float, default=16)
+    parser.add_argument('--lora-layers', type=int, default=2)
+    # 冻结部分的输出预先计算一次并缓存（不需要时用 --no-precompute-frozen 关闭）
+    parser.add_argument('--no-precompute-frozen', dest='precompute_frozen', action='store_false')
+    parser.add_argument('--frozen-cache', type=str, default='/tmp/frozen_features')
     
+    # 多进程数据并行（gloo后端），--nproc 1 为单进程训练
+    parser.add_argument('--nproc', type=int, default=1)
+    parser.add_argument('--threads-per-proc', type=int, default=0)
+    parser.add_argument('--interop-threads', type=int, default=0)
+    
+    # CPU性能模式：bf16 autocast不做损失缩放、channels-last、融合AdamW、线程调优；--compile 编译前向
+    parser.add_argument('--cpu-perf', action='store_true')
+    parser.add_argument('--compile', action='store_true')
+    parser.add_argument('--dist-port', type=int, default=29500)
+    
+    # 可恢复训练：每 --checkpoint-steps 步及每个epoch结束时在后台保存检查点；
+    # 在SageMaker上（设置了 SM_CHECKPOINT_DIR）默认从最新的检查点继续，本地运行需要显式 --resume
+    parser.add_argument('--checkpoint-dir', type=str, default=os.environ.get('SM_CHECKPOINT_DIR', '/tmp/checkpoints'))
+    parser.add_argument('--checkpoint-steps', type=int, default=200)
+    parser.add_argument('--keep-checkpoints', type=int, default=2)
+    parser.add_argument('--resume', dest='resume', action='store_true', default='SM_CHECKPOINT_DIR' in os.environ)
+    parser.add_argument('--no-resume', dest='resume', action='store_false')
+    
+    # 难负样本采样：每 --hard-negative-refresh 个epoch用当前模型重建训练集的近邻索引，
+    # 每个样本与最多 --hard-negative-group - 1 个近邻（从最相似的 --hard-negative-neighbors 个中选）放在同一批次
+    parser.add_argument('--hard-negatives', action='store_true')
+    parser.add_argument('--hard-negative-refresh', type=int, default=1)
+    parser.add_argument('--hard-negative-neighbors', type=int, default=16)
+    parser.add_argument('--hard-negative-group', type=int, default=4)
+    
+    # 知识蒸馏：--distill-teacher 为教师CLIP模型（如 ViT-L/14），教师嵌入缓存在 --teacher-cache；
+    # 学生的投影输出教师维度，损失为对比损失 + --distill-weight × 蒸馏损失（余弦对齐 + 批内相似度分布KL）
+    parser.add_argument('--distill-teacher', type=str, default=None)
+    parser.add_argument('--distill-weight', type=float, default=1.0)
+    parser.add_argument('--distill-temperature', type=float, default=0.01)
+    parser.add_argument('--teacher-cache', type=str, default='/tmp/teacher_features')
+    
+    # 训练结束后用部署权重编码语料图片，写入模型工件的 corpus/ 目录；
+    # 默认编码数据集全部划分中的图片，--corpus-list 为每行一个图片路径的文本文件
+    parser.add_argument('--embed-corpus', action='store_true')
+    parser.add_argument('--corpus-list', type=str, default=None)
+    
+    # 逐步训练指标（JSONL，空字符串为不记录）；--profile-steps START:END 对这些全局步做性能分析
+    output_data_dir = os.environ.get('SM_OUTPUT_DATA_DIR', '/tmp')
+    parser.add_argument('--metrics-log', type=str, default=os.path.join(output_data_dir, 'train_metrics.jsonl'))
+    parser.add_argument('--profile-steps', type=str, default=None)
+    parser.add_argument('--profile-dir', type=str, default=os.path.join(output_data_dir, 'profile'))
+    
+    return parser
+
+if __name__ == '__main__':
+    parser = build_parser()
     args = parser.parse_args()
+    if args.distill_teacher and (args.finetune_mode != 'full' or args.dataset_mode == 'shards' or args.grad_cache):
+        parser.error('--distill-teacher 需要 --finetune-mode full，且不支持 shards 数据集和 --grad-cache')
     
     # 开始训练
-    train(args) 
\ No newline at end of file
+    if args.nproc > 1:
+        mp.spawn(train_worker, args=(args,), nprocs=args.nproc)
+    else:
+        train(args) 
\ No newline at end of file